@@ -0,0 +1,752 @@
+"""Offline benchmark for bot.py handlers.
+
+Drives the real Application (handlers, persistence, caches, DB helpers) with
+synthetic updates. The Bot API is replaced by a stub transport that records
+every call, and each run uses a throwaway database on a local Postgres.
+
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/postgres python bench.py --out bench.json
+
+The database in BENCH_DATABASE_URL is only used to CREATE/DROP a temporary
+bot_bench_<pid> database. Results are written as JSON so runs can be diffed.
+
+--concurrency USERS runs the same cart sessions one update at a time and then
+for all users at once through PerUserUpdateProcessor, and fails unless every
+user's updates ran in order, one at a time, and left the same cart. Add
+--api-latency 20 to give each stub Bot API call a realistic round trip.
+
+--webhook posts synthetic updates to the webhook server run_webhook uses, on
+localhost, and fails unless a correct secret is accepted and handled, a wrong
+one gets 403 and update types outside ALLOWED_UPDATES are ignored.
+
+--shards 1 2 4 runs the same load through BOT_MODE=sharded instead: a ShardFront
+in this process and N worker processes (this file with --shard-worker, same stub
+Bot API), fed from many concurrent users, and reports throughput per N. The
+users post to the front's webhook server (shard_webhook_server) over localhost HTTP,
+one connection per request. Before the load, the front must refuse a wrong secret
+(even with a huge Content-Length and no body sent), an oversized body, bad JSON and
+garbage, and accept a chunked body.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import functools
+import socket
+import itertools
+import tracemalloc
+import urllib.error
+import urllib.request
+from typing import Optional, Dict, Any, List, Callable, Awaitable
+from urllib.parse import urlsplit, urlunsplit
+
+ADMIN_ID = 999_000_001
+BENCH_DB = os.getenv("BENCH_DB") or f"bot_bench_{os.getpid()}"  # set for --shard-worker children
+BASE_DSN = os.getenv("BENCH_DATABASE_URL", "postgresql://postgres@localhost/postgres")
+
+
+def with_database(dsn: str, name: str) -> str:
+    parts = urlsplit(dsn)
+    return urlunsplit((parts.scheme, parts.netloc, f"/{name}", parts.query, parts.fragment))
+
+
+# bot.py reads its configuration at import time
+os.environ["BOT_TOKEN"] = "0:bench"
+os.environ["ADMIN_ID"] = str(ADMIN_ID)
+os.environ["BENCH_DB"] = BENCH_DB
+os.environ["DATABASE_URL"] = with_database(BASE_DSN, BENCH_DB)
+os.environ.setdefault("SEND_GLOBAL_RATE", "1000000")  # measure handlers, not Telegram's limits
+os.environ.setdefault("SEND_CHAT_RATE", "1000000")
+os.environ.setdefault("SEND_CHAT_BURST", "1000000")
+os.chdir(os.path.dirname(os.path.abspath(__file__)))  # static images are opened relative to cwd
+
+import asyncpg  # noqa: E402
+import tornado.httpclient  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import CallbackQueryHandler, TypeHandler  # noqa: E402
+from telegram.request import BaseRequest, RequestData  # noqa: E402
+
+import bot  # noqa: E402
+
+
+# ================== STUB BOT API ==================
+class StubRequest(BaseRequest):
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency  # seconds per call, a stand-in for the round trip to Telegram
+        self.calls: List[str] = []
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        read_timeout: Any = None,
+        write_timeout: Any = None,
+        connect_timeout: Any = None,
+        pool_timeout: Any = None,
+    ) -> Any:
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.json_parameters if request_data else {}
+        self.calls.append(endpoint)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return 200, json.dumps({"ok": True, "result": self._result(endpoint, params)}).encode()
+
+    def _result(self, endpoint: str, params: Dict[str, str]) -> Any:
+        if endpoint == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if endpoint in ("sendMessage", "sendPhoto", "editMessageText", "editMessageCaption", "editMessageReplyMarkup"):
+            chat_id = int(params.get("chat_id", 0))
+            msg: Dict[str, Any] = {
+                "message_id": int(params.get("message_id") or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+            }
+            if endpoint == "sendPhoto":
+                msg["photo"] = [{"file_id": f"F{next(self._file_ids)}", "file_unique_id": "u", "width": 1, "height": 1}]
+            else:
+                msg["text"] = params.get("text", "")
+            return msg
+        return True
+
+
+# ================== SYNTHETIC UPDATES ==================
+_update_ids = itertools.count(1)
+
+
+def user_json(user_id: int) -> Dict[str, Any]:
+    return {"id": user_id, "is_bot": False, "first_name": f"U{user_id}", "username": f"user{user_id}"}
+
+
+def command_json(user_id: int, text: str) -> Dict[str, Any]:
+    cmd = text.split()[0]
+    return {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user_json(user_id),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(cmd)}],
+        },
+    }
+
+
+def text_json(user_id: int, text: str) -> Dict[str, Any]:
+    return {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user_json(user_id),
+            "text": text,
+        },
+    }
+
+
+def callback_json(user_id: int, data: str, photo: bool = False) -> Dict[str, Any]:
+    message: Dict[str, Any] = {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}}
+    if photo:
+        message["photo"] = [{"file_id": "F0", "file_unique_id": "u", "width": 1, "height": 1}]
+    else:
+        message["text"] = "menu"
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": user_json(user_id),
+            "chat_instance": "bench",
+            "data": data,
+            "message": message,
+        },
+    }
+
+
+def command(app: Any, user_id: int, text: str) -> Update:
+    return Update.de_json(command_json(user_id, text), app.bot)
+
+
+def text_message(app: Any, user_id: int, text: str) -> Update:
+    return Update.de_json(text_json(user_id, text), app.bot)
+
+
+def callback(app: Any, user_id: int, data: str, photo: bool = False) -> Update:
+    return Update.de_json(callback_json(user_id, data, photo), app.bot)
+
+
+# ================== MEASUREMENT ==================
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def db_query_count() -> int:
+    return sum(q[0] for name, q in bot.DB_STATS.queries.items() if name != "pool_reset")
+
+
+class Recorder:
+    def __init__(self, app: Any, stub: StubRequest, trace_alloc: bool) -> None:
+        self.app = app
+        self.stub = stub
+        self.trace_alloc = trace_alloc
+        self.latencies: List[float] = []
+        self.queries: List[int] = []
+        self.api_calls: List[int] = []
+        self.alloc_bytes: List[int] = []
+        self.by_handler: Dict[str, List[float]] = {}
+
+    async def feed(self, update: Update, label: str) -> None:
+        await asyncio.sleep(0)  # let query-logger callbacks of the previous update land
+        q0 = db_query_count()
+        c0 = len(self.stub.calls)
+        if self.trace_alloc:
+            tracemalloc.reset_peak()
+            m0 = tracemalloc.get_traced_memory()[0]
+        t0 = time.perf_counter()
+        await self.app.process_update(update)
+        elapsed = time.perf_counter() - t0
+        if self.trace_alloc:
+            self.alloc_bytes.append(tracemalloc.get_traced_memory()[1] - m0)
+        await asyncio.sleep(0)
+        self.latencies.append(elapsed)
+        self.queries.append(db_query_count() - q0)
+        self.api_calls.append(len(self.stub.calls) - c0)
+        self.by_handler.setdefault(label, []).append(elapsed)
+
+    def report(self) -> Dict[str, Any]:
+        n = len(self.latencies)
+        out: Dict[str, Any] = {
+            "updates": n,
+            "latency_ms": {
+                "p50": round(percentile(self.latencies, 50) * 1000, 3),
+                "p95": round(percentile(self.latencies, 95) * 1000, 3),
+                "p99": round(percentile(self.latencies, 99) * 1000, 3),
+                "mean": round(sum(self.latencies) / n * 1000, 3) if n else 0.0,
+            },
+            "db_queries_per_update": round(sum(self.queries) / n, 3) if n else 0.0,
+            "bot_api_calls_per_update": round(sum(self.api_calls) / n, 3) if n else 0.0,
+            "per_step_p50_ms": {
+                k: round(percentile(v, 50) * 1000, 3) for k, v in sorted(self.by_handler.items())
+            },
+        }
+        if self.alloc_bytes:
+            out["alloc_peak_kib_per_update"] = {
+                "p50": round(percentile(self.alloc_bytes, 50) / 1024, 1),
+                "p95": round(percentile(self.alloc_bytes, 95) / 1024, 1),
+            }
+        return out
+
+
+# ================== SCENARIOS ==================
+async def seed(pool: Any, items: int, users: range) -> List[int]:
+    async with pool.acquire() as conn:
+        await conn.executemany(
+            "INSERT INTO items (name, short_text, price_cents, photo_file_id) VALUES ($1, $2, $3, $4) ON CONFLICT (name) DO NOTHING",
+            [(f"Item {i}", "bench item", 100 + i * 50, "F0") for i in range(items)],
+        )
+        await conn.executemany(
+            "INSERT INTO users (user_id, first_name, username, status) VALUES ($1, $2, $3, 'SAFE') "
+            "ON CONFLICT (user_id) DO UPDATE SET status='SAFE'",
+            [(uid, f"U{uid}", f"user{uid}") for uid in users],
+        )
+    bot.CATALOG.bump()
+    return [int(it["id"]) for it in await bot.list_items(pool)]
+
+
+async def browse_shop(rec: Recorder, pool: Any, users: int) -> None:
+    uids = range(100_000, 100_000 + users)
+    item_ids = await seed(pool, 20, uids)
+    for uid in uids:
+        await rec.feed(command(rec.app, uid, "/start"), "start_cmd")
+        await rec.feed(callback(rec.app, uid, "safe:shop", photo=True), "safe:shop")
+        await rec.feed(callback(rec.app, uid, f"shop:from:{item_ids[bot.CATALOG_PAGE_SIZE]}", photo=True), "shop:page")
+        for iid in item_ids[:3]:
+            await rec.feed(callback(rec.app, uid, f"item:{iid}", photo=True), "item_open")
+        await rec.feed(callback(rec.app, uid, "safe:home", photo=True), "safe:home")
+
+
+async def checkout(rec: Recorder, uid: int, item_ids: List[int], delivery: bool) -> None:
+    await rec.feed(callback(rec.app, uid, "safe:buy", photo=True), "safe:buy")
+    for iid in item_ids:
+        await rec.feed(callback(rec.app, uid, f"buy:item:{iid}", photo=True), "buy:item")
+        await rec.feed(callback(rec.app, uid, f"buy:qty:{iid}:2", photo=True), "buy:qty")
+    await rec.feed(callback(rec.app, uid, "buy:next", photo=True), "buy:next")
+    if delivery:
+        await rec.feed(callback(rec.app, uid, "buy:delivery:yes"), "buy:delivery")
+        await rec.feed(text_message(rec.app, uid, "Main street 1"), "handle_text:address")
+    else:
+        await rec.feed(callback(rec.app, uid, "buy:delivery:no"), "buy:delivery")
+
+
+async def cart_checkout(rec: Recorder, pool: Any, users: int) -> None:
+    uids = range(200_000, 200_000 + users)
+    item_ids = await seed(pool, 20, uids)
+    for n, uid in enumerate(uids):
+        await checkout(rec, uid, item_ids[:5], delivery=bool(n % 2))
+
+
+async def admin_completes(rec: Recorder, pool: Any, orders: int) -> None:
+    uids = range(300_000, 300_000 + orders)
+    item_ids = await seed(pool, 20, uids)
+    by_id = (await bot.CATALOG.get(pool)).by_id
+    for uid in uids:
+        cart = {iid: bot.CartLine(1, int(by_id[iid]["price_cents"])) for iid in item_ids[:3]}
+        order_id, _ = await bot.create_order(pool, uid, cart, False, None, uid.to_bytes(8, "big"))
+        await rec.feed(callback(rec.app, ADMIN_ID, f"ord:complete:{order_id}"), "admin_order_callback:complete")
+
+
+SCENARIOS: Dict[str, Callable[[Recorder, Any, int], Awaitable[None]]] = {
+    "browse_shop": browse_shop,
+    "cart_5_items_checkout": cart_checkout,
+    "admin_completes_orders": admin_completes,
+}
+
+
+# ================== CALLBACK ROUTING ==================
+# the regex chain bot.py registered before CALLBACK_ROUTES, in registration order
+LEGACY_CALLBACK_PATTERNS = [
+    r"^(lang:(et|ru|en)|verify)$",
+    r"^safe:(shop|buy|orders|help|account|home)$",
+    r"^item:\d+(:\d+)?$",
+    r"^shop:(from|before|open):\d+$",
+    r"^buy:",
+    r"^uord:(view|cancel|confirm):\d+$",
+    r"^adm:(acc|dec):\d+$",
+    r"^adm:rem:\d+$",
+    r"^adm:rmitem:\d+$",
+    r"^ord:(complete|fee):\d+$",
+    r"^aord:((NEW|SEEN|DONE|CANCELLED)(:[ab]:\d+)?|o:\d+)$",
+]
+ROUTING_PAYLOADS = [
+    "lang:en", "verify", "safe:shop", "safe:buy", "item:12:9", "shop:from:17", "buy:item:12",
+    "buy:qty:12:3", "buy:next", "buy:delivery:yes", "uord:view:42", "adm:acc:7", "adm:rmitem:3",
+    "ord:complete:42", "aord:DONE:b:120", "aord:o:42",
+]
+
+
+async def _noop(update: Any, context: Any) -> None:
+    pass
+
+
+def bench_routing(app: Any, rounds: int) -> Dict[str, Any]:
+    # routing cost only: handler lookup + payload parsing, no handler bodies
+    updates = [callback(app, 1, data) for data in ROUTING_PAYLOADS]
+    legacy = [CallbackQueryHandler(_noop, pattern=p) for p in LEGACY_CALLBACK_PATTERNS]
+    single = CallbackQueryHandler(_noop)
+
+    def legacy_route(update: Update) -> None:
+        for handler in legacy:
+            if handler.check_update(update):
+                # each handler then split query.data itself
+                parts = update.callback_query.data.split(":")
+                [int(p) for p in parts if p.isdigit()]
+                return
+
+    def table_route(update: Update) -> None:
+        if single.check_update(update):
+            bot.resolve_callback(update.callback_query.data)
+
+    out: Dict[str, Any] = {"payloads": len(updates), "rounds": rounds}
+    for name, fn in (("regex_chain", legacy_route), ("prefix_table", table_route)):
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            for u in updates:
+                fn(u)
+        out[f"{name}_ns_per_callback"] = round((time.perf_counter() - t0) / (rounds * len(updates)) * 1e9, 1)
+    return out
+
+
+# ================== CONCURRENT UPDATES ==================
+def cart_session(n: int, uid: int, item_ids: List[int]) -> List[Dict[str, Any]]:
+    # repeated qty taps and a clear overwrite each other: the final cart is only right in arrival order
+    steps = [callback_json(uid, "safe:buy", photo=True)]
+    for k, iid in enumerate(item_ids):
+        if k == 2:
+            steps.append(callback_json(uid, "buy:clear", photo=True))
+        steps.append(callback_json(uid, f"buy:item:{iid}", photo=True))
+        steps.append(callback_json(uid, f"buy:qty:{iid}:{(n + k) % 5 + 1}", photo=True))
+        steps.append(callback_json(uid, f"buy:qty:{iid}:{(n + k + 2) % 7 + 1}", photo=True))
+    steps.append(callback_json(uid, "buy:next", photo=True))
+    return steps
+
+
+def final_buy(app: Any, uid: int) -> Dict[str, Any]:
+    buy = dict(app.user_data.get(uid, {}).get("buy") or {})
+    buy.pop("nonce", None)  # random per cart
+    return buy
+
+
+async def run_concurrency_check(users: int, api_latency: float) -> Dict[str, Any]:
+    # the same cart sessions for two sets of users: one update at a time through
+    # Application.process_update, then all users at once through the update queue
+    # (PerUserUpdateProcessor), which has to end with the same carts
+    admin = await asyncpg.connect(BASE_DSN)
+    await admin.execute(f'DROP DATABASE IF EXISTS "{BENCH_DB}" WITH (FORCE)')
+    await admin.execute(f'CREATE DATABASE "{BENCH_DB}"')
+    app = bot.build_application(request=StubRequest(api_latency))
+    events: Dict[int, List[Any]] = {}
+
+    async def mark(update: Update, context: Any, edge: str) -> None:
+        events.setdefault(update.effective_user.id, []).append((edge, update.update_id))
+
+    app.add_handler(TypeHandler(Update, functools.partial(mark, edge="start")), group=-3)
+    app.add_handler(TypeHandler(Update, functools.partial(mark, edge="end")), group=bot.TRACE_GROUP_END + 1)
+    try:
+        await bot.migrate()
+        await app.initialize()
+        await bot.on_startup(app)
+        pool = app.bot_data["db_pool"]
+        await bot.set_setting(pool, "operator_online", "true")
+        serial_uids = range(600_000, 600_000 + users)
+        concurrent_uids = range(600_000 + users, 600_000 + 2 * users)
+        item_ids = (await seed(pool, 20, range(600_000, 600_000 + 2 * users)))[:5]
+
+        serial = [[Update.de_json(u, app.bot) for u in cart_session(n, uid, item_ids)] for n, uid in enumerate(serial_uids)]
+        t0 = time.perf_counter()
+        for updates in serial:
+            for update in updates:
+                await app.process_update(update)
+        serial_s = time.perf_counter() - t0
+
+        sessions = [[Update.de_json(u, app.bot) for u in cart_session(n, uid, item_ids)]
+                    for n, uid in enumerate(concurrent_uids)]
+        await app.start()
+        t0 = time.perf_counter()
+        # every user taps through the whole session at once: their updates queue back to back
+        for updates_of_user in sessions:
+            for update in updates_of_user:
+                await app.update_queue.put(update)
+        await app.update_queue.join()
+        concurrent_s = time.perf_counter() - t0
+        await app.stop()
+
+        updates = sum(len(s) for s in sessions)
+        out_of_order = 0
+        for updates_of_user in sessions:
+            uid = updates_of_user[0].effective_user.id
+            expected = [(edge, u.update_id) for u in updates_of_user for edge in ("start", "end")]
+            out_of_order += events.get(uid) != expected
+        wrong_carts = sum(
+            final_buy(app, a) != final_buy(app, b) for a, b in zip(serial_uids, concurrent_uids)
+        )
+        result = {
+            "users": users,
+            "updates": updates,
+            "api_latency_ms": api_latency * 1000,
+            "serial_updates_per_s": round(updates / serial_s, 1),
+            "concurrent_updates_per_s": round(updates / concurrent_s, 1),
+            "speedup": round(serial_s / concurrent_s, 2),
+            "users_out_of_order": out_of_order,
+            "wrong_carts": wrong_carts,
+        }
+        assert out_of_order == 0 and wrong_carts == 0, result
+        assert all(final_buy(app, uid).get("cart") for uid in serial_uids), "empty carts"
+        return result
+    finally:
+        if app.running:
+            await app.stop()
+        await bot.on_stop(app)
+        await app.shutdown()
+        await bot.on_shutdown(app)
+        await admin.execute(f'DROP DATABASE IF EXISTS "{BENCH_DB}" WITH (FORCE)')
+        await admin.close()
+
+
+# ================== SHARDED LOAD ==================
+def sharded_session(uid: int, item_ids: List[int]) -> List[Dict[str, Any]]:
+    # browse, fill a cart, order without delivery: one order per user
+    return [
+        command_json(uid, "/start"),
+        callback_json(uid, "safe:shop", photo=True),
+        *(callback_json(uid, f"item:{iid}", photo=True) for iid in item_ids[:2]),
+        callback_json(uid, "safe:buy", photo=True),
+        *itertools.chain.from_iterable(
+            (callback_json(uid, f"buy:item:{iid}", photo=True), callback_json(uid, f"buy:qty:{iid}:2", photo=True))
+            for iid in item_ids[:3]
+        ),
+        callback_json(uid, "buy:next", photo=True),
+        callback_json(uid, "buy:delivery:no"),
+    ]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def raw_http(port: int, request: bytes) -> int:
+    # -> response status; for requests an HTTP client library would not send
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(request)
+        await writer.drain()
+        return int((await asyncio.wait_for(reader.readline(), 10)).split()[1])
+    finally:
+        writer.close()
+
+
+async def check_front_http(port: int) -> Dict[str, int]:
+    def head(secret: str, extra: str) -> bytes:
+        return (
+            f"POST /{bot.WEBHOOK_PATH} HTTP/1.1\r\nHost: bench\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n{extra}\r\n"
+        ).encode()
+
+    result = {
+        # 403 comes back without the body ever being sent
+        "secret_bad_no_body": await raw_http(port, head("wrong", "Content-Length: 1000000000\r\n")),
+        "too_large": await raw_http(port, head(WEBHOOK_TEST_SECRET, f"Content-Length: {bot.WEBHOOK_MAX_BODY + 1}\r\n")),
+        "bad_json": await raw_http(port, head(WEBHOOK_TEST_SECRET, "Content-Length: 1\r\n") + b"x"),
+        "garbage": await raw_http(port, b"NOT HTTP\r\n\r\n"),
+        "chunked": await raw_http(
+            port, head(WEBHOOK_TEST_SECRET, "Transfer-Encoding: chunked\r\n") + b"1\r\n{\r\n1\r\n}\r\n0\r\n\r\n"
+        ),
+    }
+    assert result["secret_bad_no_body"] == 403, result
+    assert result["too_large"] in (400, 413), result
+    assert result["bad_json"] == 400 and result["garbage"] == 400, result
+    assert result["chunked"] == 200, result  # {} is an update without a user: admin shard, no handler
+    return result
+
+
+async def run_sharded(args: argparse.Namespace) -> Dict[str, Any]:
+    worker_cmd = [sys.executable, os.path.abspath(__file__), "--shard-worker"]
+    admin = await asyncpg.connect(BASE_DSN)
+    results: Dict[str, Any] = {}
+    base = None
+    try:
+        for workers in args.shards:
+            await admin.execute(f'DROP DATABASE IF EXISTS "{BENCH_DB}" WITH (FORCE)')
+            await admin.execute(f'CREATE DATABASE "{BENCH_DB}"')
+            await bot.migrate()
+            pool = await bot.DbPool.create(os.environ["DATABASE_URL"])
+            try:
+                uids = range(400_000, 400_000 + args.users)
+                item_ids = await seed(pool, 20, uids)
+                await bot.set_setting(pool, "operator_online", "true")
+                sessions = [[json.dumps(u).encode() for u in sharded_session(uid, item_ids)] for uid in uids]
+
+                front = bot.ShardFront(workers, worker_cmd)
+                await front.start()
+                port = free_port()
+                server = bot.shard_webhook_server(front, WEBHOOK_TEST_SECRET)
+                server.listen(port, "127.0.0.1")
+                client = tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=args.users)
+                try:
+                    http_checks = await check_front_http(port)
+                    await front.barrier()
+
+                    async def feed_user(raws: List[bytes]) -> None:
+                        # one user's updates in order, like Telegram
+                        for raw in raws:
+                            await client.fetch(
+                                f"http://127.0.0.1:{port}/{bot.WEBHOOK_PATH}", method="POST", body=raw,
+                                headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_TEST_SECRET},
+                            )
+
+                    t0 = time.perf_counter()
+                    await asyncio.gather(*(feed_user(raws) for raws in sessions))
+                    await front.barrier()
+                    elapsed = time.perf_counter() - t0
+                    restarts = sum(link.restarts for link in front.links)
+                finally:
+                    client.close()
+                    server.stop()
+                    await server.close_all_connections()
+                    await front.stop()
+                orders = await pool.fetchval("SELECT count(*) FROM orders")
+            finally:
+                await pool.close()
+
+            updates = sum(len(raws) for raws in sessions)
+            rate = updates / elapsed
+            base = base or (workers, rate)
+            speedup = rate / base[1]
+            per_user = [0] * workers
+            for uid in uids:
+                per_user[bot.shard_for(uid, workers)] += 1
+            results[str(workers)] = {
+                "updates": updates,
+                "seconds": round(elapsed, 3),
+                "updates_per_s": round(rate, 1),
+                "speedup": round(speedup, 2),
+                "efficiency": round(speedup / (workers / base[0]), 2),
+                "users_per_shard": per_user,
+                "orders": orders,
+                "orders_ok": orders == args.users,
+                "worker_restarts": restarts,
+                "front_http": http_checks,
+                "cpus": os.cpu_count(),
+            }
+    finally:
+        await admin.execute(f'DROP DATABASE IF EXISTS "{BENCH_DB}" WITH (FORCE)')
+        await admin.close()
+    return results
+
+
+# ================== WEBHOOK ==================
+WEBHOOK_TEST_SECRET = "bench-secret"
+
+
+def post(url: str, body: bytes, secret: str) -> int:
+    req = urllib.request.Request(url, data=body, method="POST", headers={
+        "Content-Type": "application/json",
+        "X-Telegram-Bot-Api-Secret-Token": secret,
+    })
+    try:
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+async def run_webhook_check() -> Dict[str, Any]:
+    # the webhook server run_webhook starts (Updater.start_webhook with main()'s options),
+    # in this process so the stub's calls can be counted
+    admin = await asyncpg.connect(BASE_DSN)
+    await admin.execute(f'DROP DATABASE IF EXISTS "{BENCH_DB}" WITH (FORCE)')
+    await admin.execute(f'CREATE DATABASE "{BENCH_DB}"')
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/{bot.WEBHOOK_PATH}"
+    stub = StubRequest()
+    app = bot.build_application(request=stub)
+    try:
+        await bot.migrate()
+        await app.initialize()
+        await bot.on_startup(app)
+        await app.updater.start_webhook(**bot.webhook_options(
+            listen="127.0.0.1", port=port, webhook_url=url, secret_token=WEBHOOK_TEST_SECRET,
+        ))
+        await app.start()
+
+        def handled() -> int:
+            # updates that reached a handler (trace_finish counts them per handler)
+            return sum(st.count for st in bot.HANDLER_STATS.values())
+
+        async def deliver(update: Dict[str, Any], secret: str) -> Dict[str, int]:
+            h0, c0 = handled(), len(stub.calls)
+            status = await asyncio.to_thread(post, url, json.dumps(update).encode(), secret)
+            await app.update_queue.join()
+            return {"status": status, "handled": handled() - h0, "api_calls": len(stub.calls) - c0}
+
+        edited = command_json(500_003, "/start")  # CommandHandler takes edited messages too
+        edited["edited_message"] = dict(edited.pop("message"), edit_date=int(time.time()))
+        result = {
+            "secret_ok": await deliver(command_json(500_001, "/start"), WEBHOOK_TEST_SECRET),
+            "secret_bad": await deliver(command_json(500_002, "/start"), "wrong"),
+            "not_allowed_update": await deliver(edited, WEBHOOK_TEST_SECRET),
+        }
+        ok, bad, other = result["secret_ok"], result["secret_bad"], result["not_allowed_update"]
+        assert ok["status"] == 200 and ok["handled"] == 1 and ok["api_calls"] > 0, result
+        assert bad["status"] == 403 and bad["handled"] == 0, result
+        assert other["status"] == 200 and other["handled"] == 0 and other["api_calls"] == 0, result
+        assert "edited_message" not in bot.ALLOWED_UPDATES
+        return result
+    finally:
+        if app.updater.running:
+            await app.updater.stop()
+        if app.running:
+            await app.stop()
+        await bot.on_stop(app)
+        await app.shutdown()
+        await bot.on_shutdown(app)
+        await admin.execute(f'DROP DATABASE IF EXISTS "{BENCH_DB}" WITH (FORCE)')
+        await admin.close()
+
+
+# ================== MAIN ==================
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    if not args.scenarios:
+        return {}
+    admin = await asyncpg.connect(BASE_DSN)
+    await admin.execute(f'DROP DATABASE IF EXISTS "{BENCH_DB}"')
+    await admin.execute(f'CREATE DATABASE "{BENCH_DB}"')
+    results: Dict[str, Any] = {}
+    try:
+        for name in args.scenarios:
+            stub = StubRequest()
+            app = bot.build_application(request=stub)
+            await bot.migrate()
+            await app.initialize()
+            await bot.on_startup(app)
+            pool = app.bot_data["db_pool"]
+            await bot.set_setting(pool, "operator_online", "true")
+            try:
+                if args.trace_alloc:
+                    tracemalloc.start()
+                rec = Recorder(app, stub, args.trace_alloc)
+                await SCENARIOS[name](rec, pool, args.n)
+                results[name] = rec.report()
+            finally:
+                if args.trace_alloc:
+                    tracemalloc.stop()
+                await bot.on_stop(app)
+                await app.shutdown()
+                await bot.on_shutdown(app)
+    finally:
+        await admin.execute(f'DROP DATABASE IF EXISTS "{BENCH_DB}" WITH (FORCE)')
+        await admin.close()
+    return results
+
+
+async def run_all(args: argparse.Namespace) -> Dict[str, Any]:
+    # one event loop: bot.py's module-level workers (OUTBOX, SETTINGS...) bind to it
+    results = await run(args)
+    if args.concurrency:
+        results["concurrency"] = await run_concurrency_check(args.concurrency, args.api_latency / 1000)
+    if args.webhook:
+        results["webhook"] = await run_webhook_check()
+    if args.shards:
+        results["sharded"] = await run_sharded(args)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="*", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("-n", type=int, default=100, help="users / orders per scenario")
+    parser.add_argument("--trace-alloc", action="store_true", help="record allocations per update (slower)")
+    parser.add_argument("--routing", type=int, default=0, metavar="ROUNDS",
+                        help="also micro-benchmark callback routing (no database needed)")
+    parser.add_argument("--shards", type=int, nargs="*", default=[], metavar="N",
+                        help="also load-test BOT_MODE=sharded with N worker processes, for each N")
+    parser.add_argument("--users", type=int, default=500, help="concurrent users for --shards")
+    parser.add_argument("--concurrency", type=int, default=0, metavar="USERS",
+                        help="also compare serial and concurrent (PerUserUpdateProcessor) cart sessions")
+    parser.add_argument("--api-latency", type=float, default=0.0, metavar="MS",
+                        help="stub Bot API delay per call for --concurrency (default 0)")
+    parser.add_argument("--webhook", action="store_true",
+                        help="also check the webhook endpoint: secret token, allowed update types")
+    parser.add_argument("--shard-worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--out", default="bench.json")
+    args = parser.parse_args()
+
+    if args.shard_worker:
+        asyncio.run(bot.run_shard_worker(bot.build_application(request=StubRequest())))
+        return
+    results = asyncio.run(run_all(args))
+    if args.routing:
+        results["callback_routing"] = bench_routing(bot.build_application(request=StubRequest()), args.routing)
+    with open(args.out, "w") as f:
+        json.dump({"n": args.n, "scenarios": results}, f, indent=2, sort_keys=True)
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    print()
+
+
+if __name__ == "__main__":
+    main()
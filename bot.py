@@ -1,24 +1,53 @@
 import os
+import sys
+import time
+import signal
+import asyncio
+import bisect
+import functools
+import contextlib
+import hashlib
+import heapq
+import hmac
+import socket
+import struct
 import datetime
 import json
+import enum
+import contextvars
+import logging
 import asyncpg
-from typing import Optional, Dict, Any, List
+import tornado.httpserver
+import tornado.web
+from collections import OrderedDict, deque
+from typing import Optional, Dict, Any, List, NamedTuple, Tuple, Sequence, Set
 
 from telegram import (
+    Bot,
     Update,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     InputFile,
 )
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.request import BaseRequest
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
+    PersistenceInput,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     ContextTypes,
+    ApplicationHandlerStop,
     filters,
 )
 
+log = logging.getLogger("bot")
+
 # ================== ENV ==================
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -33,6 +62,80 @@ if not ADMIN_ID or not ADMIN_ID.isdigit():
 
 ADMIN_ID_INT = int(ADMIN_ID)
 
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))  # 0 for pgbouncer (no prepared statement reuse)
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "10"))  # seconds
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", "300"))  # seconds
+
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))  # seconds
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "5"))  # seconds between users write-behind flushes
+USER_FLUSH_ROWS = int(os.getenv("USER_FLUSH_ROWS", "500"))  # ...or earlier once this many users are buffered
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", "60"))  # seconds, picks up edits from other processes
+CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", "8"))  # item buttons per shop/buy keyboard page
+ORDERS_PAGE_SIZE = int(os.getenv("ORDERS_PAGE_SIZE", "10"))  # orders per /orders page
+
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(7 * 24 * 3600)))  # seconds idle before a cart/flow is dropped
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "10"))  # seconds between batched writes
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "3600"))
+
+# closed orders / decided claims older than this move to the archive tables
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "1000"))  # rows per move transaction
+PARTITION_MAINTENANCE_INTERVAL = float(os.getenv("PARTITION_MAINTENANCE_INTERVAL", "3600"))
+
+# order notifications (admin card, customer notices) go through the outbox table
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "50"))  # rows claimed per round
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))  # seconds, for retries and other processes' rows
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "60"))  # seconds a claimed row is hidden from other workers, on top of the send time
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", "2"))  # seconds, doubled per attempt
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", "300"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+OUTBOX_KEEP_DAYS = float(os.getenv("OUTBOX_KEEP_DAYS", "7"))  # sent/failed rows kept this long
+
+# outbound Bot API limits (Telegram: ~30 msg/s overall, ~1 msg/s per chat with short bursts)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))  # requests per second
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))  # requests per second per chat
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+# polling (default), webhook, or sharded (webhook front + SHARD_WORKERS worker processes,
+# see SHARDING; the front starts its workers with BOT_MODE=shard)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public base url, e.g. https://bot.up.railway.app
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # sent back by Telegram as X-Telegram-Bot-Api-Secret-Token
+
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", str(os.cpu_count() or 1)))
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))  # set by the front for each worker
+SHARD_FD = int(os.getenv("SHARD_FD", "-1"))  # set by the front: the worker's end of its socketpair
+
+# handlers running at once / updates admitted (incl. those waiting for their user's previous update)
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16"))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "256"))
+
+# Prometheus text endpoint (GET /metrics), 0 = off
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "0.0.0.0")
+
+if BOT_MODE not in ("polling", "webhook", "sharded", "shard"):
+    raise RuntimeError("BOT_MODE must be polling, webhook, sharded or shard")
+if BOT_MODE in ("webhook", "sharded") and not WEBHOOK_URL:
+    raise RuntimeError("WEBHOOK_URL missing (required when BOT_MODE=webhook or sharded)")
+if BOT_MODE in ("webhook", "sharded") and not WEBHOOK_SECRET:
+    # without it anyone who learns the url can post updates "from" ADMIN_ID
+    raise RuntimeError("WEBHOOK_SECRET missing (required when BOT_MODE=webhook or sharded)")
+if SHARD_WORKERS < 1 or not 0 <= SHARD_INDEX < SHARD_WORKERS:
+    raise RuntimeError("SHARD_WORKERS must be >= 1 and SHARD_INDEX in [0, SHARD_WORKERS)")
+if BOT_MODE == "shard" and SHARD_FD < 0:
+    raise RuntimeError("SHARD_FD missing (BOT_MODE=shard workers are started by BOT_MODE=sharded)")
+
+LOCALES_DIR = os.getenv("LOCALES_DIR", "locales")  # <lang>.json text catalogs
+DEFAULT_LANG = os.getenv("DEFAULT_LANG", "et")  # new users, and fallback for texts missing elsewhere
+
 CLAIM_IMAGE_PATH = "claim.png"
 HOME_IMAGE_PATH = "home.png"
 SHOP_IMAGE_PATH = "shop.png"
@@ -109,6 +212,46 @@ CREATE TABLE IF NOT EXISTS orders (
 );
 """
 
+# persisted context.user_data (cart + admin flows), see PgPersistence
+CREATE_SESSIONS_SQL = """
+CREATE TABLE IF NOT EXISTS sessions (
+  user_id BIGINT PRIMARY KEY,
+  cart BYTEA NULL,                    -- encode_cart()
+  data JSONB NOT NULL DEFAULT '{}',   -- rest of user_data
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
+
+# one row per placed checkout: the unique key turns a repeated checkout (double tap,
+# redelivered update, session restored after a crash) into a lookup of the first order.
+# orders is partitioned by created_at, so it cannot carry this unique constraint itself.
+CREATE_CHECKOUT_KEYS_SQL = """
+CREATE TABLE IF NOT EXISTS checkout_keys (
+  key BYTEA PRIMARY KEY,              -- checkout_key()
+  user_id BIGINT NOT NULL,
+  order_id INT NOT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
+
+# messages owed for an order event, inserted in the same statement as the event and
+# delivered by OutboxWorker; kinds: admin_order (send/refresh the admin card),
+# order_done (customer notice), order_cancelled (admin notice)
+CREATE_OUTBOX_SQL = """
+CREATE TABLE IF NOT EXISTS outbox (
+  id BIGSERIAL PRIMARY KEY,
+  kind TEXT NOT NULL,
+  order_id INT NOT NULL,
+  status TEXT NOT NULL DEFAULT 'PENDING',   -- PENDING/SENT/FAILED
+  attempts INT NOT NULL DEFAULT 0,
+  next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  message_id BIGINT NULL,                   -- Telegram message id once sent
+  last_error TEXT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  sent_at TIMESTAMPTZ NULL
+);
+"""
+
 ALTER_USERS_SQL = [
     "ALTER TABLE users ADD COLUMN IF NOT EXISTS language TEXT DEFAULT 'et';",
     "ALTER TABLE users ADD COLUMN IF NOT EXISTS status TEXT DEFAULT 'NEW';",
@@ -132,229 +275,435 @@ ALTER_ORDERS_SQL = [
     "ALTER TABLE orders ADD COLUMN IF NOT EXISTS admin_message_id BIGINT NULL;",
 ]
 
-# ================== TEXTS ==================
-TEXTS: Dict[str, Dict[str, str]] = {
-    "et": {
-        "welcome": "Tere! Vajuta Verify",
-        "verify": "✅ Verify",
-        "waiting_ref": "Kirjuta oma sõbra @username, kelle käest sa selle boti said (näiteks: @mart).",
-        "invalid_ref": "❌ Palun kirjuta korrektne @username (peab algama @-ga). Proovi uuesti.",
-        "wait_admin": "⏳ Aitäh! Oota palun admini vastust.",
-        "already_pending": "⏳ Su verifitseerimine on juba ootel. Oota admini vastust.",
-        "accepted": "✅ Admin kinnitas su verifitseerimise. Sa oled nüüd SAFE. Tee /start",
-        "declined": "❌ Admin lükkas su verifitseerimise tagasi.",
-        "removed_safe": "❌ Admin eemaldas sind SAFE listist. Tee /start ja verifitseeri uuesti.",
-        "added_safe": "✅ Admin lisas sind SAFE listi. Tee /start",
-        "do_start": "Tee /start",
-
-        "safe_welcome": (
-            "*The UnderGround Market*\n\n"
-            "Siin saad vaadata pakkumisi ja teha oste.\n"
-            "Vali alt menüüst üks valik."
-        ),
+# ================== PARTITIONS ==================
+# orders and claims are range partitioned by month on created_at (<table>_YYYY_MM).
+# Closed rows older than ARCHIVE_AFTER_DAYS move to <table>_archive, partitioned the
+# same way, so the hot tables only hold open rows and recent history.
+# Lookups by id alone (get_order, complete_order, callbacks, outbox) cannot prune:
+# they probe the (id, created_at) index of each hot partition. drop_empty_partitions
+# keeps that to about ARCHIVE_AFTER_DAYS / 30 + 2 partitions, so ids stay the only key
+# callbacks and outbox rows carry.
+PARTITIONED_TABLES = ("orders", "claims")
+ARCHIVE_STATUSES: Dict[str, Tuple[str, ...]] = {
+    "orders": ("DONE", "CANCELLED"),
+    "claims": ("ACCEPTED", "DECLINED"),
+}
+PARTITIONS_LOCK_ID = 72_811_002
 
-        "shop_title": "*Shop*\nVali toode.",
-        "shop_empty": "Shop on hetkel tühi.",
-        "help_text": "Help: kirjuta adminile.",
-        "account_text": "Account",
-
-        "buy_offline": "❌ Praegu on operator OFFLINE.",
-        "buy_intro": "*Buy*\nVali toode ja kogus. Kui valmis, vajuta Next.",
-        "buy_cart": "Cart",
-        "buy_next": "✅ Next",
-        "buy_clear": "❌ Clear",
-        "buy_choose_qty": "Vali kogus:",
-        "buy_delivery_q": "Kas on vaja delivery?",
-        "buy_yes": "✅ Jah",
-        "buy_no": "❌ Ei",
-        "buy_send_address": "Kirjuta oma aadress.\n\nDelivery fee ja kell kirjutab admin pärast DM.",
-        "buy_order_sent": "✅ Order saadetud. Admin kirjutab sulle.",
-        "buy_need_items": "❌ Lisa vähemalt 1 item carti.",
-
-        "orders_title": "*Orders*\nVali order.",
-        "orders_empty": "Sul pole aktiivseid ordereid.",
-        "order_detail": "*Order*",
-        "order_cancel": "❌ Cancel",
-        "order_cancel_confirm": "✅ Confirm cancel",
-        "order_cancelled_user": "✅ Order cancelled.",
-        "order_cancelled_admin": "❌ USER CANCELLED",
-
-        "admin_add_name": "/additem\nSaada itemi nimi:",
-        "admin_add_text": "Saada lühike tekst (kirjeldus):",
-        "admin_add_price": "Saada hind EUR (näiteks: 25 või 25.50):",
-        "admin_add_photo": "Saada nüüd pilt (foto) selle itemi jaoks:",
-        "admin_add_done": "✅ Item lisatud Shopi!",
-        "admin_remove_pick": "Vali item, mida eemaldada:",
-        "admin_remove_empty": "Pole midagi eemaldada.",
-        "admin_bad": "❌ Midagi läks valesti.",
-
-        "back": "⬅️ Tagasi",
-        "home": "⬅️ Home",
-
-        "order_pickup_msg": "✅ Sinu order on valmis.\nAsukoht ja kellaaeg:",
-        "order_completed_user": "✅ Order completed.",
-        "admin_fee_prompt": "Kirjuta delivery fee EUR (näiteks: 5 või 7.50):",
-
-        "search_usage": "Usage: /search @username",
-        "search_not_found": "❌ User not found in database.",
-    },
-    "ru": {
-        "welcome": "Привет! Нажми Verify",
-        "verify": "✅ Verify",
-        "waiting_ref": "Напиши @username друга, от которого ты получил бота (например: @mart).",
-        "invalid_ref": "❌ Напиши корректный @username (должен начинаться с @). Попробуй ещё раз.",
-        "wait_admin": "⏳ Спасибо! Дождись решения админа.",
-        "already_pending": "⏳ Проверка уже в ожидании.",
-        "accepted": "✅ Админ подтвердил проверку. Ты теперь SAFE. Напиши /start",
-        "declined": "❌ Админ отклонил проверку.",
-        "removed_safe": "❌ Админ удалил тебя из SAFE. Сделай /start и пройди проверку снова.",
-        "added_safe": "✅ Админ добавил тебя в SAFE. Напиши /start",
-        "do_start": "Напиши /start",
-
-        "safe_welcome": (
-            "*The UnderGround Market*\n\n"
-            "Здесь ты можешь смотреть товары и делать заказы.\n"
-            "Выбери пункт меню ниже."
-        ),
+CREATE_ORDERS_PARTITIONED_SQL = """
+CREATE TABLE {name} (
+  id INT NOT NULL{id_default},
+  user_id BIGINT NOT NULL{user_fk},
+  cart_json JSONB NOT NULL,
+  subtotal_cents INT NOT NULL,
+  delivery BOOLEAN NOT NULL,
+  address TEXT NULL,
+  delivery_fee_cents INT NOT NULL DEFAULT 0,
+  total_cents INT NOT NULL,
+  status TEXT NOT NULL DEFAULT 'NEW',   -- NEW/SEEN/DONE/CANCELLED
+  admin_message_id BIGINT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+"""
 
-        "shop_title": "*Shop*\nВыбери товар.",
-        "shop_empty": "Shop сейчас пуст.",
-        "help_text": "Help: напиши админу.",
-        "account_text": "Account",
-
-        "buy_offline": "❌ Сейчас оператор OFFLINE.",
-        "buy_intro": "*Buy*\nВыбери товар и количество. Когда готов, нажми Next.",
-        "buy_cart": "Cart",
-        "buy_next": "✅ Next",
-        "buy_clear": "❌ Clear",
-        "buy_choose_qty": "Выбери количество:",
-        "buy_delivery_q": "Нужна доставка?",
-        "buy_yes": "✅ Да",
-        "buy_no": "❌ Нет",
-        "buy_send_address": "Напиши адрес.\n\nDelivery fee и время админ напишет позже в DM.",
-        "buy_order_sent": "✅ Заказ отправлен. Админ напишет тебе.",
-        "buy_need_items": "❌ Добавь хотя бы 1 товар в cart.",
-
-        "orders_title": "*Orders*\nВыбери заказ.",
-        "orders_empty": "У тебя нет активных заказов.",
-        "order_detail": "*Order*",
-        "order_cancel": "❌ Cancel",
-        "order_cancel_confirm": "✅ Confirm cancel",
-        "order_cancelled_user": "✅ Заказ отменён.",
-        "order_cancelled_admin": "❌ USER CANCELLED",
-
-        "admin_add_name": "/additem\nОтправь название товара:",
-        "admin_add_text": "Отправь короткий текст (описание):",
-        "admin_add_price": "Отправь цену EUR (пример: 25 или 25.50):",
-        "admin_add_photo": "Теперь отправь фото товара:",
-        "admin_add_done": "✅ Товар добавлен в Shop!",
-        "admin_remove_pick": "Выбери товар для удаления:",
-        "admin_remove_empty": "Нечего удалять.",
-        "admin_bad": "❌ Что-то пошло не так.",
-
-        "back": "⬅️ Назад",
-        "home": "⬅️ Home",
-
-        "order_pickup_msg": "✅ Твой заказ готов.\nМесто и время:",
-        "order_completed_user": "✅ Заказ выполнен.",
-        "admin_fee_prompt": "Отправь delivery fee EUR (пример: 5 или 7.50):",
-
-        "search_usage": "Usage: /search @username",
-        "search_not_found": "❌ User not found in database.",
-    },
-    "en": {
-        "welcome": "Hi! Press Verify",
-        "verify": "✅ Verify",
-        "waiting_ref": "Send your friend's @username who gave you this bot (example: @mart).",
-        "invalid_ref": "❌ Please send a valid @username (must start with @). Try again.",
-        "wait_admin": "⏳ Thanks. Wait for admin approval.",
-        "already_pending": "⏳ Verification is pending.",
-        "accepted": "✅ Admin approved you. You are SAFE now. Send /start",
-        "declined": "❌ Admin declined your verification.",
-        "removed_safe": "❌ Admin removed you from SAFE. Do /start and verify again.",
-        "added_safe": "✅ Admin added you to SAFE. Send /start",
-        "do_start": "Send /start",
-
-        "safe_welcome": (
-            "*The UnderGround Market*\n\n"
-            "Browse items and place orders.\n"
-            "Choose an option below."
-        ),
+CREATE_CLAIMS_PARTITIONED_SQL = """
+CREATE TABLE {name} (
+  id INT NOT NULL{id_default},
+  user_id BIGINT NOT NULL{user_fk},
+  ref_username TEXT NOT NULL,
+  status TEXT DEFAULT 'PENDING',      -- PENDING/ACCEPTED/DECLINED
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  decided_at TIMESTAMPTZ NULL,
+  PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+"""
 
-        "shop_title": "*Shop*\nChoose an item.",
-        "shop_empty": "Shop is empty.",
-        "help_text": "Help: contact admin.",
-        "account_text": "Account",
-
-        "buy_offline": "❌ Operator is OFFLINE right now.",
-        "buy_intro": "*Buy*\nPick items and quantities. When ready, press Next.",
-        "buy_cart": "Cart",
-        "buy_next": "✅ Next",
-        "buy_clear": "❌ Clear",
-        "buy_choose_qty": "Choose quantity:",
-        "buy_delivery_q": "Need delivery?",
-        "buy_yes": "✅ Yes",
-        "buy_no": "❌ No",
-        "buy_send_address": "Send your address.\n\nDelivery fee and time will be sent by admin in DM.",
-        "buy_order_sent": "✅ Order sent. Admin will DM you.",
-        "buy_need_items": "❌ Add at least 1 item to cart.",
-
-        "orders_title": "*Orders*\nPick an order.",
-        "orders_empty": "You have no active orders.",
-        "order_detail": "*Order*",
-        "order_cancel": "❌ Cancel",
-        "order_cancel_confirm": "✅ Confirm cancel",
-        "order_cancelled_user": "✅ Order cancelled.",
-        "order_cancelled_admin": "❌ USER CANCELLED",
-
-        "admin_add_name": "/additem\nSend item name:",
-        "admin_add_text": "Send short text (description):",
-        "admin_add_price": "Send price EUR (example: 25 or 25.50):",
-        "admin_add_photo": "Now send item photo:",
-        "admin_add_done": "✅ Item added to Shop!",
-        "admin_remove_pick": "Pick an item to remove:",
-        "admin_remove_empty": "Nothing to remove.",
-        "admin_bad": "❌ Something went wrong.",
-
-        "back": "⬅️ Back",
-        "home": "⬅️ Home",
-
-        "order_pickup_msg": "✅ Your order is ready.\nLocation and time:",
-        "order_completed_user": "✅ Order completed.",
-        "admin_fee_prompt": "Send delivery fee EUR (example: 5 or 7.50):",
-
-        "search_usage": "Usage: /search @username",
-        "search_not_found": "❌ User not found in database.",
-    },
+PARTITIONED_COLUMNS: Dict[str, str] = {
+    "orders": "id, user_id, cart_json, subtotal_cents, delivery, address, delivery_fee_cents, "
+              "total_cents, status, admin_message_id, created_at",
+    "claims": "id, user_id, ref_username, status, created_at, decided_at",
 }
 
 
-def t(lang: str, key: str) -> str:
-    if lang not in TEXTS:
-        lang = "et"
-    return TEXTS[lang].get(key, TEXTS["et"].get(key, key))
+def month_start(ts: datetime.datetime) -> datetime.datetime:
+    ts = ts.astimezone(datetime.timezone.utc)
+    return datetime.datetime(ts.year, ts.month, 1, tzinfo=datetime.timezone.utc)
+
+
+def next_month(m: datetime.datetime) -> datetime.datetime:
+    return m.replace(year=m.year + 1, month=1) if m.month == 12 else m.replace(month=m.month + 1)
+
+
+async def ensure_month_partitions(
+    conn: asyncpg.Connection, parent: str, start: datetime.datetime, end: datetime.datetime
+) -> None:
+    # one partition per month from start's month through end's month; parent is a fixed table name
+    m = month_start(start)
+    while m <= end:
+        nxt = next_month(m)
+        await conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {parent}_{m:%Y_%m} PARTITION OF {parent} "
+            f"FOR VALUES FROM ('{m.isoformat()}') TO ('{nxt.isoformat()}')"
+        )
+        m = nxt
+
+
+async def partition_orders_and_claims(conn: asyncpg.Connection) -> None:
+    # swap the plain tables for partitioned ones, keeping ids (sequence); the rows stay in
+    # <table>_unpartitioned for move_unpartitioned_rows, outside the migration transaction
+    now = datetime.datetime.now(datetime.timezone.utc)
+    create_sql = {"orders": CREATE_ORDERS_PARTITIONED_SQL, "claims": CREATE_CLAIMS_PARTITIONED_SQL}
+    for table in PARTITIONED_TABLES:
+        await conn.execute(f"ALTER TABLE {table} RENAME TO {table}_unpartitioned")
+        await conn.execute(f"ALTER INDEX {table}_pkey RENAME TO {table}_unpartitioned_pkey")
+        await conn.execute(f"ALTER SEQUENCE {table}_id_seq OWNED BY NONE")
+        await conn.execute(create_sql[table].format(
+            name=table,
+            id_default=f" DEFAULT nextval('{table}_id_seq')",
+            user_fk=" REFERENCES users(user_id)",
+        ))
+        await conn.execute(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id")
+        await ensure_month_partitions(conn, table, now, next_month(month_start(now)))
+
+        # archive: same shape, no id default / FK; TOAST-compress with lz4 where the server has it
+        await conn.execute(create_sql[table].format(name=f"{table}_archive", id_default="", user_fk=""))
+        for col in ("cart_json", "address") if table == "orders" else ("ref_username",):
+            try:
+                async with conn.transaction():
+                    await conn.execute(f"ALTER TABLE {table}_archive ALTER COLUMN {col} SET COMPRESSION lz4")
+            except asyncpg.PostgresError:
+                pass
+
+    # indexes from migrations 3 and 5, now partitioned (created on every partition)
+    for q in (
+        "CREATE INDEX IF NOT EXISTS orders_user_active_idx ON orders (user_id, id DESC) "
+        "WHERE status NOT IN ('DONE','CANCELLED');",
+        "CREATE INDEX IF NOT EXISTS orders_user_done_idx ON orders (user_id) WHERE status = 'DONE';",
+        "CREATE INDEX IF NOT EXISTS orders_status_id_idx ON orders (status, id);",
+        "CREATE INDEX IF NOT EXISTS claims_user_status_idx ON claims (user_id, status);",
+        "CREATE INDEX IF NOT EXISTS orders_archive_user_idx ON orders_archive (user_id);",
+    ):
+        await conn.execute(q)
+
+
+async def move_unpartitioned_rows(conn: asyncpg.Connection) -> None:
+    # Rows migration 6 left in <table>_unpartitioned move over in ARCHIVE_BATCH-row
+    # transactions, so no lock is held across the whole copy. Runs from migrate() in
+    # every booting process (one batch at a time across them); none of them serves
+    # before the old tables are gone.
+    for table in PARTITIONED_TABLES:
+        old = f"{table}_unpartitioned"
+        cols = PARTITIONED_COLUMNS[table]
+        while True:
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock($1)", PARTITIONS_LOCK_ID)
+                # pg_class, not to_regclass(): the advisory lock does not refresh the catalog
+                # cache, so a DROP committed by the process we waited for would go unseen
+                if not await conn.fetchval(
+                    "SELECT EXISTS (SELECT 1 FROM pg_class WHERE oid::regclass::text = $1)", old
+                ):
+                    break
+                span = await conn.fetchrow(
+                    f"SELECT min(ts), max(ts) FROM ("
+                    f"SELECT COALESCE(created_at, now()) AS ts FROM {old} ORDER BY id LIMIT $1) batch",
+                    ARCHIVE_BATCH,
+                )
+                if span[0] is None:
+                    await conn.execute(f"DROP TABLE {old}")
+                    break
+                await ensure_month_partitions(conn, table, span[0], span[1])
+                await conn.execute(
+                    f"""
+                    WITH batch AS (
+                      DELETE FROM {old} WHERE id IN (SELECT id FROM {old} ORDER BY id LIMIT $1)
+                      RETURNING {cols}
+                    )
+                    INSERT INTO {table} ({cols})
+                    SELECT {cols.replace('created_at', 'COALESCE(created_at, now())')} FROM batch
+                    """,
+                    ARCHIVE_BATCH,
+                )
+
+
+# ================== MIGRATIONS ==================
+CREATE_SCHEMA_MIGRATIONS_SQL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+  version INT PRIMARY KEY,
+  name TEXT NOT NULL,
+  applied_at TIMESTAMPTZ DEFAULT now()
+);
+"""
+
+MIGRATIONS_LOCK_ID = 72_811_001  # pg advisory lock, so parallel boots don't race
+
+
+async def backfill_order_counters(conn: asyncpg.Connection) -> None:
+    # orders still waiting in orders_unpartitioned (see move_unpartitioned_rows) count too
+    sources = ["orders", "orders_archive"]
+    if await conn.fetchval("SELECT to_regclass('orders_unpartitioned') IS NOT NULL"):
+        sources.append("orders_unpartitioned")
+    all_orders = " UNION ALL ".join(f"SELECT user_id, status, created_at FROM {s}" for s in sources)
+    await conn.execute(
+        f"""
+        UPDATE users u SET
+          orders_done = c.done,
+          orders_cancelled = c.cancelled,
+          last_order_at = c.last_at
+        FROM (
+          SELECT user_id,
+                 count(*) FILTER (WHERE status = 'DONE') AS done,
+                 count(*) FILTER (WHERE status = 'CANCELLED') AS cancelled,
+                 max(created_at) AS last_at
+          FROM ({all_orders}) all_orders
+          GROUP BY user_id
+        ) c
+        WHERE u.user_id = c.user_id;
+        """
+    )
+
+# (version, name, statements) — append only, never edit an applied migration.
+# 1 is idempotent so databases created before schema_migrations existed adopt it cleanly.
+# A statement is SQL or an async fn(conn) for steps that depend on existing data.
+MIGRATIONS: List[Tuple[int, str, List[Any]]] = [
+    (1, "base tables", [
+        CREATE_USERS_SQL, *ALTER_USERS_SQL,
+        CREATE_CLAIMS_SQL,
+        CREATE_SETTINGS_SQL,
+        CREATE_ITEMS_SQL, *ALTER_ITEMS_SQL,
+        CREATE_ORDERS_SQL, *ALTER_ORDERS_SQL,
+    ]),
+    (2, "operator_online default", [
+        "INSERT INTO settings (key, value) VALUES ('operator_online', 'true') ON CONFLICT (key) DO NOTHING;",
+    ]),
+    (3, "lookup indexes", [
+        # get_user_by_username
+        "CREATE INDEX IF NOT EXISTS users_username_lower_idx ON users (lower(username));",
+        # list_user_active_orders
+        "CREATE INDEX IF NOT EXISTS orders_user_active_idx ON orders (user_id, id DESC) "
+        "WHERE status NOT IN ('DONE','CANCELLED');",
+        # count_orders_done
+        "CREATE INDEX IF NOT EXISTS orders_user_done_idx ON orders (user_id) WHERE status = 'DONE';",
+        "CREATE INDEX IF NOT EXISTS claims_user_status_idx ON claims (user_id, status);",
+    ]),
+    (4, "sessions", [
+        CREATE_SESSIONS_SQL,
+        "CREATE INDEX IF NOT EXISTS sessions_updated_idx ON sessions (updated_at);",
+    ]),
+    (5, "admin order queue index", [
+        # list_orders_page (/orders)
+        "CREATE INDEX IF NOT EXISTS orders_status_id_idx ON orders (status, id);",
+    ]),
+    (6, "monthly partitions + archive for orders and claims", [
+        partition_orders_and_claims,
+    ]),
+    (7, "per-user order counters", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS orders_done INT NOT NULL DEFAULT 0;",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS orders_cancelled INT NOT NULL DEFAULT 0;",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_order_at TIMESTAMPTZ NULL;",
+        backfill_order_counters,
+        # only count_orders_done used these
+        "DROP INDEX IF EXISTS orders_user_done_idx;",
+        "DROP INDEX IF EXISTS orders_archive_user_idx;",
+    ]),
+    (8, "checkout idempotency keys", [
+        CREATE_CHECKOUT_KEYS_SQL,
+        "CREATE INDEX IF NOT EXISTS checkout_keys_created_idx ON checkout_keys (created_at);",
+    ]),
+    (9, "notification outbox", [
+        CREATE_OUTBOX_SQL,
+        "CREATE INDEX IF NOT EXISTS outbox_pending_idx ON outbox (next_attempt_at) WHERE status = 'PENDING';",
+        "CREATE INDEX IF NOT EXISTS outbox_created_idx ON outbox (created_at) WHERE status <> 'PENDING';",
+    ]),
+]
+
+
+async def run_migrations(conn: asyncpg.Connection) -> None:
+    await conn.execute(CREATE_SCHEMA_MIGRATIONS_SQL)
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATIONS_LOCK_ID)
+        applied = {int(r["version"]) for r in await conn.fetch("SELECT version FROM schema_migrations")}
+        for version, name, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            for q in statements:
+                if callable(q):
+                    await q(conn)
+                else:
+                    await conn.execute(q)
+            await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name)
+
+
+async def migrate(dsn: str = DATABASE_URL) -> None:
+    # the one place migrations run: before Application.initialize, whose
+    # PgPersistence.get_user_data already reads the sessions table
+    conn = await asyncpg.connect(dsn)
+    try:
+        await run_migrations(conn)
+        await move_unpartitioned_rows(conn)
+    finally:
+        await conn.close()
+
+
+# ================== TEXTS ==================
+# Texts live in LOCALES_DIR/<lang>.json ({"<message id>": "text"}). They are
+# compiled into one tuple per language indexed by Msg, with ids missing from a
+# language already filled from DEFAULT_LANG, so t() is a dict get + tuple index.
+# /reloadtexts recompiles them without a restart.
+class Msg(enum.IntEnum):
+    @staticmethod
+    def _generate_next_value_(name: str, start: int, count: int, last_values: List[int]) -> int:
+        return count  # tuple index
+
+    LANG_BUTTON = enum.auto()
+    WELCOME = enum.auto()
+    VERIFY = enum.auto()
+    WAITING_REF = enum.auto()
+    INVALID_REF = enum.auto()
+    WAIT_ADMIN = enum.auto()
+    ALREADY_PENDING = enum.auto()
+    ACCEPTED = enum.auto()
+    DECLINED = enum.auto()
+    REMOVED_SAFE = enum.auto()
+    ADDED_SAFE = enum.auto()
+    DO_START = enum.auto()
+    SAFE_WELCOME = enum.auto()
+    SHOP_TITLE = enum.auto()
+    SHOP_EMPTY = enum.auto()
+    HELP_TEXT = enum.auto()
+    ACCOUNT_TEXT = enum.auto()
+    BUY_OFFLINE = enum.auto()
+    BUY_INTRO = enum.auto()
+    BUY_CART = enum.auto()
+    BUY_NEXT = enum.auto()
+    BUY_CLEAR = enum.auto()
+    BUY_CHOOSE_QTY = enum.auto()
+    BUY_DELIVERY_Q = enum.auto()
+    BUY_YES = enum.auto()
+    BUY_NO = enum.auto()
+    BUY_SEND_ADDRESS = enum.auto()
+    BUY_ORDER_SENT = enum.auto()
+    BUY_NEED_ITEMS = enum.auto()
+    BUY_CART_CHANGED = enum.auto()
+    ORDERS_TITLE = enum.auto()
+    ORDERS_EMPTY = enum.auto()
+    ORDER_DETAIL = enum.auto()
+    ORDER_CANCEL = enum.auto()
+    ORDER_CANCEL_CONFIRM = enum.auto()
+    ORDER_CANCELLED_USER = enum.auto()
+    ORDER_CANCELLED_ADMIN = enum.auto()
+    ADMIN_ADD_NAME = enum.auto()
+    ADMIN_ADD_TEXT = enum.auto()
+    ADMIN_ADD_PRICE = enum.auto()
+    ADMIN_ADD_PHOTO = enum.auto()
+    ADMIN_ADD_DONE = enum.auto()
+    ADMIN_REMOVE_PICK = enum.auto()
+    ADMIN_REMOVE_EMPTY = enum.auto()
+    ADMIN_BAD = enum.auto()
+    BACK = enum.auto()
+    HOME = enum.auto()
+    ORDER_PICKUP_MSG = enum.auto()
+    ORDER_COMPLETED_USER = enum.auto()
+    ADMIN_FEE_PROMPT = enum.auto()
+    SEARCH_USAGE = enum.auto()
+    SEARCH_NOT_FOUND = enum.auto()
+    ORDERS_USAGE = enum.auto()
+
+    @property
+    def key(self) -> str:
+        return self.name.lower()
+
+
+class TextCatalog(NamedTuple):
+    langs: Tuple[str, ...]  # DEFAULT_LANG first
+    texts: Dict[str, Tuple[str, ...]]
+    default: Tuple[str, ...]
+    missing: Dict[str, Tuple[str, ...]]  # lang -> ids filled from the fallback
+    unknown: Dict[str, Tuple[str, ...]]  # lang -> ids in the file that Msg does not have
+
+
+def _read_locale(path: str) -> Dict[str, str]:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or not all(isinstance(v, str) for v in data.values()):
+        raise ValueError(f"{path}: expected an object of strings")
+    return data
+
+
+def compile_texts(sources: Dict[str, Dict[str, str]]) -> TextCatalog:
+    if DEFAULT_LANG not in sources:
+        raise ValueError(f"no texts for default language {DEFAULT_LANG!r}")
+    langs = (DEFAULT_LANG,) + tuple(sorted(lang for lang in sources if lang != DEFAULT_LANG))
+    texts: Dict[str, Tuple[str, ...]] = {}
+    missing: Dict[str, Tuple[str, ...]] = {}
+    unknown: Dict[str, Tuple[str, ...]] = {}
+    known = {m.key for m in Msg}
+    for lang in langs:
+        src = sources[lang]
+        # the default language falls back to the id itself, like a missing key always did
+        fallback = texts[DEFAULT_LANG] if lang != DEFAULT_LANG else tuple(m.key for m in Msg)
+        texts[lang] = tuple(src.get(m.key, fallback[m]) for m in Msg)
+        missing[lang] = tuple(m.key for m in Msg if m.key not in src)
+        unknown[lang] = tuple(sorted(set(src) - known))
+    return TextCatalog(langs, texts, texts[DEFAULT_LANG], missing, unknown)
+
+
+def load_texts(directory: str = LOCALES_DIR) -> TextCatalog:
+    sources: Dict[str, Dict[str, str]] = {}
+    for name in sorted(os.listdir(directory)):
+        lang, ext = os.path.splitext(name)
+        if ext == ".json":
+            sources[lang] = _read_locale(os.path.join(directory, name))
+    return compile_texts(sources)
+
+
+TEXTS = load_texts()
+
+
+def use_texts(texts: TextCatalog) -> None:
+    global TEXTS
+    TEXTS = texts
+    route(on_lang_or_verify, "lang", texts.langs)
+    clear_keyboards()
+    warm_keyboards()
+    CATALOG.bump()  # shop keyboards carry texts too
+
+
+async def reload_texts() -> TextCatalog:
+    # raises OSError/ValueError and keeps the current texts if a catalog is broken
+    texts = await asyncio.to_thread(load_texts)  # every locale file: off the event loop
+    use_texts(texts)
+    return texts
+
+
+def t(lang: str, key: Msg) -> str:
+    return TEXTS.texts.get(lang, TEXTS.default)[key]
 
 
 # ================== KEYBOARDS ==================
+# Markups are immutable in PTB, so identical ones are built once and shared:
+# static ones per language (lru_cache, warmed in on_startup), catalog-derived
+# ones per CatalogSnapshot (rebuilt only when the catalog is reloaded).
+# All of them are dropped by clear_keyboards() when the texts are reloaded.
+@functools.lru_cache(maxsize=None)
+def lang_row() -> Tuple[InlineKeyboardButton, ...]:
+    return tuple(InlineKeyboardButton(t(lang, Msg.LANG_BUTTON), callback_data=f"lang:{lang}") for lang in TEXTS.langs)
+
+
+@functools.lru_cache(maxsize=None)
 def kb_languages() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[
-        InlineKeyboardButton("🇪🇪 ET", callback_data="lang:et"),
-        InlineKeyboardButton("🇷🇺 RU", callback_data="lang:ru"),
-        InlineKeyboardButton("🇬🇧 EN", callback_data="lang:en"),
-    ]])
+    return InlineKeyboardMarkup([lang_row()])
 
 
+@functools.lru_cache(maxsize=16)
 def kb_languages_and_verify(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("🇪🇪 ET", callback_data="lang:et"),
-            InlineKeyboardButton("🇷🇺 RU", callback_data="lang:ru"),
-            InlineKeyboardButton("🇬🇧 EN", callback_data="lang:en"),
-        ],
-        [InlineKeyboardButton(t(lang, "verify"), callback_data="verify")],
+        lang_row(),
+        [InlineKeyboardButton(t(lang, Msg.VERIFY), callback_data="verify")],
     ])
 
 
+@functools.lru_cache(maxsize=16)
 def kb_safe_menu(lang: str) -> InlineKeyboardMarkup:
     # ✅ added Orders on home menu
     return InlineKeyboardMarkup([
@@ -369,64 +718,106 @@ def kb_safe_menu(lang: str) -> InlineKeyboardMarkup:
         [
             InlineKeyboardButton("Help", callback_data="safe:help"),
         ],
-        [
-            InlineKeyboardButton("🇪🇪 ET", callback_data="lang:et"),
-            InlineKeyboardButton("🇷🇺 RU", callback_data="lang:ru"),
-            InlineKeyboardButton("🇬🇧 EN", callback_data="lang:en"),
-        ],
+        lang_row(),
     ])
 
 
-def kb_shop_items(lang: str, items: List[asyncpg.Record]) -> InlineKeyboardMarkup:
-    rows: List[List[InlineKeyboardButton]] = []
-    for it in items:
-        price = cents_to_eur_str(int(it["price_cents"]))
-        rows.append([InlineKeyboardButton(f"{it['name']} — {price}", callback_data=f"item:{it['id']}")])
-    rows.append([InlineKeyboardButton(t(lang, "home"), callback_data="safe:home")])
-    rows.append([
-        InlineKeyboardButton("🇪🇪 ET", callback_data="lang:et"),
-        InlineKeyboardButton("🇷🇺 RU", callback_data="lang:ru"),
-        InlineKeyboardButton("🇬🇧 EN", callback_data="lang:en"),
+def _kb_page_nav(catalog: "CatalogSnapshot", start: int, prefix: str) -> Tuple[InlineKeyboardButton, ...]:
+    # keyset links: "<prefix>:before:<first id>" / "<prefix>:from:<first id of next page>"
+    key = ("nav", prefix, start)
+    nav = catalog.markups.get(key)
+    if nav is None:
+        ids = catalog.ids
+        buttons = []
+        if start > 0:
+            buttons.append(InlineKeyboardButton("◀️", callback_data=f"{prefix}:before:{ids[start]}"))
+        if start + CATALOG_PAGE_SIZE < len(ids):
+            buttons.append(InlineKeyboardButton("▶️", callback_data=f"{prefix}:from:{ids[start + CATALOG_PAGE_SIZE]}"))
+        nav = catalog.markups[key] = tuple(buttons)
+    return nav
+
+
+def kb_shop_items(lang: str, catalog: "CatalogSnapshot", start: int = 0) -> InlineKeyboardMarkup:
+    key = ("shop", lang, start)
+    kb = catalog.markups.get(key)
+    if kb is None:
+        rows: List[Sequence[InlineKeyboardButton]] = []
+        page_from = catalog.ids[start] if catalog.ids else 0
+        for it in catalog.items[start:start + CATALOG_PAGE_SIZE]:
+            price = cents_to_eur_str(int(it["price_cents"]))
+            # page_from lets the item view link back to this page
+            rows.append([InlineKeyboardButton(f"{it['name']} — {price}", callback_data=f"item:{it['id']}:{page_from}")])
+        nav = _kb_page_nav(catalog, start, "shop")
+        if nav:
+            rows.append(nav)
+        rows.append([InlineKeyboardButton(t(lang, Msg.HOME), callback_data="safe:home")])
+        rows.append(lang_row())
+        kb = catalog.markups[key] = InlineKeyboardMarkup(rows)
+    return kb
+
+
+@functools.lru_cache(maxsize=1024)
+def kb_item_detail(lang: str, page_from: int = 0) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(t(lang, Msg.BACK), callback_data=f"shop:open:{page_from}")],
+        [InlineKeyboardButton(t(lang, Msg.HOME), callback_data="safe:home")],
+        lang_row(),
     ])
-    return InlineKeyboardMarkup(rows)
 
 
-def kb_item_detail(lang: str) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton(t(lang, "back"), callback_data="safe:shop")],
-        [InlineKeyboardButton(t(lang, "home"), callback_data="safe:home")],
-        [
-            InlineKeyboardButton("🇪🇪 ET", callback_data="lang:et"),
-            InlineKeyboardButton("🇷🇺 RU", callback_data="lang:ru"),
-            InlineKeyboardButton("🇬🇧 EN", callback_data="lang:en"),
-        ],
-    ])
+@functools.lru_cache(maxsize=16)
+def _kb_buy_footer(lang: str) -> Tuple[Sequence[InlineKeyboardButton], ...]:
+    return (
+        (
+            InlineKeyboardButton(t(lang, Msg.BUY_CLEAR), callback_data="buy:clear"),
+            InlineKeyboardButton(t(lang, Msg.BUY_NEXT), callback_data="buy:next"),
+        ),
+        (InlineKeyboardButton(t(lang, Msg.HOME), callback_data="safe:home"),),
+        lang_row(),
+    )
 
 
-def kb_buy_menu(lang: str, items: List[asyncpg.Record], cart: Dict[int, int], subtotal_cents: int) -> InlineKeyboardMarkup:
-    rows: List[List[InlineKeyboardButton]] = []
-    for it in items:
-        item_id = int(it["id"])
-        qty = cart.get(item_id, 0)
-        price = cents_to_eur_str(int(it["price_cents"]))
-        label = f"{it['name']} — {price}"
-        if qty > 0:
-            label += f" (x{qty})"
-        rows.append([InlineKeyboardButton(label, callback_data=f"buy:item:{item_id}")])
-
-    rows.append([
-        InlineKeyboardButton(t(lang, "buy_clear"), callback_data="buy:clear"),
-        InlineKeyboardButton(t(lang, "buy_next"), callback_data="buy:next"),
-    ])
-    rows.append([InlineKeyboardButton(t(lang, "home"), callback_data="safe:home")])
-    rows.append([
-        InlineKeyboardButton("🇪🇪 ET", callback_data="lang:et"),
-        InlineKeyboardButton("🇷🇺 RU", callback_data="lang:ru"),
-        InlineKeyboardButton("🇬🇧 EN", callback_data="lang:en"),
-    ])
+def _kb_buy_base(catalog: "CatalogSnapshot") -> Tuple[Tuple[int, str, InlineKeyboardButton], ...]:
+    # (item_id, label, button without quantity) per catalog item
+    base = catalog.markups.get("buy_base")
+    if base is None:
+        rows = []
+        for it in catalog.items:
+            item_id = int(it["id"])
+            label = f"{it['name']} — {cents_to_eur_str(int(it['price_cents']))}"
+            rows.append((item_id, label, InlineKeyboardButton(label, callback_data=f"buy:item:{item_id}")))
+        base = catalog.markups["buy_base"] = tuple(rows)
+    return base
+
+
+def kb_buy_menu(
+    lang: str, catalog: "CatalogSnapshot", cart: Dict[int, "CartLine"], subtotal_cents: int, start: int = 0
+) -> InlineKeyboardMarkup:
+    page = _kb_buy_base(catalog)[start:start + CATALOG_PAGE_SIZE]
+    nav = _kb_page_nav(catalog, start, "buy")
+    if not any(item_id in cart for item_id, _, _ in page):
+        key = ("buy", lang, start)
+        kb = catalog.markups.get(key)
+        if kb is None:
+            rows = [(btn,) for _, _, btn in page]
+            if nav:
+                rows.append(nav)
+            kb = catalog.markups[key] = InlineKeyboardMarkup(rows + list(_kb_buy_footer(lang)))
+        return kb
+
+    rows: List[Sequence[InlineKeyboardButton]] = []
+    for item_id, label, btn in page:
+        line = cart.get(item_id)
+        if line is not None:
+            btn = InlineKeyboardButton(f"{label} (x{line.qty})", callback_data=f"buy:item:{item_id}")
+        rows.append((btn,))
+    if nav:
+        rows.append(nav)
+    rows.extend(_kb_buy_footer(lang))
     return InlineKeyboardMarkup(rows)
 
 
+@functools.lru_cache(maxsize=1024)
 def kb_qty(lang: str, item_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [
@@ -439,18 +830,34 @@ def kb_qty(lang: str, item_id: int) -> InlineKeyboardMarkup:
             InlineKeyboardButton("5", callback_data=f"buy:qty:{item_id}:5"),
             InlineKeyboardButton("0", callback_data=f"buy:qty:{item_id}:0"),
         ],
-        [InlineKeyboardButton(t(lang, "back"), callback_data="buy:back")],
+        [InlineKeyboardButton(t(lang, Msg.BACK), callback_data="buy:back")],
     ])
 
 
+@functools.lru_cache(maxsize=16)
 def kb_delivery(lang: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton(t(lang, "buy_yes"), callback_data="buy:delivery:yes")],
-        [InlineKeyboardButton(t(lang, "buy_no"), callback_data="buy:delivery:no")],
-        [InlineKeyboardButton(t(lang, "back"), callback_data="buy:back")],
+        [InlineKeyboardButton(t(lang, Msg.BUY_YES), callback_data="buy:delivery:yes")],
+        [InlineKeyboardButton(t(lang, Msg.BUY_NO), callback_data="buy:delivery:no")],
+        [InlineKeyboardButton(t(lang, Msg.BACK), callback_data="buy:back")],
     ])
 
 
+def clear_keyboards() -> None:
+    for kb in (lang_row, kb_languages, kb_languages_and_verify, kb_safe_menu, kb_item_detail, _kb_buy_footer, kb_qty, kb_delivery):
+        kb.cache_clear()
+
+
+def warm_keyboards() -> None:
+    kb_languages()
+    for lang in TEXTS.langs:
+        kb_languages_and_verify(lang)
+        kb_safe_menu(lang)
+        kb_item_detail(lang)
+        kb_delivery(lang)
+        _kb_buy_footer(lang)
+
+
 def kb_orders_list(lang: str, orders: List[asyncpg.Record]) -> InlineKeyboardMarkup:
     rows: List[List[InlineKeyboardButton]] = []
     for o in orders:
@@ -458,23 +865,23 @@ def kb_orders_list(lang: str, orders: List[asyncpg.Record]) -> InlineKeyboardMar
         status = str(o["status"])
         total = cents_to_eur_str(int(o["total_cents"]))
         rows.append([InlineKeyboardButton(f"Order #{oid} — {status} — {total}", callback_data=f"uord:view:{oid}")])
-    rows.append([InlineKeyboardButton(t(lang, "home"), callback_data="safe:home")])
+    rows.append([InlineKeyboardButton(t(lang, Msg.HOME), callback_data="safe:home")])
     return InlineKeyboardMarkup(rows)
 
 
 def kb_order_detail(lang: str, order_id: int, can_cancel: bool) -> InlineKeyboardMarkup:
     rows: List[List[InlineKeyboardButton]] = []
     if can_cancel:
-        rows.append([InlineKeyboardButton(t(lang, "order_cancel"), callback_data=f"uord:cancel:{order_id}")])
-    rows.append([InlineKeyboardButton(t(lang, "back"), callback_data="safe:orders")])
-    rows.append([InlineKeyboardButton(t(lang, "home"), callback_data="safe:home")])
+        rows.append([InlineKeyboardButton(t(lang, Msg.ORDER_CANCEL), callback_data=f"uord:cancel:{order_id}")])
+    rows.append([InlineKeyboardButton(t(lang, Msg.BACK), callback_data="safe:orders")])
+    rows.append([InlineKeyboardButton(t(lang, Msg.HOME), callback_data="safe:home")])
     return InlineKeyboardMarkup(rows)
 
 
 def kb_order_cancel_confirm(lang: str, order_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton(t(lang, "order_cancel_confirm"), callback_data=f"uord:confirm:{order_id}")],
-        [InlineKeyboardButton(t(lang, "back"), callback_data=f"uord:view:{order_id}")],
+        [InlineKeyboardButton(t(lang, Msg.ORDER_CANCEL_CONFIRM), callback_data=f"uord:confirm:{order_id}")],
+        [InlineKeyboardButton(t(lang, Msg.BACK), callback_data=f"uord:view:{order_id}")],
     ])
 
 
@@ -489,11 +896,14 @@ def kb_admin_remove(user_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Remove SAFE", callback_data=f"adm:rem:{user_id}")]])
 
 
-def kb_admin_removeitem(items: List[asyncpg.Record]) -> InlineKeyboardMarkup:
-    rows: List[List[InlineKeyboardButton]] = []
-    for it in items:
-        rows.append([InlineKeyboardButton(f"❌ {it['name']}", callback_data=f"adm:rmitem:{it['id']}")])
-    return InlineKeyboardMarkup(rows) if rows else InlineKeyboardMarkup([])
+def kb_admin_removeitem(catalog: "CatalogSnapshot") -> InlineKeyboardMarkup:
+    kb = catalog.markups.get("admin_remove")
+    if kb is None:
+        rows: List[List[InlineKeyboardButton]] = []
+        for it in catalog.items:
+            rows.append([InlineKeyboardButton(f"❌ {it['name']}", callback_data=f"adm:rmitem:{it['id']}")])
+        kb = catalog.markups["admin_remove"] = InlineKeyboardMarkup(rows)
+    return kb
 
 
 def kb_admin_order(order_id: int) -> InlineKeyboardMarkup:
@@ -503,10 +913,43 @@ def kb_admin_order(order_id: int) -> InlineKeyboardMarkup:
     ]])
 
 
-# ================== DB HELPERS ==================
-async def upsert_user(pool: asyncpg.Pool, user) -> None:
-    await pool.execute(
-        """
+ORDER_STATUSES = ("NEW", "SEEN", "DONE", "CANCELLED")
+
+
+@functools.lru_cache(maxsize=None)
+def _kb_admin_orders_tabs() -> Tuple[InlineKeyboardButton, ...]:
+    return tuple(InlineKeyboardButton(st, callback_data=f"aord:{st}") for st in ORDER_STATUSES)
+
+
+def kb_admin_orders(status: str, order_ids: Sequence[int], has_newer: bool, has_older: bool) -> InlineKeyboardMarkup:
+    # order_ids newest first; a/b = newer/older than the given id
+    rows: List[Sequence[InlineKeyboardButton]] = []
+    for i in range(0, len(order_ids), 5):
+        rows.append([InlineKeyboardButton(f"#{oid}", callback_data=f"aord:o:{oid}") for oid in order_ids[i:i + 5]])
+    nav = []
+    if has_newer and order_ids:
+        nav.append(InlineKeyboardButton("◀️ Newer", callback_data=f"aord:{status}:a:{order_ids[0]}"))
+    if has_older and order_ids:
+        nav.append(InlineKeyboardButton("Older ▶️", callback_data=f"aord:{status}:b:{order_ids[-1]}"))
+    if nav:
+        rows.append(nav)
+    rows.append(_kb_admin_orders_tabs())
+    return InlineKeyboardMarkup(rows)
+
+
+# ================== DB POOL ==================
+# hot queries from DB HELPERS: asyncpg keeps each one as a named server-side prepared
+# statement in every connection's statement cache, so after the first use on a
+# connection they skip parse/plan. The dict key is the name used in DB_STATS.
+ORDERS_PAGE_SQL = (
+    "SELECT o.id, o.total_cents, o.delivery, o.created_at, u.username, u.first_name, "
+    "(SELECT count(*) FROM jsonb_object_keys(o.cart_json)) AS lines "
+    "FROM orders o LEFT JOIN users u ON u.user_id = o.user_id "
+    "WHERE o.status=$1 {where} ORDER BY o.id {order} LIMIT $2"
+)
+PREPARED_SQL: Dict[str, str] = {
+    "get_user": "SELECT * FROM users WHERE user_id=$1",
+    "upsert_user": """
         INSERT INTO users (user_id, first_name, last_name, username, updated_at)
         VALUES ($1, $2, $3, $4, now())
         ON CONFLICT (user_id) DO UPDATE
@@ -514,49 +957,768 @@ async def upsert_user(pool: asyncpg.Pool, user) -> None:
               last_name  = EXCLUDED.last_name,
               username   = EXCLUDED.username,
               updated_at = now()
-        """,
+        RETURNING *
+    """,
+    # updated_at for these goes through USER_WRITES
+    "set_language": "UPDATE users SET language=$1 WHERE user_id=$2",
+    "set_state": "UPDATE users SET state=$1 WHERE user_id=$2",
+    "set_status": "UPDATE users SET status=$1 WHERE user_id=$2",
+    "get_setting": "SELECT value FROM settings WHERE key=$1",
+    "get_order": "SELECT * FROM orders WHERE id=$1",
+    "get_admin_order": (
+        "SELECT o.*, u.username, u.first_name, u.last_name "
+        "FROM orders o LEFT JOIN users u ON u.user_id = o.user_id WHERE o.id=$1"
+    ),
+    "get_archived_order": "SELECT * FROM orders_archive WHERE id=$1",
+    # status change + users.orders_done/orders_cancelled + outbox rows of kinds $3 in one
+    # statement; no-op if already in $2
+    "set_order_status": """
+        WITH prev AS (
+          SELECT id, created_at, user_id, status FROM orders WHERE id=$1 FOR UPDATE
+        ), o AS (
+          -- DONE and CANCELLED are final, as in complete_order (spent_cents stays added)
+          UPDATE orders SET status=$2 FROM prev
+          WHERE orders.id = prev.id AND orders.created_at = prev.created_at
+            AND prev.status <> $2 AND prev.status NOT IN ('DONE','CANCELLED')
+          RETURNING prev.id, prev.user_id
+        ), n AS (
+          INSERT INTO outbox (kind, order_id) SELECT k, o.id FROM o, unnest($3::text[]) AS k
+        ), u AS (
+          UPDATE users SET
+            orders_done = users.orders_done + ($2 = 'DONE')::int,
+            orders_cancelled = users.orders_cancelled + ($2 = 'CANCELLED')::int
+          FROM o WHERE users.user_id = o.user_id
+          RETURNING users.user_id, users.orders_done, users.orders_cancelled
+        )
+        SELECT o.id, o.user_id, u.orders_done, u.orders_cancelled
+        FROM o LEFT JOIN u ON u.user_id = o.user_id
+    """,
+    # only an open order completes (a double tap finds nothing), queueing the customer
+    # notice and the admin card refresh
+    "complete_order": """
+        WITH o AS (
+          UPDATE orders SET status='DONE'
+          WHERE id=$1 AND status NOT IN ('DONE','CANCELLED')
+          RETURNING *
+        ), u AS (
+          UPDATE users SET spent_cents = users.spent_cents + o.total_cents, orders_done = users.orders_done + 1
+          FROM o WHERE users.user_id = o.user_id
+          RETURNING users.user_id, users.spent_cents, users.orders_done
+        ), n AS (
+          INSERT INTO outbox (kind, order_id) SELECT k, o.id FROM o, unnest(ARRAY['order_done', 'admin_order']) AS k
+        )
+        SELECT o.id, o.user_id, o.admin_message_id, u.spent_cents, u.orders_done
+        FROM o LEFT JOIN u ON u.user_id = o.user_id
+    """,
+    "get_archived_admin_order": (
+        "SELECT o.*, u.username, u.first_name, u.last_name "
+        "FROM orders_archive o LEFT JOIN users u ON u.user_id = o.user_id WHERE o.id=$1"
+    ),
+    "list_user_active_orders": (
+        "SELECT id, status, total_cents FROM orders "
+        "WHERE user_id=$1 AND status NOT IN ('DONE','CANCELLED') ORDER BY id DESC"
+    ),
+    # /orders pages: keyset over orders_status_id_idx, LIMIT is page size + 1 to see if more follow
+    "list_orders_first": ORDERS_PAGE_SQL.format(where="", order="DESC"),
+    "list_orders_older": ORDERS_PAGE_SQL.format(where="AND o.id < $3", order="DESC"),
+    "list_orders_newer": ORDERS_PAGE_SQL.format(where="AND o.id > $3", order="ASC"),
+}
+PREPARED_NAMES: Dict[str, str] = {sql: name for name, sql in PREPARED_SQL.items()}
+
+
+class DbStats:
+    def __init__(self) -> None:
+        self.acquires = 0
+        self.acquire_wait_total = 0.0
+        self.acquire_wait_max = 0.0
+        self.in_use = 0
+        self.in_use_max = 0
+        # query name -> [count, total seconds, max seconds, errors]
+        self.queries: Dict[str, List[Any]] = {}
+        self.write_behind_failures = 0  # UserWriteBehind batches put back for the next flush
+
+    def record_acquire(self, wait: float) -> None:
+        self.acquires += 1
+        self.acquire_wait_total += wait
+        if wait > self.acquire_wait_max:
+            self.acquire_wait_max = wait
+
+    def record_query(self, name: str, elapsed: float, failed: bool = False) -> None:
+        q = self.queries.get(name)
+        if q is None:
+            q = self.queries[name] = [0, 0.0, 0.0, 0]
+        q[0] += 1
+        q[1] += elapsed
+        if elapsed > q[2]:
+            q[2] = elapsed
+        if failed:
+            q[3] += 1
+
+
+DB_STATS = DbStats()
+
+
+def query_name(sql: str) -> str:
+    name = PREPARED_NAMES.get(sql)
+    if name:
+        return name
+    if sql.startswith("SELECT pg_advisory_unlock_all()"):
+        return "pool_reset"  # asyncpg's reset on connection release
+    return " ".join(sql.split())[:60]
+
+
+def _log_query(record: Any) -> None:
+    # asyncpg query logger: covers every statement, incl. ones run on acquired connections
+    name = query_name(record.query)
+    DB_STATS.record_query(name, record.elapsed, record.exception is not None)
+    if name != "pool_reset":
+        trace_db(record.elapsed)
+
+
+class DbPool:
+    # asyncpg.Pool wrapper that measures acquire wait and in-use connections
+    def __init__(self, pool: asyncpg.Pool) -> None:
+        self._pool = pool
+
+    @classmethod
+    async def create(cls, dsn: str) -> "DbPool":
+        async def init(conn: asyncpg.Connection) -> None:
+            conn.add_query_logger(_log_query)
+
+        pool = await asyncpg.create_pool(
+            dsn,
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            init=init,
+        )
+        return cls(pool)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        start = time.perf_counter()
+        async with self._pool.acquire() as conn:
+            DB_STATS.record_acquire(time.perf_counter() - start)
+            DB_STATS.in_use += 1
+            if DB_STATS.in_use > DB_STATS.in_use_max:
+                DB_STATS.in_use_max = DB_STATS.in_use
+            try:
+                yield conn
+            finally:
+                DB_STATS.in_use -= 1
+
+    def size(self) -> Tuple[int, int]:
+        return self._pool.get_size(), self._pool.get_max_size()
+
+    async def close(self) -> None:
+        await self._pool.close()
+
+    async def _run(self, method: str, query: str, args: Tuple[Any, ...]) -> Any:
+        async with self.acquire() as conn:
+            return await getattr(conn, method)(query, *args)
+
+    async def execute(self, query: str, *args: Any) -> str:
+        return await self._run("execute", query, args)
+
+    async def fetch(self, query: str, *args: Any) -> List[asyncpg.Record]:
+        return await self._run("fetch", query, args)
+
+    async def fetchrow(self, query: str, *args: Any) -> Optional[asyncpg.Record]:
+        return await self._run("fetchrow", query, args)
+
+    async def fetchval(self, query: str, *args: Any) -> Any:
+        return await self._run("fetchval", query, args)
+
+
+# ================== TRACING ==================
+# per-update trace: started by a group -1 TypeHandler, named by the wrapped handler
+# callback, closed by a TypeHandler in TRACE_GROUP_END. DB time comes from the asyncpg
+# query logger, Bot API time from SendScheduler; both find the trace through TRACE.
+TRACE_GROUP_END = 100
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Trace:
+    __slots__ = ("handler", "start", "db", "queries", "api", "api_calls", "failed", "done")
+
+    def __init__(self) -> None:
+        self.handler = "unhandled"
+        self.start = time.perf_counter()
+        self.db = 0.0
+        self.queries = 0
+        self.api = 0.0
+        self.api_calls = 0
+        self.failed = False
+        self.done = False
+
+
+class HandlerStat:
+    __slots__ = ("count", "wall", "wall_max", "db", "queries", "api", "api_calls", "errors", "buckets")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.wall = 0.0
+        self.wall_max = 0.0
+        self.db = 0.0
+        self.queries = 0
+        self.api = 0.0
+        self.api_calls = 0
+        self.errors = 0
+        self.buckets = [0] * len(LATENCY_BUCKETS)  # per bound, not cumulative; slower ones only in count
+
+
+TRACE: "contextvars.ContextVar[Optional[Trace]]" = contextvars.ContextVar("trace", default=None)
+HANDLER_STATS: Dict[str, HandlerStat] = {}
+
+
+def handler_stat(name: str) -> HandlerStat:
+    st = HANDLER_STATS.get(name)
+    if st is None:
+        st = HANDLER_STATS[name] = HandlerStat()
+    return st
+
+
+def trace_db(elapsed: float) -> None:
+    tr = TRACE.get()
+    if tr is not None and not tr.done:
+        tr.db += elapsed
+        tr.queries += 1
+
+
+def trace_api(elapsed: float) -> None:
+    tr = TRACE.get()
+    if tr is not None and not tr.done:
+        tr.api += elapsed
+        tr.api_calls += 1
+
+
+def traced(callback: Any) -> Any:
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update: Any, context: Any, *args: Any) -> Any:
+        tr = TRACE.get()
+        if tr is not None:
+            tr.handler = name
+        try:
+            return await callback(update, context, *args)
+        except Exception:
+            if tr is not None:
+                tr.failed = True
+            raise
+
+    return wrapper
+
+
+async def trace_start(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    TRACE.set(Trace())
+
+
+async def trace_finish(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    tr = TRACE.get()
+    if tr is None or tr.done:
+        return
+    # the query logger reports via call_soon: let the last query's record land first
+    await asyncio.sleep(0)
+    tr.done = True
+    wall = time.perf_counter() - tr.start
+    st = handler_stat(tr.handler)
+    st.count += 1
+    st.wall += wall
+    if wall > st.wall_max:
+        st.wall_max = wall
+    st.db += tr.db
+    st.queries += tr.queries
+    st.api += tr.api
+    st.api_calls += tr.api_calls
+    if tr.failed:
+        st.errors += 1
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if wall <= bound:
+            st.buckets[i] += 1
+            break
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def render_metrics(app: Application) -> str:
+    out: List[str] = []
+
+    def metric(name: str, kind: str, help_text: str) -> None:
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} {kind}")
+
+    handlers = sorted(HANDLER_STATS.items())
+    metric("bot_handler_duration_seconds", "histogram", "Wall time per update, by handler.")
+    for name, st in handlers:
+        h = _label(name)
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS, st.buckets):
+            cumulative += n
+            out.append(f'bot_handler_duration_seconds_bucket{{handler="{h}",le="{bound}"}} {cumulative}')
+        out.append(f'bot_handler_duration_seconds_bucket{{handler="{h}",le="+Inf"}} {st.count}')
+        out.append(f'bot_handler_duration_seconds_sum{{handler="{h}"}} {st.wall}')
+        out.append(f'bot_handler_duration_seconds_count{{handler="{h}"}} {st.count}')
+    for name, kind, attr, help_text in (
+        ("bot_handler_db_seconds_total", "counter", "db", "Time spent in DB queries, by handler."),
+        ("bot_handler_db_queries_total", "counter", "queries", "DB queries run, by handler."),
+        ("bot_handler_bot_api_seconds_total", "counter", "api", "Time spent in Bot API calls incl. rate limiting, by handler."),
+        ("bot_handler_bot_api_calls_total", "counter", "api_calls", "Bot API calls, by handler."),
+        ("bot_handler_errors_total", "counter", "errors", "Updates whose handler raised, by handler."),
+    ):
+        metric(name, kind, help_text)
+        for hname, st in handlers:
+            out.append(f'{name}{{handler="{_label(hname)}"}} {getattr(st, attr)}')
+
+    pool: Optional[DbPool] = app.bot_data.get("db_pool")
+    if pool is not None:
+        size, max_size = pool.size()
+        metric("bot_db_pool_connections", "gauge", "Open pool connections.")
+        out.append(f"bot_db_pool_connections {size}")
+        metric("bot_db_pool_max_connections", "gauge", "Pool max size.")
+        out.append(f"bot_db_pool_max_connections {max_size}")
+    metric("bot_db_pool_in_use", "gauge", "Connections currently acquired.")
+    out.append(f"bot_db_pool_in_use {DB_STATS.in_use}")
+    metric("bot_db_acquires_total", "counter", "Pool acquisitions.")
+    out.append(f"bot_db_acquires_total {DB_STATS.acquires}")
+    metric("bot_db_acquire_wait_seconds_total", "counter", "Time spent waiting for a pool connection.")
+    out.append(f"bot_db_acquire_wait_seconds_total {DB_STATS.acquire_wait_total}")
+    metric("bot_user_write_behind_failures_total", "counter", "Failed user write-behind flushes (retried).")
+    out.append(f"bot_user_write_behind_failures_total {DB_STATS.write_behind_failures}")
+    queries = sorted(DB_STATS.queries.items())
+    metric("bot_db_queries_total", "counter", "DB queries, by statement.")
+    for qname, (count, _total, _worst, _errors) in queries:
+        out.append(f'bot_db_queries_total{{query="{_label(qname)}"}} {count}')
+    metric("bot_db_query_seconds_total", "counter", "DB query time, by statement.")
+    for qname, (_count, total, _worst, _errors) in queries:
+        out.append(f'bot_db_query_seconds_total{{query="{_label(qname)}"}} {total}')
+
+    limiter = getattr(app.bot, "rate_limiter", None)
+    if isinstance(limiter, SendScheduler):
+        metric("bot_send_queue_size", "gauge", "Outbound Bot API calls waiting for a rate-limit slot.")
+        out.append(f"bot_send_queue_size {limiter.queue_size()}")
+    return "\n".join(out) + "\n"
+
+
+async def _serve_metrics(app: Application, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+            status, body = b"200 OK", render_metrics(app).encode()
+        else:
+            status, body = b"404 Not Found", b"not found\n"
+        writer.write(
+            b"HTTP/1.1 " + status + b"\r\n"
+            b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+            b"Connection: close\r\n\r\n" + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(app: Application) -> Optional[asyncio.AbstractServer]:
+    if not METRICS_PORT:
+        return None
+    return await asyncio.start_server(functools.partial(_serve_metrics, app), METRICS_LISTEN, METRICS_PORT)
+
+
+# ================== CACHES ==================
+class UserCache:
+    # user_id -> users row (as dict), LRU ordered, each entry expires after ttl seconds
+    def __init__(self, ttl: float, max_size: int) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data: "OrderedDict[int, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        entry = self._data.get(user_id)
+        if entry is None:
+            return None
+        expires_at, row = entry
+        if expires_at < time.monotonic():
+            del self._data[user_id]
+            return None
+        self._data.move_to_end(user_id)
+        return row
+
+    def put(self, user_id: int, row: Dict[str, Any]) -> None:
+        self._data[user_id] = (time.monotonic() + self.ttl, row)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def update(self, user_id: int, **fields: Any) -> None:
+        row = self.get(user_id)
+        if row is not None:
+            row.update(fields)
+
+    def invalidate(self, user_id: int) -> None:
+        self._data.pop(user_id, None)
+
+
+class CatalogSnapshot:
+    # immutable view of the items table: ordered tuple + id index
+    __slots__ = ("version", "items", "by_id", "ids", "price_version", "loaded_at", "markups")
+
+    def __init__(self, version: int, items: Sequence[Dict[str, Any]]) -> None:
+        self.version = version
+        self.items: Tuple[Dict[str, Any], ...] = tuple(items)
+        self.by_id: Dict[int, Dict[str, Any]] = {int(it["id"]): it for it in self.items}
+        self.ids: Tuple[int, ...] = tuple(int(it["id"]) for it in self.items)  # ascending, for keyset pages
+        # fingerprint of (id, price) over all items, equal in every process with the same items;
+        # carts remember it so checkout knows whether their price snapshots are still current
+        prices = hashlib.blake2b(digest_size=8)
+        for it in self.items:
+            prices.update(struct.pack("<Iq", int(it["id"]), int(it["price_cents"])))
+        self.price_version = int.from_bytes(prices.digest(), "big")
+        self.loaded_at = time.monotonic()
+        self.markups: Dict[Any, Any] = {}  # keyboards derived from this snapshot
+
+    def page_start(self, from_id: int = 0, before_id: Optional[int] = None) -> int:
+        # index of a page's first item: first id >= from_id, or the page ending just before before_id
+        if before_id is not None:
+            return max(0, bisect.bisect_left(self.ids, before_id) - CATALOG_PAGE_SIZE)
+        start = bisect.bisect_left(self.ids, from_id)
+        if start >= len(self.ids):
+            # anchor item was removed from the end of the catalog
+            start = max(0, len(self.ids) - CATALOG_PAGE_SIZE)
+        return start
+
+
+class CatalogCache:
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self.version = 0
+        self._snapshot: Optional[CatalogSnapshot] = None
+
+    async def get(self, pool: DbPool) -> CatalogSnapshot:
+        snap = self._snapshot
+        if snap is not None and snap.version == self.version and time.monotonic() - snap.loaded_at < self.ttl:
+            return snap
+        version = self.version
+        rows = await pool.fetch("SELECT id, name, short_text, price_cents, photo_file_id FROM items ORDER BY id ASC")
+        snap = CatalogSnapshot(version, [dict(r) for r in rows])
+        if version == self.version:
+            self._snapshot = snap
+        return snap
+
+    def bump(self) -> None:
+        self.version += 1
+
+
+SETTINGS_CHANNEL = "bot_settings"  # NOTIFY channel, payload {"key": ..., "value": ...}
+# NOTIFY channel, payload {"kind": "user" | "catalog" | "texts" | "outbox", "id": ..., "from": PROCESS_ID}:
+# another process changed something this process keeps in memory, or queued outbox rows
+CACHE_CHANNEL = "bot_cache"
+PROCESS_ID = os.urandom(8).hex()
+_NOTIFY_TASKS: Set[asyncio.Task] = set()  # strong refs until done
+
+
+async def _reload_texts_notified() -> None:
+    try:
+        await reload_texts()
+    except Exception:
+        log.exception("texts not reloaded after %s notification, keeping the current ones", CACHE_CHANNEL)
+
+
+def _on_cache_notify(conn: Any, pid: int, channel: str, payload: str) -> None:
+    # runs inside the asyncpg listener: anything slow goes to a task
+    try:
+        data = json.loads(payload)
+        if data.get("from") == PROCESS_ID:
+            return
+        kind = data["kind"]
+        if kind == "user":
+            USER_CACHE.invalidate(int(data["id"]))
+        elif kind == "catalog":
+            CATALOG.bump()
+        elif kind == "texts":
+            task = asyncio.get_running_loop().create_task(_reload_texts_notified())
+            _NOTIFY_TASKS.add(task)
+            task.add_done_callback(_NOTIFY_TASKS.discard)
+        elif kind == "outbox":
+            OUTBOX.wake(publish=False)
+        else:
+            log.warning("unknown %s kind %r", CACHE_CHANNEL, kind)
+    except Exception:
+        log.exception("bad %s payload %r", CACHE_CHANNEL, payload)
+
+
+async def publish_invalidation(pool: "DbPool", kind: str, key: Optional[int] = None) -> None:
+    await pool.execute(
+        "SELECT pg_notify($1, $2)", CACHE_CHANNEL, json.dumps({"kind": kind, "id": key, "from": PROCESS_ID})
+    )
+
+
+class SettingsCache:
+    # full copy of the settings table, kept current by LISTEN on a dedicated
+    # connection so every process sharing the database sees /online, /offline etc.;
+    # the same connection carries CACHE_CHANNEL
+    def __init__(self) -> None:
+        self.values: Dict[str, str] = {}
+        self.loaded = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def load(self, pool: "DbPool") -> None:
+        rows = await pool.fetch("SELECT key, value FROM settings")
+        self.values = {r["key"]: r["value"] for r in rows}
+        self.loaded = True
+
+    def _on_notify(self, conn: Any, pid: int, channel: str, payload: str) -> None:
+        try:
+            data = json.loads(payload)
+            self.values[str(data["key"])] = str(data["value"])
+        except Exception:
+            log.exception("bad %s payload %r", SETTINGS_CHANNEL, payload)
+
+    async def _listen(self, pool: "DbPool", dsn: str) -> None:
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(dsn)
+                lost = asyncio.get_running_loop().create_future()
+                conn.add_termination_listener(lambda _c: lost.done() or lost.set_result(None))
+                await conn.add_listener(SETTINGS_CHANNEL, self._on_notify)
+                await conn.add_listener(CACHE_CHANNEL, _on_cache_notify)
+                await self.load(pool)  # catch up on anything sent while we were not listening
+                while not lost.done():
+                    try:
+                        await asyncio.wait_for(asyncio.shield(lost), timeout=60)
+                    except asyncio.TimeoutError:
+                        await conn.execute("SELECT 1")  # detect dead connections
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass
+            finally:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(5)
+
+    def start(self, pool: "DbPool", dsn: str) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._listen(pool, dsn))
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+
+class UserWriteBehind:
+    # Buffers profile changes and updated_at touches of existing users, merged
+    # per user, and writes them as two unnest() statements every
+    # USER_FLUSH_INTERVAL seconds (or at USER_FLUSH_ROWS users) and on shutdown.
+    def __init__(self) -> None:
+        self._profiles: Dict[int, Tuple[Optional[str], Optional[str], Optional[str], datetime.datetime]] = {}
+        self._touches: Dict[int, datetime.datetime] = {}
+        self._pool: Optional["DbPool"] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flush_task: Optional[asyncio.Task] = None  # early flush at USER_FLUSH_ROWS
+        self._flushing = asyncio.Lock()
+        self._writing: Set[int] = set()  # profiles in the flush under way
+        self._superseded: Set[int] = set()  # ... that discard() made stale
+
+    def profile(self, user_id: int, first_name: Optional[str], last_name: Optional[str], username: Optional[str]) -> None:
+        self._touches.pop(user_id, None)
+        self._profiles[user_id] = (first_name, last_name, username, datetime.datetime.now(datetime.timezone.utc))
+        self._maybe_flush()
+
+    def touch(self, user_id: int) -> None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        prof = self._profiles.get(user_id)
+        if prof is not None:
+            self._profiles[user_id] = prof[:3] + (now,)
+        else:
+            self._touches[user_id] = now
+        self._maybe_flush()
+
+    async def discard(self, user_id: int) -> None:
+        # the caller writes the user's profile itself: drop what is buffered, and let a
+        # flush already writing it finish (and not re-queue it), so the newer write lands last
+        self._profiles.pop(user_id, None)
+        self._touches.pop(user_id, None)
+        if user_id in self._writing:
+            self._superseded.add(user_id)
+            async with self._flushing:
+                pass
+
+    def _maybe_flush(self) -> None:
+        if self._pool is None or len(self._profiles) + len(self._touches) < USER_FLUSH_ROWS:
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self) -> None:
+        if self._pool is None:
+            return
+        async with self._flushing:
+            profiles, self._profiles = self._profiles, {}
+            touches, self._touches = self._touches, {}
+            if not profiles and not touches:
+                return
+            self._writing = set(profiles)
+            try:
+                async with self._pool.acquire() as conn:
+                    async with conn.transaction():
+                        if profiles:
+                            await conn.execute(
+                                """
+                                INSERT INTO users (user_id, first_name, last_name, username, updated_at)
+                                SELECT * FROM unnest($1::bigint[], $2::text[], $3::text[], $4::text[], $5::timestamptz[])
+                                ON CONFLICT (user_id) DO UPDATE
+                                  SET first_name = EXCLUDED.first_name,
+                                      last_name  = EXCLUDED.last_name,
+                                      username   = EXCLUDED.username,
+                                      updated_at = GREATEST(users.updated_at, EXCLUDED.updated_at)
+                                """,
+                                list(profiles),
+                                [p[0] for p in profiles.values()],
+                                [p[1] for p in profiles.values()],
+                                [p[2] for p in profiles.values()],
+                                [p[3] for p in profiles.values()],
+                            )
+                        if touches:
+                            await conn.execute(
+                                """
+                                UPDATE users SET updated_at = GREATEST(users.updated_at, w.ts)
+                                FROM unnest($1::bigint[], $2::timestamptz[]) AS w(uid, ts)
+                                WHERE users.user_id = w.uid
+                                """,
+                                list(touches), list(touches.values()),
+                            )
+            except Exception:
+                DB_STATS.write_behind_failures += 1
+                log.warning(
+                    "user write-behind flush failed, %d profiles / %d touches kept for the next one",
+                    len(profiles), len(touches), exc_info=True,
+                )
+                # put the batch back without overwriting anything newer
+                for uid, prof in profiles.items():
+                    if uid not in self._superseded:
+                        self._profiles.setdefault(uid, prof)
+                for uid, ts in touches.items():
+                    if uid not in self._profiles:
+                        self._touches.setdefault(uid, ts)
+            finally:
+                self._writing = set()
+                self._superseded = set()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(USER_FLUSH_INTERVAL)
+            await self.flush()
+
+    def start(self, pool: "DbPool") -> None:
+        self._pool = pool
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if self._flush_task is not None:
+            await self._flush_task  # flush() handles its own errors
+            self._flush_task = None
+        await self.flush()
+
+
+USER_CACHE = UserCache(USER_CACHE_TTL, USER_CACHE_SIZE)
+USER_WRITES = UserWriteBehind()
+CATALOG = CatalogCache(CATALOG_CACHE_TTL)
+SETTINGS = SettingsCache()
+
+
+# ================== DB HELPERS ==================
+async def upsert_user(pool: DbPool, user) -> None:
+    cached = USER_CACHE.get(user.id)
+    if cached is not None:
+        # row exists -> no round trip, profile/updated_at go out with the next batch
+        if (
+            cached.get("first_name") == user.first_name
+            and cached.get("last_name") == user.last_name
+            and cached.get("username") == user.username
+        ):
+            USER_WRITES.touch(user.id)
+        else:
+            cached.update(first_name=user.first_name, last_name=user.last_name, username=user.username)
+            USER_WRITES.profile(user.id, user.first_name, user.last_name, user.username)
+        return
+    await USER_WRITES.discard(user.id)  # a buffered profile is older than this one
+    row = await pool.fetchrow(
+        PREPARED_SQL["upsert_user"],
         user.id, user.first_name, user.last_name, user.username
     )
+    USER_CACHE.put(user.id, dict(row))
 
 
-async def ensure_user_exists(pool: asyncpg.Pool, user_id: int) -> None:
+async def ensure_user_exists(pool: DbPool, user_id: int) -> None:
     await pool.execute(
         "INSERT INTO users (user_id, updated_at) VALUES ($1, now()) ON CONFLICT (user_id) DO NOTHING",
         user_id
     )
 
 
-async def get_user(pool: asyncpg.Pool, user_id: int) -> Optional[asyncpg.Record]:
-    return await pool.fetchrow("SELECT * FROM users WHERE user_id=$1", user_id)
+async def get_user(pool: DbPool, user_id: int) -> Optional[Dict[str, Any]]:
+    cached = USER_CACHE.get(user_id)
+    if cached is not None:
+        return cached
+    row = await pool.fetchrow(PREPARED_SQL["get_user"], user_id)
+    if not row:
+        return None
+    u = dict(row)
+    if owns_user(user_id):
+        USER_CACHE.put(user_id, u)
+    return u
+
 
+async def user_changed(pool: DbPool, user_id: int) -> None:
+    # a shard worker wrote another shard's user (admin actions): drop that shard's cached row
+    if not owns_user(user_id):
+        await publish_invalidation(pool, "user", user_id)
 
-async def get_user_by_username(pool: asyncpg.Pool, username: str) -> Optional[asyncpg.Record]:
+
+async def get_user_by_username(pool: DbPool, username: str) -> Optional[asyncpg.Record]:
     u = username.strip()
     if u.startswith("@"):
         u = u[1:]
     return await pool.fetchrow("SELECT * FROM users WHERE lower(username)=lower($1)", u)
 
 
-async def set_language(pool: asyncpg.Pool, user_id: int, lang: str) -> None:
-    await pool.execute("UPDATE users SET language=$1, updated_at=now() WHERE user_id=$2", lang, user_id)
+async def set_language(pool: DbPool, user_id: int, lang: str) -> None:
+    await pool.execute(PREPARED_SQL["set_language"], lang, user_id)
+    USER_CACHE.update(user_id, language=lang)
+    USER_WRITES.touch(user_id)
+    await user_changed(pool, user_id)
 
 
-async def set_state(pool: asyncpg.Pool, user_id: int, state: Optional[str]) -> None:
-    await pool.execute("UPDATE users SET state=$1, updated_at=now() WHERE user_id=$2", state, user_id)
+async def set_state(pool: DbPool, user_id: int, state: Optional[str]) -> None:
+    await pool.execute(PREPARED_SQL["set_state"], state, user_id)
+    USER_CACHE.update(user_id, state=state)
+    USER_WRITES.touch(user_id)
+    await user_changed(pool, user_id)
 
 
-async def set_status(pool: asyncpg.Pool, user_id: int, status: str) -> None:
-    await pool.execute("UPDATE users SET status=$1, updated_at=now() WHERE user_id=$2", status, user_id)
+async def set_status(pool: DbPool, user_id: int, status: str) -> None:
+    await pool.execute(PREPARED_SQL["set_status"], status, user_id)
+    USER_CACHE.update(user_id, status=status)
+    USER_WRITES.touch(user_id)
+    await user_changed(pool, user_id)
 
 
-async def add_spent(pool: asyncpg.Pool, user_id: int, add_cents: int) -> None:
-    await pool.execute(
-        "UPDATE users SET spent_cents = spent_cents + $1, updated_at=now() WHERE user_id=$2",
-        int(add_cents), user_id
-    )
-
-
-async def create_claim(pool: asyncpg.Pool, user_id: int, ref_username: str) -> int:
+async def create_claim(pool: DbPool, user_id: int, ref_username: str) -> int:
     row = await pool.fetchrow(
         "INSERT INTO claims (user_id, ref_username, status) VALUES ($1, $2, 'PENDING') RETURNING id",
         user_id, ref_username
@@ -564,130 +1726,547 @@ async def create_claim(pool: asyncpg.Pool, user_id: int, ref_username: str) -> i
     return int(row["id"])
 
 
-async def get_claim(pool: asyncpg.Pool, claim_id: int) -> Optional[asyncpg.Record]:
-    return await pool.fetchrow("SELECT * FROM claims WHERE id=$1", claim_id)
+async def get_claim(pool: DbPool, claim_id: int) -> Optional[asyncpg.Record]:
+    row = await pool.fetchrow("SELECT * FROM claims WHERE id=$1", claim_id)
+    if row is None:
+        row = await pool.fetchrow("SELECT * FROM claims_archive WHERE id=$1", claim_id)
+    return row
 
 
-async def decide_claim(pool: asyncpg.Pool, claim_id: int, decision: str) -> None:
+async def decide_claim(pool: DbPool, claim_id: int, decision: str) -> None:
     await pool.execute("UPDATE claims SET status=$1, decided_at=now() WHERE id=$2", decision, claim_id)
 
 
-async def list_items(pool: asyncpg.Pool) -> List[asyncpg.Record]:
-    return await pool.fetch("SELECT id, name, short_text, price_cents, photo_file_id FROM items ORDER BY id ASC")
+async def list_items(pool: DbPool) -> Tuple[Dict[str, Any], ...]:
+    return (await CATALOG.get(pool)).items
 
 
-async def get_item(pool: asyncpg.Pool, item_id: int) -> Optional[asyncpg.Record]:
-    return await pool.fetchrow("SELECT id, name, short_text, price_cents, photo_file_id FROM items WHERE id=$1", item_id)
+async def get_item(pool: DbPool, item_id: int) -> Optional[Dict[str, Any]]:
+    return (await CATALOG.get(pool)).by_id.get(int(item_id))
 
 
-async def add_item(pool: asyncpg.Pool, name: str, short_text: str, price_cents: int, photo_file_id: str) -> None:
-    await pool.execute(
-        "INSERT INTO items (name, short_text, price_cents, photo_file_id) VALUES ($1, $2, $3, $4)",
-        name, short_text, price_cents, photo_file_id
-    )
+async def add_item(pool: DbPool, name: str, short_text: str, price_cents: int, photo_file_id: str) -> None:
+    try:
+        await pool.execute(
+            "INSERT INTO items (name, short_text, price_cents, photo_file_id) VALUES ($1, $2, $3, $4)",
+            name, short_text, price_cents, photo_file_id
+        )
+    finally:
+        CATALOG.bump()
+    await publish_invalidation(pool, "catalog")
 
 
-async def remove_item(pool: asyncpg.Pool, item_id: int) -> None:
-    await pool.execute("DELETE FROM items WHERE id=$1", item_id)
+async def remove_item(pool: DbPool, item_id: int) -> None:
+    try:
+        await pool.execute("DELETE FROM items WHERE id=$1", item_id)
+    finally:
+        CATALOG.bump()
+    await publish_invalidation(pool, "catalog")
 
 
-async def get_setting(pool: asyncpg.Pool, key: str, default: str) -> str:
-    row = await pool.fetchrow("SELECT value FROM settings WHERE key=$1", key)
+async def get_setting(pool: DbPool, key: str, default: str) -> str:
+    if SETTINGS.loaded:
+        return SETTINGS.values.get(key, default)
+    row = await pool.fetchrow(PREPARED_SQL["get_setting"], key)
     return row["value"] if row else default
 
 
-async def set_setting(pool: asyncpg.Pool, key: str, value: str) -> None:
+async def set_setting(pool: DbPool, key: str, value: str) -> None:
+    # upsert + NOTIFY in one statement; the notification is delivered on commit
     await pool.execute(
-        "INSERT INTO settings (key, value) VALUES ($1, $2) ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value",
-        key, value
+        """
+        WITH up AS (
+          INSERT INTO settings (key, value) VALUES ($1, $2)
+          ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value
+          RETURNING key, value
+        )
+        SELECT pg_notify($3, json_build_object('key', key, 'value', value)::text) FROM up
+        """,
+        key, value, SETTINGS_CHANNEL
     )
+    SETTINGS.values[key] = value
 
 
 async def create_order(
-    pool: asyncpg.Pool,
+    pool: DbPool,
     user_id: int,
-    cart: Dict[int, int],
-    subtotal_cents: int,
+    cart: Dict[int, "CartLine"],
     delivery: bool,
     address: Optional[str],
-) -> int:
+    key: bytes,
+) -> Tuple[int, bool]:
+    # -> (order_id, created); a key seen before returns its order and inserts nothing
+    # snapshot name + price so the order renders without the catalog
+    by_id = (await CATALOG.get(pool)).by_id
+    lines: Dict[str, Dict[str, Any]] = {}
+    for iid, line in cart.items():
+        it = by_id.get(iid)
+        name = it["name"] if it else f"#{iid}"
+        lines[str(iid)] = {"qty": line.qty, "name": name, "price_cents": line.price_cents}
+
+    subtotal_cents = cart_subtotal(cart)
     delivery_fee_cents = 0
     total_cents = subtotal_cents + delivery_fee_cents
+    # the key row claims the order id; on conflict nothing below it runs
     row = await pool.fetchrow(
         """
-        INSERT INTO orders (user_id, cart_json, subtotal_cents, delivery, address, delivery_fee_cents, total_cents, status)
-        VALUES ($1, $2::jsonb, $3, $4, $5, $6, $7, 'NEW')
-        RETURNING id
+        WITH k AS (
+          INSERT INTO checkout_keys (key, user_id, order_id)
+          VALUES ($8, $1, nextval('orders_id_seq'))
+          ON CONFLICT (key) DO NOTHING
+          RETURNING order_id
+        ), o AS (
+          INSERT INTO orders (id, user_id, cart_json, subtotal_cents, delivery, address, delivery_fee_cents, total_cents, status)
+          SELECT k.order_id, $1, $2::jsonb, $3, $4, $5, $6, $7, 'NEW' FROM k
+          RETURNING id, user_id, created_at
+        ), u AS (
+          UPDATE users SET last_order_at = o.created_at FROM o WHERE users.user_id = o.user_id
+        ), n AS (
+          INSERT INTO outbox (kind, order_id) SELECT 'admin_order', id FROM o
+        )
+        SELECT id, created_at FROM o
         """,
-        user_id, json.dumps(cart), subtotal_cents, delivery, address, delivery_fee_cents, total_cents
+        user_id, json.dumps(lines), subtotal_cents, delivery, address, delivery_fee_cents, total_cents, key
     )
-    return int(row["id"])
+    if row is None:
+        # repeat: the first checkout has committed (ON CONFLICT waited for it)
+        order_id = await pool.fetchval("SELECT order_id FROM checkout_keys WHERE key=$1", key)
+        return int(order_id), False
+    USER_CACHE.update(user_id, last_order_at=row["created_at"])
+    OUTBOX.wake()
+    return int(row["id"]), True
+
+
+async def get_order(pool: DbPool, order_id: int) -> Optional[asyncpg.Record]:
+    row = await pool.fetchrow(PREPARED_SQL["get_order"], order_id)
+    if row is None:
+        row = await pool.fetchrow(PREPARED_SQL["get_archived_order"], order_id)
+    return row
 
 
-async def get_order(pool: asyncpg.Pool, order_id: int) -> Optional[asyncpg.Record]:
-    return await pool.fetchrow("SELECT * FROM orders WHERE id=$1", order_id)
+async def get_admin_order(pool: DbPool, order_id: int) -> Optional[asyncpg.Record]:
+    row = await pool.fetchrow(PREPARED_SQL["get_admin_order"], order_id)
+    if row is None:
+        row = await pool.fetchrow(PREPARED_SQL["get_archived_admin_order"], order_id)
+    return row
 
 
-async def set_order_fee(pool: asyncpg.Pool, order_id: int, fee_cents: int) -> None:
+async def set_order_fee(pool: DbPool, order_id: int, fee_cents: int) -> None:
     await pool.execute(
         """
-        UPDATE orders
-        SET delivery_fee_cents=$1,
-            total_cents = subtotal_cents + $1
-        WHERE id=$2
+        WITH o AS (
+          UPDATE orders
+          SET delivery_fee_cents=$1,
+              total_cents = subtotal_cents + $1
+          WHERE id=$2
+          RETURNING id
+        )
+        INSERT INTO outbox (kind, order_id) SELECT 'admin_order', id FROM o
         """,
         int(fee_cents), int(order_id)
     )
+    OUTBOX.wake()
+
+
+async def set_order_status(pool: DbPool, order_id: int, status: str, notify: Sequence[str] = ()) -> bool:
+    # False if the order is missing, already in that status or already DONE/CANCELLED;
+    # notify: outbox kinds to queue if the status actually changed
+    row = await pool.fetchrow(PREPARED_SQL["set_order_status"], int(order_id), status, list(notify))
+    if row is None:
+        return False
+    if notify:
+        OUTBOX.wake()
+    if row["orders_done"] is not None:
+        USER_CACHE.update(
+            int(row["user_id"]),
+            orders_done=int(row["orders_done"]),
+            orders_cancelled=int(row["orders_cancelled"]),
+        )
+        USER_WRITES.touch(int(row["user_id"]))
+        await user_changed(pool, int(row["user_id"]))
+    return True
 
 
-async def mark_order_done(pool: asyncpg.Pool, order_id: int) -> None:
-    await pool.execute("UPDATE orders SET status='DONE' WHERE id=$1", int(order_id))
+async def complete_order(pool: DbPool, order_id: int) -> Optional[asyncpg.Record]:
+    # None if the order is missing or already DONE/CANCELLED
+    row = await pool.fetchrow(PREPARED_SQL["complete_order"], int(order_id))
+    if row and row["spent_cents"] is not None:
+        user_id = int(row["user_id"])
+        USER_CACHE.update(user_id, spent_cents=int(row["spent_cents"]), orders_done=int(row["orders_done"]))
+        USER_WRITES.touch(user_id)
+        await user_changed(pool, user_id)
+    if row:
+        OUTBOX.wake()
+    return row
 
 
-async def cancel_order(pool: asyncpg.Pool, order_id: int) -> None:
-    await pool.execute("UPDATE orders SET status='CANCELLED' WHERE id=$1", int(order_id))
+async def cancel_order(pool: DbPool, order_id: int) -> bool:
+    # False if the order was completed or cancelled first
+    return await set_order_status(pool, order_id, "CANCELLED", ("order_cancelled", "admin_order"))
 
 
-async def save_admin_message_id(pool: asyncpg.Pool, order_id: int, message_id: int) -> None:
+async def save_admin_message_id(pool: DbPool, order_id: int, message_id: int) -> None:
     await pool.execute("UPDATE orders SET admin_message_id=$1 WHERE id=$2", int(message_id), int(order_id))
 
 
-async def count_orders_done(pool: asyncpg.Pool, user_id: int) -> int:
-    row = await pool.fetchrow("SELECT COUNT(*) AS c FROM orders WHERE user_id=$1 AND status='DONE'", user_id)
-    return int(row["c"] if row else 0)
+async def list_user_active_orders(pool: DbPool, user_id: int) -> List[asyncpg.Record]:
+    # active = not DONE, not CANCELLED
+    return await pool.fetch(PREPARED_SQL["list_user_active_orders"], user_id)
+
+
+async def list_orders_page(
+    pool: DbPool,
+    status: str,
+    older_than: Optional[int] = None,
+    newer_than: Optional[int] = None,
+) -> Tuple[List[asyncpg.Record], bool, bool]:
+    # one page newest first + (has_newer, has_older); the cursor id itself proves the other side exists
+    limit = ORDERS_PAGE_SIZE + 1
+    if newer_than is not None:
+        rows = await pool.fetch(PREPARED_SQL["list_orders_newer"], status, limit, newer_than)
+        more = len(rows) > ORDERS_PAGE_SIZE
+        return list(reversed(rows[:ORDERS_PAGE_SIZE])), more, True
+    if older_than is not None:
+        rows = await pool.fetch(PREPARED_SQL["list_orders_older"], status, limit, older_than)
+        return rows[:ORDERS_PAGE_SIZE], True, len(rows) > ORDERS_PAGE_SIZE
+    rows = await pool.fetch(PREPARED_SQL["list_orders_first"], status, limit)
+    return rows[:ORDERS_PAGE_SIZE], False, len(rows) > ORDERS_PAGE_SIZE
+
+
+# ================== SESSIONS ==================
+class CartLine(NamedTuple):
+    qty: int
+    price_cents: int  # unit price when the line was set, valid for buy["prices"]
+
+
+CART_FORMAT = 2
+CART_LINE = struct.Struct("<IHI")  # item_id, qty, price_cents
+CART_LINE_V1 = struct.Struct("<IH")  # item_id, qty
+
+
+def encode_cart(cart: Dict[int, CartLine]) -> bytes:
+    return bytes([CART_FORMAT]) + b"".join(CART_LINE.pack(iid, *line) for iid, line in cart.items())
+
+
+def decode_cart(raw: bytes) -> Dict[int, CartLine]:
+    if not raw:
+        return {}
+    if raw[0] == CART_FORMAT:
+        return {iid: CartLine(qty, price) for iid, qty, price in CART_LINE.iter_unpack(raw[1:])}
+    if raw[0] == 1:
+        # no prices yet: such sessions have no buy["prices"], so the next reprice_cart fills them
+        return {iid: CartLine(qty, 0) for iid, qty in CART_LINE_V1.iter_unpack(raw[1:])}
+    return {}
+
+
+def encode_session(user_data: Dict[str, Any]) -> Tuple[Optional[bytes], str]:
+    data = dict(user_data)
+    cart_raw = None
+    buy = data.get("buy")
+    if isinstance(buy, dict):
+        cart_raw = encode_cart(buy.get("cart") or {})
+        data["buy"] = {k: v for k, v in buy.items() if k != "cart"}
+    return cart_raw, json.dumps(data)
+
+
+def decode_session(cart_raw: Optional[bytes], data: Any) -> Dict[str, Any]:
+    user_data = json.loads(data) if isinstance(data, str) else dict(data or {})
+    if cart_raw is not None:
+        buy = user_data.get("buy")
+        if not isinstance(buy, dict):
+            buy = user_data["buy"] = {}
+        buy["cart"] = decode_cart(cart_raw)
+    return user_data
+
+
+class PgPersistence(BasePersistence):
+    # Stores user_data only. PTB hands us dirty users every update_interval;
+    # they are buffered and written as one batch, and idle sessions expire.
+    def __init__(self) -> None:
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=SESSION_FLUSH_INTERVAL,
+        )
+        self.pool: Optional[DbPool] = None  # set in on_startup
+        self._dirty: Dict[int, Dict[str, Any]] = {}
+        self._dropped: set = set()
+        self._stored: set = set()  # user_ids that have a row
+        self._touched: Dict[int, float] = {}
+        self._write_task: Optional[asyncio.Task] = None
+
+    async def get_user_data(self) -> Dict[int, Dict[str, Any]]:
+        # runs in Application.initialize, before on_startup -> own connection
+        conn = await asyncpg.connect(DATABASE_URL)
+        try:
+            rows = await conn.fetch(
+                "SELECT user_id, cart, data FROM sessions WHERE updated_at > now() - make_interval(secs => $1)",
+                SESSION_TTL,
+            )
+        finally:
+            await conn.close()
+        now = time.monotonic()
+        out: Dict[int, Dict[str, Any]] = {}
+        for r in rows:
+            uid = int(r["user_id"])
+            if not owns_user(uid):
+                continue  # another shard's session: loading it here would let this sweep delete it
+            out[uid] = decode_session(r["cart"], r["data"])
+            self._stored.add(uid)
+            self._touched[uid] = now
+        return out
+
+    async def update_user_data(self, user_id: int, data: Dict[str, Any]) -> None:
+        self._touched[user_id] = time.monotonic()
+        if data:
+            self._dirty[user_id] = data
+            self._dropped.discard(user_id)
+        elif user_id in self._stored:
+            self._dropped.add(user_id)
+            self._dirty.pop(user_id, None)
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._touched.pop(user_id, None)
+        self._dirty.pop(user_id, None)
+        if user_id in self._stored:
+            self._dropped.add(user_id)
+        self._schedule_write()
+
+    def _schedule_write(self) -> None:
+        # PTB calls update_user_data for all dirty users at once; write them together right after
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.get_running_loop().create_task(self._write_soon())
+
+    async def _write_soon(self) -> None:
+        await asyncio.sleep(0)
+        # entries buffered while a batch was in flight go out in the next one
+        while (self._dirty or self._dropped) and await self._write():
+            pass
+
+    async def _write(self) -> bool:
+        if self.pool is None:
+            return False
+        if not self._dirty and not self._dropped:
+            return True
+        dirty, self._dirty = self._dirty, {}
+        dropped, self._dropped = self._dropped, set()
+        uids, carts, datas = [], [], []
+        for uid, user_data in dirty.items():
+            cart_raw, data = encode_session(user_data)
+            uids.append(uid)
+            carts.append(cart_raw)
+            datas.append(data)
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    if uids:
+                        await conn.execute(
+                            """
+                            INSERT INTO sessions (user_id, cart, data, updated_at)
+                            SELECT u, c, d, now() FROM unnest($1::bigint[], $2::bytea[], $3::jsonb[]) AS s(u, c, d)
+                            ON CONFLICT (user_id) DO UPDATE
+                              SET cart=EXCLUDED.cart, data=EXCLUDED.data, updated_at=now()
+                            """,
+                            uids, carts, datas
+                        )
+                    if dropped:
+                        await conn.execute("DELETE FROM sessions WHERE user_id = ANY($1::bigint[])", list(dropped))
+        except Exception:
+            # keep the batch for the next run, newer data wins
+            for uid, user_data in dirty.items():
+                self._dirty.setdefault(uid, user_data)
+            self._dropped |= dropped - set(self._dirty)
+            return False
+        self._stored.update(uids)
+        self._stored -= dropped
+        return True
+
+    async def flush(self) -> None:
+        if self._write_task is not None:
+            with contextlib.suppress(Exception):
+                await self._write_task
+        await self._write()
+
+    async def sweep(self, app: Application) -> None:
+        # forget sessions idle for SESSION_TTL: in memory here, in the table (all processes) via SQL
+        while True:
+            await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+            cutoff = time.monotonic() - SESSION_TTL
+            for uid in [uid for uid in app.user_data if self._touched.get(uid, 0) < cutoff]:
+                app.drop_user_data(uid)
+            if self.pool is not None:
+                with contextlib.suppress(Exception):
+                    await self.pool.execute(
+                        "DELETE FROM sessions WHERE updated_at < now() - make_interval(secs => $1)",
+                        SESSION_TTL,
+                    )
+                # a cart older than this cannot come back, so neither can its checkout
+                with contextlib.suppress(Exception):
+                    await self.pool.execute(
+                        "DELETE FROM checkout_keys WHERE created_at < now() - make_interval(secs => $1)",
+                        SESSION_TTL,
+                    )
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
 
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
 
-async def list_user_active_orders(pool: asyncpg.Pool, user_id: int) -> List[asyncpg.Record]:
-    # active = not DONE, not CANCELLED
-    return await pool.fetch(
-        "SELECT id, status, total_cents FROM orders WHERE user_id=$1 AND status NOT IN ('DONE','CANCELLED') ORDER BY id DESC",
-        user_id
-    )
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Any, Any]:
+        return {}
+
+    async def update_conversation(self, name: str, key: Any, new_state: Optional[object]) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        pass
+
+    async def update_bot_data(self, data: Any) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: Any) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Any) -> None:
+        pass
+
+
+# ================== ARCHIVE ==================
+async def maintain_partitions(pool: DbPool) -> None:
+    # this month's and next month's partitions always exist before inserts need them
+    now = datetime.datetime.now(datetime.timezone.utc)
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", PARTITIONS_LOCK_ID)
+            for table in PARTITIONED_TABLES:
+                await ensure_month_partitions(conn, table, now, next_month(month_start(now)))
+
+
+async def archive_closed_rows(pool: DbPool, table: str) -> int:
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=ARCHIVE_AFTER_DAYS)
+    statuses = list(ARCHIVE_STATUSES[table])
+    cols = PARTITIONED_COLUMNS[table]
+    async with pool.acquire() as conn:
+        oldest = await conn.fetchval(
+            f"SELECT min(created_at) FROM {table} WHERE status = ANY($1::text[]) AND created_at < $2",
+            statuses, cutoff,
+        )
+        if oldest is None:
+            return 0
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", PARTITIONS_LOCK_ID)
+            await ensure_month_partitions(conn, f"{table}_archive", oldest, cutoff)
+
+    moved_total = 0
+    while True:
+        # short transactions: each batch is deleted and inserted atomically
+        moved = await pool.fetchval(
+            f"""
+            WITH moved AS (
+              DELETE FROM {table} WHERE (id, created_at) IN (
+                SELECT id, created_at FROM {table}
+                WHERE status = ANY($1::text[]) AND created_at < $2
+                ORDER BY created_at LIMIT $3
+              )
+              RETURNING {cols}
+            ), ins AS (
+              INSERT INTO {table}_archive ({cols}) SELECT {cols} FROM moved RETURNING 1
+            )
+            SELECT count(*) FROM ins
+            """,
+            statuses, cutoff, ARCHIVE_BATCH,
+        )
+        moved_total += int(moved)
+        if moved < ARCHIVE_BATCH:
+            return moved_total
+
+
+async def drop_empty_partitions(pool: DbPool, table: str) -> None:
+    # archived-out months leave empty hot partitions; dropping them keeps per-user scans short
+    keep_from = month_start(datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=ARCHIVE_AFTER_DAYS))
+    async with pool.acquire() as conn:
+        names = await conn.fetch(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = $1::regclass",
+            table,
+        )
+        for (name,) in names:
+            try:
+                month = datetime.datetime.strptime(name[len(table) + 1:], "%Y_%m").replace(tzinfo=datetime.timezone.utc)
+            except ValueError:
+                continue
+            if month >= keep_from:
+                continue
+            try:
+                async with conn.transaction():
+                    # dropping a partition locks the parent: give up rather than queue behind traffic
+                    await conn.execute("SET LOCAL lock_timeout = '2s'")
+                    if not await conn.fetchval(f"SELECT EXISTS (SELECT 1 FROM {name})"):
+                        await conn.execute(f"DROP TABLE {name}")
+            except asyncpg.PostgresError:
+                pass
+
+
+async def partition_maintenance(pool: DbPool) -> None:
+    while True:
+        await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
+        with contextlib.suppress(Exception):
+            await maintain_partitions(pool)
+            for table in PARTITIONED_TABLES:
+                await archive_closed_rows(pool, table)
+                await drop_empty_partitions(pool, table)
 
 
 # ================== LIFECYCLE ==================
 async def on_startup(app: Application) -> None:
-    pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5)
+    pool = await DbPool.create(DATABASE_URL)
     app.bot_data["db_pool"] = pool
-    async with pool.acquire() as conn:
-        await conn.execute(CREATE_USERS_SQL)
-        for q in ALTER_USERS_SQL:
-            await conn.execute(q)
-        await conn.execute(CREATE_CLAIMS_SQL)
-        await conn.execute(CREATE_SETTINGS_SQL)
-        await conn.execute(CREATE_ITEMS_SQL)
-        for q in ALTER_ITEMS_SQL:
-            await conn.execute(q)
-        await conn.execute(CREATE_ORDERS_SQL)
-        for q in ALTER_ORDERS_SQL:
-            await conn.execute(q)
-
-        cur = await conn.fetchrow("SELECT value FROM settings WHERE key='operator_online'")
-        if not cur:
-            await conn.execute("INSERT INTO settings (key, value) VALUES ('operator_online', 'true')")
+    warm_keyboards()
+    await maintain_partitions(pool)
+    app.bot_data["partition_maintenance"] = asyncio.get_running_loop().create_task(partition_maintenance(pool))
+    await SETTINGS.load(pool)
+    SETTINGS.start(pool, DATABASE_URL)
+    USER_WRITES.start(pool)
+    OUTBOX.start(pool, app.bot, deliver=delivers_outbox())
+
+    if isinstance(app.persistence, PgPersistence):
+        app.persistence.pool = pool
+        app.bot_data["session_sweeper"] = asyncio.get_running_loop().create_task(app.persistence.sweep(app))
+
+    metrics_server = await start_metrics_server(app)
+    if metrics_server:
+        app.bot_data["metrics_server"] = metrics_server
+
+
+async def on_stop(app: Application) -> None:
+    # before Application.shutdown closes the bot the outbox sends through
+    await OUTBOX.stop()
 
 
 async def on_shutdown(app: Application) -> None:
+    for name in ("session_sweeper", "partition_maintenance"):
+        task = app.bot_data.pop(name, None)
+        if task:
+            task.cancel()
+    metrics_server = app.bot_data.pop("metrics_server", None)
+    if metrics_server:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    await SETTINGS.stop()
+    await USER_WRITES.stop()
     pool = app.bot_data.get("db_pool")
     if pool:
         await pool.close()
@@ -702,89 +2281,175 @@ def reset_additem(context: ContextTypes.DEFAULT_TYPE) -> None:
     context.user_data.pop("additem", None)
 
 
-def get_cart(context: ContextTypes.DEFAULT_TYPE) -> Dict[int, int]:
+def get_buy(context: ContextTypes.DEFAULT_TYPE) -> Dict[str, Any]:
+    # user_data["buy"]: cart {item_id: CartLine} (built here and restored typed by decode_cart),
+    # subtotal_cents, prices (CatalogSnapshot.price_version of the line prices), nonce (one per cart)
     buy = context.user_data.get("buy")
-    if not buy or not isinstance(buy, dict):
-        buy = {"cart": {}, "subtotal_cents": 0}
-        context.user_data["buy"] = buy
-    cart = buy.get("cart")
-    if not cart or not isinstance(cart, dict):
+    if not isinstance(buy, dict):
+        buy = context.user_data["buy"] = {}
+    if not isinstance(buy.get("cart"), dict):
         buy["cart"] = {}
-    cart2: Dict[int, int] = {}
-    for k, v in buy["cart"].items():
+        buy["subtotal_cents"] = 0
+    if "nonce" not in buy:
+        buy["nonce"] = os.urandom(8).hex()
+    return buy
+
+
+def cart_subtotal(cart: Dict[int, CartLine]) -> int:
+    return sum(line.qty * line.price_cents for line in cart.values())
+
+
+def reprice_cart(buy: Dict[str, Any], catalog: "CatalogSnapshot") -> bool:
+    # bring the line prices to this catalog; True if a line changed or was dropped
+    if buy.get("prices") == catalog.price_version:
+        return False
+    cart: Dict[int, CartLine] = buy["cart"]
+    changed = False
+    for iid, line in list(cart.items()):
+        it = catalog.by_id.get(iid)
+        if it is None:
+            del cart[iid]
+            changed = True
+        elif int(it["price_cents"]) != line.price_cents:
+            cart[iid] = line._replace(price_cents=int(it["price_cents"]))
+            changed = True
+    buy["prices"] = catalog.price_version
+    buy["subtotal_cents"] = cart_subtotal(cart)
+    return changed
+
+
+def checkout_key(user_id: int, buy: Dict[str, Any]) -> bytes:
+    # same user + same cart (nonce, lines, prices) = same checkout
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{user_id}:{buy['nonce']}:".encode())
+    h.update(encode_cart(dict(sorted(buy["cart"].items()))))
+    return h.digest()
+
+
+# ================== STATIC PHOTOS ==================
+# path -> (mtime_ns, size, sha256) so the file is only re-hashed when it changes on disk
+_photo_hashes: Dict[str, Tuple[int, int, str]] = {}
+# path -> (sha256, telegram file_id), mirrored in settings as photo:<path>
+_photo_file_ids: Dict[str, Tuple[str, str]] = {}
+
+
+def photo_hash(path: str) -> str:
+    st = os.stat(path)  # raises FileNotFoundError like open() did
+    cached = _photo_hashes.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    _photo_hashes[path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+
+async def get_photo_file_id(pool: DbPool, path: str, digest: str) -> Optional[str]:
+    cached = _photo_file_ids.get(path)
+    if cached is None:
+        value = await get_setting(pool, f"photo:{path}", "")
+        stored_hash, _, file_id = value.partition(":")
+        if not file_id:
+            return None
+        cached = _photo_file_ids[path] = (stored_hash, file_id)
+    return cached[1] if cached[0] == digest else None
+
+
+async def save_photo_file_id(pool: DbPool, path: str, digest: str, file_id: str) -> None:
+    _photo_file_ids[path] = (digest, file_id)
+    await set_setting(pool, f"photo:{path}", f"{digest}:{file_id}")
+
+
+# BadRequest texts meaning the stored file_id is unusable; anything else (a caption
+# that fails to parse, chat not found) would fail the upload the same way
+STALE_FILE_ID_ERRORS = ("wrong file identifier", "wrong remote file identifier", "file reference expired", "wrong padding")
+
+
+async def send_static_photo(context: ContextTypes.DEFAULT_TYPE, chat_id: int, path: str, **kwargs: Any) -> None:
+    # upload once, then send by file_id; re-upload when the file content changes
+    pool: DbPool = context.application.bot_data["db_pool"]
+    digest = photo_hash(path)
+    file_id = await get_photo_file_id(pool, path, digest)
+    if file_id:
         try:
-            cart2[int(k)] = int(v)
-        except Exception:
-            pass
-    buy["cart"] = cart2
-    return cart2
-
+            await context.bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+            return
+        except BadRequest as e:
+            if not any(err in str(e).lower() for err in STALE_FILE_ID_ERRORS):
+                raise
+            _photo_file_ids.pop(path, None)  # file_id no longer valid -> upload again
 
-async def recompute_subtotal(pool: asyncpg.Pool, cart: Dict[int, int]) -> int:
-    if not cart:
-        return 0
-    item_ids = list(cart.keys())
-    rows = await pool.fetch("SELECT id, price_cents FROM items WHERE id = ANY($1::int[])", item_ids)
-    price_map = {int(r["id"]): int(r["price_cents"]) for r in rows}
-    subtotal = 0
-    for iid, qty in cart.items():
-        subtotal += price_map.get(iid, 0) * max(qty, 0)
-    return subtotal
+    with open(path, "rb") as f:
+        sent = await context.bot.send_photo(
+            chat_id=chat_id,
+            photo=InputFile(f, filename=os.path.basename(path)),
+            **kwargs,
+        )
+    if sent.photo:
+        await save_photo_file_id(pool, path, digest, sent.photo[-1].file_id)
 
 
 # ================== HOME ==================
 async def send_home(chat_id: int, lang: str, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        with open(HOME_IMAGE_PATH, "rb") as f:
-            await context.bot.send_photo(
-                chat_id=chat_id,
-                photo=InputFile(f, filename="home.png"),
-                caption=t(lang, "safe_welcome"),
-                reply_markup=kb_safe_menu(lang),
-                parse_mode="Markdown",
-            )
+        await send_static_photo(
+            context,
+            chat_id,
+            HOME_IMAGE_PATH,
+            caption=t(lang, Msg.SAFE_WELCOME),
+            reply_markup=kb_safe_menu(lang),
+            parse_mode="Markdown",
+        )
     except FileNotFoundError:
         await context.bot.send_message(
             chat_id=chat_id,
-            text=t(lang, "safe_welcome"),
+            text=t(lang, Msg.SAFE_WELCOME),
             reply_markup=kb_safe_menu(lang),
             parse_mode="Markdown",
-        )
-
-
-# ================== ADMIN ORDER MESSAGE ==================
-async def build_admin_order_text(pool: asyncpg.Pool, order_id: int) -> str:
-    order = await get_order(pool, order_id)
-    if not order:
-        return "Order not found."
+        )
 
-    user_id = int(order["user_id"])
-    u = await get_user(pool, user_id)
-    uname = f"@{u['username']}" if u and u.get("username") else "(no username)"
-    name = ((u.get("first_name") or "") + " " + (u.get("last_name") or "")).strip() if u else "(no name)"
 
-    cart = order["cart_json"]
+# ================== ADMIN ORDER MESSAGE ==================
+async def order_item_lines(pool: DbPool, cart: Any) -> List[str]:
+    # orders store {item_id: {"qty", "name", "price_cents"}}; older ones only {item_id: qty}
     if isinstance(cart, str):
         try:
             cart = json.loads(cart)
         except Exception:
             cart = {}
 
-    items = await list_items(pool)
-    item_map = {int(it["id"]): it for it in items}
-
+    item_map: Optional[Dict[int, Dict[str, Any]]] = None
     lines = []
     for k, v in (cart or {}).items():
         try:
             iid = int(k)
-            qty = int(v)
+            if isinstance(v, dict):
+                qty = int(v["qty"])
+                name = str(v["name"])
+                price_cents = int(v["price_cents"])
+            else:
+                qty = int(v)
+                if item_map is None:
+                    item_map = (await CATALOG.get(pool)).by_id
+                it = item_map.get(iid)
+                if not it:
+                    continue
+                name = it["name"]
+                price_cents = int(it["price_cents"])
         except Exception:
             continue
-        it = item_map.get(iid)
-        if not it:
-            continue
-        price = cents_to_eur_str(int(it["price_cents"]))
-        lines.append(f"- {it['name']} x{qty} ({price})")
+        lines.append(f"- {name} x{qty} ({cents_to_eur_str(price_cents)})")
+    return lines
+
+
+async def render_admin_order_text(pool: DbPool, order: asyncpg.Record) -> str:
+    # order = row from get_admin_order (order joined with its customer)
+    order_id = int(order["id"])
+    user_id = int(order["user_id"])
+    uname = f"@{order['username']}" if order["username"] else "(no username)"
+    name = ((order["first_name"] or "") + " " + (order["last_name"] or "")).strip()
+
+    lines = await order_item_lines(pool, order["cart_json"])
 
     delivery = bool(order["delivery"])
     addr = order["address"] or "-"
@@ -809,47 +2474,266 @@ async def build_admin_order_text(pool: asyncpg.Pool, order_id: int) -> str:
     )
 
 
-async def notify_admin_order(pool: asyncpg.Pool, context: ContextTypes.DEFAULT_TYPE, order_id: int) -> None:
-    text = await build_admin_order_text(pool, order_id)
-    sent = await context.bot.send_message(
+async def build_admin_order_text(pool: DbPool, order_id: int) -> str:
+    order = await get_admin_order(pool, order_id)
+    if not order:
+        return "Order not found."
+    return await render_admin_order_text(pool, order)
+
+
+async def notify_admin_order(
+    pool: DbPool,
+    bot: Bot,
+    order_id: int,
+    order: Optional[asyncpg.Record] = None,
+) -> int:
+    if order is None:
+        order = await get_admin_order(pool, order_id)
+    text = await render_admin_order_text(pool, order) if order else "Order not found."
+    sent = await bot.send_message(
         chat_id=ADMIN_ID_INT,
         text=text,
         reply_markup=kb_admin_order(order_id),
     )
     await save_admin_message_id(pool, order_id, sent.message_id)
+    return sent.message_id
 
 
-async def refresh_admin_order_message(pool: asyncpg.Pool, context: ContextTypes.DEFAULT_TYPE, order_id: int) -> None:
-    order = await get_order(pool, order_id)
-    if not order:
-        return
+_ADMIN_CARD_LOCKS: Dict[int, asyncio.Lock] = {}
+_ADMIN_CARD_WAITERS: Dict[int, int] = {}
 
-    mid = order["admin_message_id"]
-    if not mid:
-        # cannot edit -> just send new
-        await notify_admin_order(pool, context, order_id)
-        return
 
-    text = await build_admin_order_text(pool, order_id)
+@contextlib.asynccontextmanager
+async def admin_card_turn(order_id: int):
+    # one card update per order at a time; the admin chat has one sending process
+    # (see delivers_outbox), so a lock here is enough for a refresh to edit the card
+    # an earlier one posted instead of posting another
+    lock = _ADMIN_CARD_LOCKS.get(order_id)
+    if lock is None:
+        lock = _ADMIN_CARD_LOCKS[order_id] = asyncio.Lock()
+    _ADMIN_CARD_WAITERS[order_id] = _ADMIN_CARD_WAITERS.get(order_id, 0) + 1
+    try:
+        async with lock:
+            yield
+    finally:
+        left = _ADMIN_CARD_WAITERS[order_id] - 1
+        if left:
+            _ADMIN_CARD_WAITERS[order_id] = left
+        else:
+            del _ADMIN_CARD_WAITERS[order_id]
+            del _ADMIN_CARD_LOCKS[order_id]
 
-    # if DONE or CANCELLED -> remove buttons
-    st = str(order["status"])
-    markup = None if st in ("DONE", "CANCELLED") else kb_admin_order(order_id)
 
-    try:
-        await context.bot.edit_message_text(
-            chat_id=ADMIN_ID_INT,
-            message_id=int(mid),
-            text=text,
-            reply_markup=markup,
+async def refresh_admin_order_message(pool: DbPool, bot: Bot, order_id: int) -> Optional[int]:
+    # -> id of the card now showing the order; Telegram errors other than an
+    # uneditable card propagate (editing again is safe, the outbox retries)
+    async with admin_card_turn(order_id):
+        order = await get_admin_order(pool, order_id)
+        if not order:
+            return None
+
+        mid = order["admin_message_id"]
+        if not mid:
+            # cannot edit -> just send new
+            return await notify_admin_order(pool, bot, order_id, order)
+
+        text = await render_admin_order_text(pool, order)
+
+        # if DONE or CANCELLED -> remove buttons
+        st = str(order["status"])
+        markup = None if st in ("DONE", "CANCELLED") else kb_admin_order(order_id)
+
+        try:
+            await bot.edit_message_text(
+                chat_id=ADMIN_ID_INT,
+                message_id=int(mid),
+                text=text,
+                reply_markup=markup,
+            )
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                # message deleted / too old to edit -> send a new one
+                return await notify_admin_order(pool, bot, order_id, order)
+        return int(mid)
+
+
+# ================== OUTBOX ==================
+class OutboxRow(NamedTuple):
+    id: int
+    kind: str
+    order_id: int
+    attempts: int
+
+
+ADMIN_OUTBOX_KINDS = ("admin_order", "order_cancelled")  # kinds sent to the admin chat
+
+
+class OutboxWorker:
+    # Delivers the outbox table: claims due rows in batches (leased with
+    # next_attempt_at so several processes can drain it), sends them, and records
+    # each message id or a retry with exponential backoff as soon as it is known.
+    # The lease covers a whole batch going to one chat at SEND_CHAT_RATE, which is
+    # what admin rows do; with BOT_MODE=shard only the admin shard delivers (see
+    # delivers_outbox), so its SendScheduler is the admin chat's only sender.
+    # Woken right after a commit (over CACHE_CHANNEL from the other shards), polls
+    # every OUTBOX_POLL_INTERVAL for the rest.
+    LEASE = OUTBOX_LEASE + OUTBOX_BATCH / SEND_CHAT_RATE
+
+    def __init__(self) -> None:
+        self._pool: Optional["DbPool"] = None
+        self._bot: Optional[Bot] = None
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._pruned_at = 0.0
+
+    def wake(self, publish: bool = True) -> None:
+        if self._task is not None or self._pool is None:
+            self._wakeup.set()
+        elif publish:
+            # rows committed here, delivered by another process
+            task = asyncio.get_running_loop().create_task(self._wake_deliverer())
+            _NOTIFY_TASKS.add(task)
+            task.add_done_callback(_NOTIFY_TASKS.discard)
+
+    async def _wake_deliverer(self) -> None:
+        try:
+            await publish_invalidation(self._pool, "outbox")
+        except Exception:
+            log.warning("outbox wake-up not published, rows go out on the next poll", exc_info=True)
+
+    async def _claim(self) -> List[OutboxRow]:
+        rows = await self._pool.fetch(
+            """
+            UPDATE outbox SET attempts = attempts + 1, next_attempt_at = now() + make_interval(secs => $2)
+            WHERE id IN (
+              SELECT id FROM outbox WHERE status = 'PENDING' AND next_attempt_at <= now()
+              ORDER BY id LIMIT $1 FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, kind, order_id, attempts
+            """,
+            OUTBOX_BATCH, self.LEASE,
         )
-    except Exception:
-        await notify_admin_order(pool, context, order_id)
+        return sorted((OutboxRow(*r) for r in rows), key=lambda r: r.id)
+
+    async def _deliver(self, kind: str, order_id: int) -> Optional[int]:
+        # -> Telegram message id
+        pool, bot = self._pool, self._bot
+        if kind == "admin_order":
+            return await refresh_admin_order_message(pool, bot, order_id)
+        order = await get_order(pool, order_id)
+        if order is None:
+            return None
+        if kind == "order_done":
+            u = await get_user(pool, int(order["user_id"]))
+            lang = (u["language"] if u and u.get("language") else DEFAULT_LANG)
+            text = f"{t(lang, Msg.ORDER_COMPLETED_USER)}\nTOTAL: {cents_to_eur_str(int(order['total_cents']))}"
+            return (await bot.send_message(chat_id=int(order["user_id"]), text=text)).message_id
+        if kind == "order_cancelled":
+            text = f"Order #{order_id} {t(DEFAULT_LANG, Msg.ORDER_CANCELLED_ADMIN)}"
+            return (await bot.send_message(chat_id=ADMIN_ID_INT, text=text)).message_id
+        raise ValueError(f"unknown outbox kind {kind!r}")
+
+    async def _send(self, rows: List[OutboxRow]) -> Optional[float]:
+        # rows share kind + order_id: one delivery covers them (e.g. fee set twice before a send)
+        # -> retry delay if they stay PENDING
+        status, mid, delay, error = "SENT", None, 0.0, None
+        try:
+            mid = await self._deliver(rows[0].kind, rows[0].order_id)
+        except (Forbidden, BadRequest, ValueError) as e:
+            # bot blocked by the user, chat gone, bad payload: retrying will not help
+            status, error = "FAILED", str(e)
+        except Exception as e:
+            status, error = "PENDING", f"{type(e).__name__}: {e}"
+            attempts = max(r.attempts for r in rows)
+            delay = min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_BASE * 2 ** (attempts - 1))
+            if isinstance(e, RetryAfter):
+                delay = max(delay, float(e.retry_after))
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                status = "FAILED"
+        # attempts guard: a row whose lease ran out and was claimed again belongs to that claim
+        await self._pool.execute(
+            """
+            UPDATE outbox o SET
+              status = $2,
+              message_id = COALESCE($3, o.message_id),
+              sent_at = CASE WHEN $2 = 'SENT' THEN now() END,
+              next_attempt_at = now() + make_interval(secs => $4),
+              last_error = $5
+            FROM unnest($1::bigint[], $6::int[]) AS r(id, attempts)
+            WHERE o.id = r.id AND o.attempts = r.attempts
+            """,
+            [r.id for r in rows], status, mid, delay, error, [r.attempts for r in rows],
+        )
+        return delay if status == "PENDING" else None
+
+    async def _send_in_turn(self, groups: List[List[OutboxRow]]) -> List[Optional[float]]:
+        # one chat: its pace is SEND_CHAT_RATE anyway, and the lease assumes one send at a time
+        return [await self._send(g) for g in groups]
+
+    async def drain(self) -> float:
+        # -> seconds until the earliest retry scheduled here (OUTBOX_POLL_INTERVAL if none)
+        next_retry = OUTBOX_POLL_INTERVAL
+        while True:
+            rows = await self._claim()
+            if not rows:
+                return next_retry
+            groups: Dict[Tuple[str, int], List[OutboxRow]] = {}
+            for r in rows:
+                groups.setdefault((r.kind, r.order_id), []).append(r)
+            # user chats go out concurrently, SendScheduler paces them per chat
+            admin = [g for key, g in groups.items() if key[0] in ADMIN_OUTBOX_KINDS]
+            users = [g for key, g in groups.items() if key[0] not in ADMIN_OUTBOX_KINDS]
+            admin_delays, *user_delays = await asyncio.gather(self._send_in_turn(admin), *(self._send(g) for g in users))
+            next_retry = min([next_retry] + [d for d in admin_delays + user_delays if d is not None])
+            if len(rows) < OUTBOX_BATCH:
+                return next_retry
+
+    async def _prune(self) -> None:
+        if time.monotonic() - self._pruned_at < 3600:
+            return
+        self._pruned_at = time.monotonic()
+        await self._pool.execute(
+            "DELETE FROM outbox WHERE status <> 'PENDING' AND created_at < now() - make_interval(secs => $1)",
+            OUTBOX_KEEP_DAYS * 86400,
+        )
+
+    async def _run(self) -> None:
+        timeout = 0.0  # rows left from before a restart go out right away
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            self._wakeup.clear()
+            try:
+                timeout = await self.drain()
+                await self._prune()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # db hiccup: claimed rows come back when their lease runs out
+                timeout = OUTBOX_POLL_INTERVAL
+
+    def start(self, pool: "DbPool", bot: Bot, deliver: bool = True) -> None:
+        # deliver=False: only queue rows here, wake() tells the process that sends them
+        self._pool = pool
+        self._bot = bot
+        if deliver:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        self._pool = None
+
+
+OUTBOX = OutboxWorker()
 
 
 # ================== USER HANDLERS ==================
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
+    pool: DbPool = context.application.bot_data["db_pool"]
     user = update.effective_user
     chat = update.effective_chat
     if not user or not chat or not update.message:
@@ -857,7 +2741,7 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     await upsert_user(pool, user)
     db_user = await get_user(pool, user.id)
-    lang = (db_user["language"] if db_user and db_user["language"] else "et")
+    lang = (db_user["language"] if db_user and db_user["language"] else DEFAULT_LANG)
     status = (db_user["status"] if db_user and db_user["status"] else "NEW")
 
     if status == "SAFE":
@@ -865,58 +2749,57 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     if status == "PENDING":
-        await update.message.reply_text(t(lang, "already_pending"), reply_markup=kb_languages())
+        await update.message.reply_text(t(lang, Msg.ALREADY_PENDING), reply_markup=kb_languages())
         return
 
     try:
-        with open(CLAIM_IMAGE_PATH, "rb") as f:
-            await context.bot.send_photo(
-                chat_id=chat.id,
-                photo=InputFile(f, filename="claim.png"),
-                caption=t(lang, "welcome"),
-                reply_markup=kb_languages_and_verify(lang),
-            )
+        await send_static_photo(
+            context,
+            chat.id,
+            CLAIM_IMAGE_PATH,
+            caption=t(lang, Msg.WELCOME),
+            reply_markup=kb_languages_and_verify(lang),
+        )
     except FileNotFoundError:
-        await update.message.reply_text(t(lang, "welcome"), reply_markup=kb_languages_and_verify(lang))
+        await update.message.reply_text(t(lang, Msg.WELCOME), reply_markup=kb_languages_and_verify(lang))
 
 
-async def on_lang_or_verify(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def on_lang_or_verify(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: "CallbackAction") -> None:
     query = update.callback_query
     if not query:
         return
     await query.answer()
 
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
+    pool: DbPool = context.application.bot_data["db_pool"]
     user = update.effective_user
     if not user:
         return
 
     await upsert_user(pool, user)
     db_user = await get_user(pool, user.id)
-    lang = (db_user["language"] if db_user and db_user["language"] else "et")
+    lang = (db_user["language"] if db_user and db_user["language"] else DEFAULT_LANG)
     status = (db_user["status"] if db_user and db_user["status"] else "NEW")
     state = db_user["state"] if db_user else None
 
-    data = query.data or ""
     is_photo = bool(query.message and getattr(query.message, "photo", None))
 
-    if data.startswith("lang:"):
-        new_lang = data.split(":", 1)[1]
-        if new_lang not in ("et", "ru", "en"):
-            new_lang = "et"
+    if cb.namespace == "lang":
+        new_lang = cb.verb
+        if new_lang not in TEXTS.texts:
+            new_lang = DEFAULT_LANG
         await set_language(pool, user.id, new_lang)
 
         # refresh simple screens
         if status == "SAFE":
             if is_photo:
                 await query.edit_message_caption(
-                    caption=t(new_lang, "safe_welcome"),
+                    caption=t(new_lang, Msg.SAFE_WELCOME),
                     reply_markup=kb_safe_menu(new_lang),
                     parse_mode="Markdown",
                 )
             else:
                 await query.edit_message_text(
-                    t(new_lang, "safe_welcome"),
+                    t(new_lang, Msg.SAFE_WELCOME),
                     reply_markup=kb_safe_menu(new_lang),
                     parse_mode="Markdown",
                 )
@@ -924,37 +2807,37 @@ async def on_lang_or_verify(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
         if status == "PENDING":
             if is_photo:
-                await query.edit_message_caption(caption=t(new_lang, "already_pending"), reply_markup=kb_languages())
+                await query.edit_message_caption(caption=t(new_lang, Msg.ALREADY_PENDING), reply_markup=kb_languages())
             else:
-                await query.edit_message_text(t(new_lang, "already_pending"), reply_markup=kb_languages())
+                await query.edit_message_text(t(new_lang, Msg.ALREADY_PENDING), reply_markup=kb_languages())
             return
 
         if state == "WAITING_REF":
             if is_photo:
-                await query.edit_message_caption(caption=t(new_lang, "waiting_ref"), reply_markup=kb_languages())
+                await query.edit_message_caption(caption=t(new_lang, Msg.WAITING_REF), reply_markup=kb_languages())
             else:
-                await query.edit_message_text(t(new_lang, "waiting_ref"), reply_markup=kb_languages())
+                await query.edit_message_text(t(new_lang, Msg.WAITING_REF), reply_markup=kb_languages())
             return
 
         if state == "BUY_ADDRESS":
             if is_photo:
-                await query.edit_message_caption(caption=t(new_lang, "buy_send_address"), reply_markup=kb_languages())
+                await query.edit_message_caption(caption=t(new_lang, Msg.BUY_SEND_ADDRESS), reply_markup=kb_languages())
             else:
-                await query.edit_message_text(t(new_lang, "buy_send_address"), reply_markup=kb_languages())
+                await query.edit_message_text(t(new_lang, Msg.BUY_SEND_ADDRESS), reply_markup=kb_languages())
             return
 
         if is_photo:
-            await query.edit_message_caption(caption=t(new_lang, "welcome"), reply_markup=kb_languages_and_verify(new_lang))
+            await query.edit_message_caption(caption=t(new_lang, Msg.WELCOME), reply_markup=kb_languages_and_verify(new_lang))
         else:
-            await query.edit_message_text(t(new_lang, "welcome"), reply_markup=kb_languages_and_verify(new_lang))
+            await query.edit_message_text(t(new_lang, Msg.WELCOME), reply_markup=kb_languages_and_verify(new_lang))
         return
 
-    if data == "verify":
+    if cb.namespace == "verify":
         if status == "PENDING":
             if is_photo:
-                await query.edit_message_caption(caption=t(lang, "already_pending"), reply_markup=kb_languages())
+                await query.edit_message_caption(caption=t(lang, Msg.ALREADY_PENDING), reply_markup=kb_languages())
             else:
-                await query.edit_message_text(t(lang, "already_pending"), reply_markup=kb_languages())
+                await query.edit_message_text(t(lang, Msg.ALREADY_PENDING), reply_markup=kb_languages())
             return
 
         if status == "SAFE":
@@ -963,105 +2846,104 @@ async def on_lang_or_verify(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
         await set_state(pool, user.id, "WAITING_REF")
         if is_photo:
-            await query.edit_message_caption(caption=t(lang, "waiting_ref"), reply_markup=kb_languages())
+            await query.edit_message_caption(caption=t(lang, Msg.WAITING_REF), reply_markup=kb_languages())
         else:
-            await query.edit_message_text(t(lang, "waiting_ref"), reply_markup=kb_languages())
+            await query.edit_message_text(t(lang, Msg.WAITING_REF), reply_markup=kb_languages())
         return
 
 
-async def safe_menu_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def safe_menu_click(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: "CallbackAction") -> None:
     query = update.callback_query
     if not query:
         return
     await query.answer()
 
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
+    pool: DbPool = context.application.bot_data["db_pool"]
     user = update.effective_user
     if not user:
         return
 
     db_user = await get_user(pool, user.id)
-    lang = (db_user["language"] if db_user and db_user["language"] else "et")
+    lang = (db_user["language"] if db_user and db_user["language"] else DEFAULT_LANG)
     status = (db_user["status"] if db_user and db_user["status"] else "NEW")
     chat_id = query.message.chat_id
 
     if status != "SAFE":
-        await query.edit_message_text(t(lang, "do_start"), reply_markup=kb_languages())
+        await query.edit_message_text(t(lang, Msg.DO_START), reply_markup=kb_languages())
         return
 
-    data = query.data or ""
-
-    if data == "safe:help":
-        await query.edit_message_text(t(lang, "help_text"), reply_markup=kb_safe_menu(lang))
+    if cb.verb == "help":
+        await query.edit_message_text(t(lang, Msg.HELP_TEXT), reply_markup=kb_safe_menu(lang))
         return
 
-    if data == "safe:account":
+    if cb.verb == "account":
         spent = int(db_user["spent_cents"] or 0)
         await query.edit_message_text(
-            f"{t(lang, 'account_text')}\n\nUser ID: `{user.id}`\nSpent: `{cents_to_eur_str(spent)}`",
+            f"{t(lang, Msg.ACCOUNT_TEXT)}\n\nUser ID: `{user.id}`\nSpent: `{cents_to_eur_str(spent)}`",
             reply_markup=kb_safe_menu(lang),
             parse_mode="Markdown",
         )
         return
 
-    if data == "safe:home":
+    if cb.verb == "home":
         await send_home(chat_id, lang, context)
         return
 
-    if data == "safe:orders":
+    if cb.verb == "orders":
         orders = await list_user_active_orders(pool, user.id)
         if not orders:
-            await query.edit_message_text(t(lang, "orders_empty"), reply_markup=kb_safe_menu(lang))
+            await query.edit_message_text(t(lang, Msg.ORDERS_EMPTY), reply_markup=kb_safe_menu(lang))
             return
         await query.edit_message_text(
-            t(lang, "orders_title"),
+            t(lang, Msg.ORDERS_TITLE),
             reply_markup=kb_orders_list(lang, orders),
             parse_mode="Markdown",
         )
         return
 
-    if data == "safe:shop":
-        items = await list_items(pool)
-        if not items:
+    if cb.verb == "shop":
+        catalog = await CATALOG.get(pool)
+        if not catalog.items:
             try:
-                with open(SHOP_IMAGE_PATH, "rb") as f:
-                    await context.bot.send_photo(
-                        chat_id=chat_id,
-                        photo=InputFile(f, filename="shop.png"),
-                        caption=t(lang, "shop_empty"),
-                        reply_markup=kb_safe_menu(lang),
-                        parse_mode="Markdown",
-                    )
+                await send_static_photo(
+                    context,
+                    chat_id,
+                    SHOP_IMAGE_PATH,
+                    caption=t(lang, Msg.SHOP_EMPTY),
+                    reply_markup=kb_safe_menu(lang),
+                    parse_mode="Markdown",
+                )
             except FileNotFoundError:
-                await query.edit_message_text(t(lang, "shop_empty"), reply_markup=kb_safe_menu(lang))
+                await query.edit_message_text(t(lang, Msg.SHOP_EMPTY), reply_markup=kb_safe_menu(lang))
             return
 
         try:
-            with open(SHOP_IMAGE_PATH, "rb") as f:
-                await context.bot.send_photo(
-                    chat_id=chat_id,
-                    photo=InputFile(f, filename="shop.png"),
-                    caption=t(lang, "shop_title"),
-                    reply_markup=kb_shop_items(lang, items),
-                    parse_mode="Markdown",
-                )
+            await send_static_photo(
+                context,
+                chat_id,
+                SHOP_IMAGE_PATH,
+                caption=t(lang, Msg.SHOP_TITLE),
+                reply_markup=kb_shop_items(lang, catalog),
+                parse_mode="Markdown",
+            )
         except FileNotFoundError:
-            await query.edit_message_text(t(lang, "shop_title"), reply_markup=kb_shop_items(lang, items), parse_mode="Markdown")
+            await query.edit_message_text(t(lang, Msg.SHOP_TITLE), reply_markup=kb_shop_items(lang, catalog), parse_mode="Markdown")
         return
 
-    if data == "safe:buy":
+    if cb.verb == "buy":
         online = await get_setting(pool, "operator_online", "true")
         if online != "true":
-            await query.edit_message_text(t(lang, "buy_offline"), reply_markup=kb_safe_menu(lang))
+            await query.edit_message_text(t(lang, Msg.BUY_OFFLINE), reply_markup=kb_safe_menu(lang))
             return
 
-        items = await list_items(pool)
-        cart = get_cart(context)
-        subtotal = await recompute_subtotal(pool, cart)
-        context.user_data.setdefault("buy", {})["subtotal_cents"] = subtotal
+        catalog = await CATALOG.get(pool)
+        buy = get_buy(context)
+        reprice_cart(buy, catalog)
+        buy.pop("page", None)
+        subtotal = buy["subtotal_cents"]
 
-        text = f"{t(lang,'buy_intro')}\n\n{t(lang,'buy_cart')}: {cents_to_eur_str(subtotal)}"
-        kb = kb_buy_menu(lang, items, cart, subtotal)
+        text = f"{t(lang, Msg.BUY_INTRO)}\n\n{t(lang, Msg.BUY_CART)}: {cents_to_eur_str(subtotal)}"
+        kb = kb_buy_menu(lang, catalog, buy["cart"], subtotal)
 
         is_photo = bool(query.message and getattr(query.message, "photo", None))
         if is_photo:
@@ -1071,34 +2953,31 @@ async def safe_menu_click(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
 
-async def item_open(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def item_open(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: "CallbackAction") -> None:
     query = update.callback_query
     if not query:
         return
     await query.answer()
 
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
+    pool: DbPool = context.application.bot_data["db_pool"]
     user = update.effective_user
     if not user:
         return
 
     db_user = await get_user(pool, user.id)
-    lang = (db_user["language"] if db_user and db_user["language"] else "et")
+    lang = (db_user["language"] if db_user and db_user["language"] else DEFAULT_LANG)
     status = (db_user["status"] if db_user and db_user["status"] else "NEW")
 
     if status != "SAFE":
-        await query.edit_message_text(t(lang, "do_start"), reply_markup=kb_languages())
+        await query.edit_message_text(t(lang, Msg.DO_START), reply_markup=kb_languages())
         return
 
-    try:
-        item_id = int((query.data or "").split(":", 1)[1])
-    except Exception:
-        await query.edit_message_text(t(lang, "admin_bad"))
-        return
+    item_id = cb.args[0]
+    page_from = cb.args[1] if len(cb.args) > 1 else 0
 
     item = await get_item(pool, item_id)
     if not item:
-        await query.edit_message_text(t(lang, "admin_bad"), reply_markup=kb_safe_menu(lang))
+        await query.edit_message_text(t(lang, Msg.ADMIN_BAD), reply_markup=kb_safe_menu(lang))
         return
 
     price = cents_to_eur_str(int(item["price_cents"]))
@@ -1107,42 +2986,81 @@ async def item_open(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         chat_id=query.message.chat_id,
         photo=item["photo_file_id"],
         caption=caption,
-        reply_markup=kb_item_detail(lang),
+        reply_markup=kb_item_detail(lang, page_from),
         parse_mode="Markdown",
     )
 
 
-# ================== USER ORDERS CALLBACKS ==================
-async def user_orders_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def shop_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: "CallbackAction") -> None:
+    # shop:from:<id> / shop:before:<id> swap the item buttons on the shop message,
+    # shop:open:<id> (back from an item view) sends the shop again at that page
     query = update.callback_query
     if not query:
         return
     await query.answer()
 
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
+    pool: DbPool = context.application.bot_data["db_pool"]
     user = update.effective_user
     if not user:
         return
 
     db_user = await get_user(pool, user.id)
-    lang = (db_user["language"] if db_user and db_user["language"] else "et")
+    lang = (db_user["language"] if db_user and db_user["language"] else DEFAULT_LANG)
     status = (db_user["status"] if db_user and db_user["status"] else "NEW")
 
     if status != "SAFE":
-        await query.edit_message_text(t(lang, "do_start"), reply_markup=kb_languages())
+        await query.edit_message_text(t(lang, Msg.DO_START), reply_markup=kb_languages())
+        return
+
+    catalog = await CATALOG.get(pool)
+    if cb.verb == "before":
+        start = catalog.page_start(before_id=cb.args[0])
+    else:
+        start = catalog.page_start(cb.args[0])
+
+    kb = kb_shop_items(lang, catalog, start)
+    if cb.verb != "open":
+        await query.edit_message_reply_markup(reply_markup=kb)
+        return
+    try:
+        await send_static_photo(
+            context,
+            query.message.chat_id,
+            SHOP_IMAGE_PATH,
+            caption=t(lang, Msg.SHOP_TITLE),
+            reply_markup=kb,
+            parse_mode="Markdown",
+        )
+    except FileNotFoundError:
+        await query.edit_message_text(t(lang, Msg.SHOP_TITLE), reply_markup=kb, parse_mode="Markdown")
+
+
+# ================== USER ORDERS CALLBACKS ==================
+async def user_orders_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: "CallbackAction") -> None:
+    query = update.callback_query
+    if not query:
+        return
+    await query.answer()
+
+    pool: DbPool = context.application.bot_data["db_pool"]
+    user = update.effective_user
+    if not user:
         return
 
-    data = query.data or ""
-    parts = data.split(":")
-    if len(parts) < 3:
+    db_user = await get_user(pool, user.id)
+    lang = (db_user["language"] if db_user and db_user["language"] else DEFAULT_LANG)
+    status = (db_user["status"] if db_user and db_user["status"] else "NEW")
+
+    if status != "SAFE":
+        await query.edit_message_text(t(lang, Msg.DO_START), reply_markup=kb_languages())
         return
 
-    action = parts[1]
-    oid = int(parts[2])
+    action = cb.verb
+    oid = cb.args[0]
 
     order = await get_order(pool, oid)
     if not order or int(order["user_id"]) != user.id:
-        await query.edit_message_text(t(lang, "admin_bad"))
+        await query.edit_message_text(t(lang, Msg.ADMIN_BAD))
         return
 
     st = str(order["status"])
@@ -1153,30 +3071,10 @@ async def user_orders_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     delivery = "YES" if bool(order["delivery"]) else "NO"
     address = order["address"] or "-"
 
-    # build item lines
-    cart = order["cart_json"]
-    if isinstance(cart, str):
-        try:
-            cart = json.loads(cart)
-        except Exception:
-            cart = {}
-    items = await list_items(pool)
-    item_map = {int(it["id"]): it for it in items}
-    lines = []
-    for k, v in (cart or {}).items():
-        try:
-            iid = int(k)
-            qty = int(v)
-        except Exception:
-            continue
-        it = item_map.get(iid)
-        if not it:
-            continue
-        price = cents_to_eur_str(int(it["price_cents"]))
-        lines.append(f"- {it['name']} x{qty} ({price})")
+    lines = await order_item_lines(pool, order["cart_json"])
 
     detail_text = (
-        f"{t(lang,'order_detail')} #{oid}\n\n"
+        f"{t(lang, Msg.ORDER_DETAIL)} #{oid}\n\n"
         f"Status: {st}\n\n"
         "Items:\n" + ("\n".join(lines) if lines else "-") + "\n\n"
         f"Subtotal: {subtotal}\n"
@@ -1208,62 +3106,90 @@ async def user_orders_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             await query.edit_message_text(detail_text, reply_markup=kb_order_detail(lang, oid, False))
             return
 
-        await cancel_order(pool, oid)
+        # admin notice + card without buttons go out through the outbox
+        if not await cancel_order(pool, oid):
+            # the admin completed it since this detail was read
+            order = await get_order(pool, oid)
+            new_st = str(order["status"]) if order else st
+            await query.edit_message_text(
+                detail_text.replace(f"Status: {st}\n", f"Status: {new_st}\n", 1),
+                reply_markup=kb_order_detail(lang, oid, False),
+            )
+            return
+        await query.edit_message_text(t(lang, Msg.ORDER_CANCELLED_USER), reply_markup=kb_safe_menu(lang))
+        return
 
-        # notify admin + remove buttons on admin message
-        order2 = await get_order(pool, oid)
-        if order2 and order2["admin_message_id"]:
-            try:
-                await context.bot.edit_message_reply_markup(
-                    chat_id=ADMIN_ID_INT,
-                    message_id=int(order2["admin_message_id"]),
-                    reply_markup=None
-                )
-            except Exception:
-                pass
-            try:
-                await context.bot.send_message(chat_id=ADMIN_ID_INT, text=f"Order #{oid} {t(lang,'order_cancelled_admin')}")
-            except Exception:
-                pass
-            await refresh_admin_order_message(pool, context, oid)
 
-        await query.edit_message_text(t(lang, "order_cancelled_user"), reply_markup=kb_safe_menu(lang))
+# ================== BUY CALLBACKS ==================
+async def checkout(
+    pool: DbPool, context: ContextTypes.DEFAULT_TYPE, user_id: int, lang: str, buy: Dict[str, Any], address: Optional[str]
+) -> None:
+    # the one place a cart becomes an order; address None = no delivery
+    cart: Dict[int, CartLine] = buy["cart"]
+    catalog = await CATALOG.get(pool)
+    if reprice_cart(buy, catalog):
+        # prices changed or items left the shop since the cart was filled: show it again
+        subtotal = buy["subtotal_cents"]
+        text = f"{t(lang, Msg.BUY_CART_CHANGED)}\n\n{t(lang, Msg.BUY_INTRO)}\n\n{t(lang, Msg.BUY_CART)}: {cents_to_eur_str(subtotal)}"
+        await context.bot.send_message(
+            chat_id=user_id, text=text, reply_markup=kb_buy_menu(lang, catalog, cart, subtotal), parse_mode="Markdown"
+        )
+        return
+    if not cart:
+        context.user_data.pop("buy", None)
+        await context.bot.send_message(chat_id=user_id, text=t(lang, Msg.BUY_NEED_ITEMS))
         return
 
+    # a repeat returns the first order and queues nothing
+    await create_order(pool, user_id, cart, address is not None, address, checkout_key(user_id, buy))
+    context.user_data.pop("buy", None)
+    await context.bot.send_message(chat_id=user_id, text=t(lang, Msg.BUY_ORDER_SENT))
 
-# ================== BUY CALLBACKS ==================
-async def buy_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+
+async def buy_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: "CallbackAction") -> None:
     query = update.callback_query
     if not query:
         return
     await query.answer()
 
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
+    pool: DbPool = context.application.bot_data["db_pool"]
     user = update.effective_user
     if not user:
         return
 
     db_user = await get_user(pool, user.id)
-    lang = (db_user["language"] if db_user and db_user["language"] else "et")
+    lang = (db_user["language"] if db_user and db_user["language"] else DEFAULT_LANG)
     status = (db_user["status"] if db_user and db_user["status"] else "NEW")
     if status != "SAFE":
-        await query.edit_message_text(t(lang, "do_start"), reply_markup=kb_languages())
+        await query.edit_message_text(t(lang, Msg.DO_START), reply_markup=kb_languages())
         return
 
     online = await get_setting(pool, "operator_online", "true")
     if online != "true":
-        await query.edit_message_text(t(lang, "buy_offline"), reply_markup=kb_safe_menu(lang))
+        await query.edit_message_text(t(lang, Msg.BUY_OFFLINE), reply_markup=kb_safe_menu(lang))
         return
 
-    data = query.data or ""
-    parts = data.split(":")
-    cart = get_cart(context)
+    buy = get_buy(context)
+    cart: Dict[int, CartLine] = buy["cart"]
 
-    if data == "buy:clear":
-        context.user_data["buy"] = {"cart": {}, "subtotal_cents": 0}
-        items = await list_items(pool)
-        text = f"{t(lang,'buy_intro')}\n\n{t(lang,'buy_cart')}: {cents_to_eur_str(0)}"
-        kb = kb_buy_menu(lang, items, {}, 0)
+    if cb.verb in ("from", "before"):
+        catalog = await CATALOG.get(pool)
+        if cb.verb == "before":
+            start = catalog.page_start(before_id=cb.args[0])
+        else:
+            start = catalog.page_start(cb.args[0])
+        # remembered so qty / back return to this page
+        buy["page"] = catalog.ids[start] if catalog.ids else 0
+        subtotal = int(buy.get("subtotal_cents") or 0)
+        await query.edit_message_reply_markup(reply_markup=kb_buy_menu(lang, catalog, cart, subtotal, start))
+        return
+
+    if cb.verb == "clear":
+        context.user_data.pop("buy", None)
+        get_buy(context)
+        catalog = await CATALOG.get(pool)
+        text = f"{t(lang, Msg.BUY_INTRO)}\n\n{t(lang, Msg.BUY_CART)}: {cents_to_eur_str(0)}"
+        kb = kb_buy_menu(lang, catalog, {}, 0)
         is_photo = bool(query.message and getattr(query.message, "photo", None))
         if is_photo:
             await query.edit_message_caption(caption=text, reply_markup=kb, parse_mode="Markdown")
@@ -1271,12 +3197,13 @@ async def buy_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             await query.edit_message_text(text, reply_markup=kb, parse_mode="Markdown")
         return
 
-    if data == "buy:back":
-        items = await list_items(pool)
-        subtotal = await recompute_subtotal(pool, cart)
-        context.user_data.setdefault("buy", {})["subtotal_cents"] = subtotal
-        text = f"{t(lang,'buy_intro')}\n\n{t(lang,'buy_cart')}: {cents_to_eur_str(subtotal)}"
-        kb = kb_buy_menu(lang, items, cart, subtotal)
+    if cb.verb == "back":
+        catalog = await CATALOG.get(pool)
+        reprice_cart(buy, catalog)
+        subtotal = buy["subtotal_cents"]
+        text = f"{t(lang, Msg.BUY_INTRO)}\n\n{t(lang, Msg.BUY_CART)}: {cents_to_eur_str(subtotal)}"
+        start = catalog.page_start(int(buy.get("page") or 0))
+        kb = kb_buy_menu(lang, catalog, cart, subtotal, start)
         is_photo = bool(query.message and getattr(query.message, "photo", None))
         if is_photo:
             await query.edit_message_caption(caption=text, reply_markup=kb, parse_mode="Markdown")
@@ -1284,13 +3211,13 @@ async def buy_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             await query.edit_message_text(text, reply_markup=kb, parse_mode="Markdown")
         return
 
-    if len(parts) == 3 and parts[1] == "item":
-        item_id = int(parts[2])
+    if cb.verb == "item":
+        item_id = cb.args[0]
         item = await get_item(pool, item_id)
         if not item:
             return
         price = cents_to_eur_str(int(item["price_cents"]))
-        text = f"*{item['name']}*\n{price}\n\n{t(lang,'buy_choose_qty')}"
+        text = f"*{item['name']}*\n{price}\n\n{t(lang, Msg.BUY_CHOOSE_QTY)}"
         is_photo = bool(query.message and getattr(query.message, "photo", None))
         if is_photo:
             await query.edit_message_caption(caption=text, reply_markup=kb_qty(lang, item_id), parse_mode="Markdown")
@@ -1298,21 +3225,20 @@ async def buy_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             await query.edit_message_text(text, reply_markup=kb_qty(lang, item_id), parse_mode="Markdown")
         return
 
-    if len(parts) == 4 and parts[1] == "qty":
-        item_id = int(parts[2])
-        qty = int(parts[3])
-        if qty <= 0:
+    if cb.verb == "qty":
+        item_id, qty = cb.args
+        catalog = await CATALOG.get(pool)
+        reprice_cart(buy, catalog)
+        item = catalog.by_id.get(item_id)
+        if qty <= 0 or item is None:
             cart.pop(item_id, None)
         else:
-            cart[item_id] = qty
-        context.user_data.setdefault("buy", {})["cart"] = cart
+            cart[item_id] = CartLine(qty, int(item["price_cents"]))
+        subtotal = buy["subtotal_cents"] = cart_subtotal(cart)
 
-        items = await list_items(pool)
-        subtotal = await recompute_subtotal(pool, cart)
-        context.user_data.setdefault("buy", {})["subtotal_cents"] = subtotal
-
-        text = f"{t(lang,'buy_intro')}\n\n{t(lang,'buy_cart')}: {cents_to_eur_str(subtotal)}"
-        kb = kb_buy_menu(lang, items, cart, subtotal)
+        text = f"{t(lang, Msg.BUY_INTRO)}\n\n{t(lang, Msg.BUY_CART)}: {cents_to_eur_str(subtotal)}"
+        start = catalog.page_start(int(buy.get("page") or 0))
+        kb = kb_buy_menu(lang, catalog, cart, subtotal, start)
         is_photo = bool(query.message and getattr(query.message, "photo", None))
         if is_photo:
             await query.edit_message_caption(caption=text, reply_markup=kb, parse_mode="Markdown")
@@ -1320,39 +3246,33 @@ async def buy_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             await query.edit_message_text(text, reply_markup=kb, parse_mode="Markdown")
         return
 
-    if data == "buy:next":
-        subtotal = await recompute_subtotal(pool, cart)
-        context.user_data.setdefault("buy", {})["subtotal_cents"] = subtotal
+    if cb.verb == "next":
+        subtotal = int(buy.get("subtotal_cents") or 0)
         if subtotal <= 0 or not cart:
-            await query.edit_message_text(t(lang, "buy_need_items"), reply_markup=kb_delivery(lang))
+            await query.edit_message_text(t(lang, Msg.BUY_NEED_ITEMS), reply_markup=kb_delivery(lang))
             return
 
-        text = t(lang, "buy_delivery_q") + f"\n\n{t(lang,'buy_cart')}: {cents_to_eur_str(subtotal)}"
+        text = t(lang, Msg.BUY_DELIVERY_Q) + f"\n\n{t(lang, Msg.BUY_CART)}: {cents_to_eur_str(subtotal)}"
         await query.edit_message_text(text, reply_markup=kb_delivery(lang), parse_mode="Markdown")
         return
 
-    if len(parts) == 3 and parts[1] == "delivery":
-        choice = parts[2]
-        subtotal = await recompute_subtotal(pool, cart)
-        context.user_data.setdefault("buy", {})["subtotal_cents"] = subtotal
+    if cb.verb.startswith("delivery:"):
+        choice = cb.verb.split(":", 1)[1]
 
         if choice == "yes":
-            context.user_data.setdefault("buy", {})["delivery"] = True
+            buy["delivery"] = True
             await set_state(pool, user.id, "BUY_ADDRESS")
-            await context.bot.send_message(chat_id=query.message.chat_id, text=t(lang, "buy_send_address"), reply_markup=kb_languages())
+            await context.bot.send_message(chat_id=query.message.chat_id, text=t(lang, Msg.BUY_SEND_ADDRESS), reply_markup=kb_languages())
             return
 
         if choice == "no":
-            context.user_data.setdefault("buy", {})["delivery"] = False
-            order_id = await create_order(pool, user.id, cart, subtotal, False, None)
-            context.user_data.pop("buy", None)
-            await context.bot.send_message(chat_id=user.id, text=t(lang, "buy_order_sent"))
-            await notify_admin_order(pool, context, order_id)
+            buy["delivery"] = False
+            await checkout(pool, context, user.id, lang, buy, None)
             return
 
 
 # ================== ADMIN ORDER CALLBACKS ==================
-async def admin_order_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def admin_order_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: "CallbackAction") -> None:
     query = update.callback_query
     if not query:
         return
@@ -1361,14 +3281,29 @@ async def admin_order_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     if not update.effective_user or not is_admin(update.effective_user.id):
         return
 
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
-    data = query.data or ""
-    parts = data.split(":")
-    if len(parts) != 3:
-        return
+    pool: DbPool = context.application.bot_data["db_pool"]
+    action = cb.verb
+    order_id = cb.args[0]
+
+    if action == "complete":
+        # DONE + spent/orders_done + notifications queued in one statement
+        done = await complete_order(pool, order_id)
+        if done is None:
+            # missing or already finished (e.g. double tap) -> remove buttons
+            try:
+                await query.edit_message_reply_markup(reply_markup=None)
+            except Exception:
+                pass
+            return
 
-    action = parts[1]
-    order_id = int(parts[2])
+        # customer notice + card showing DONE without buttons go out through the outbox
+        if done["admin_message_id"] != query.message.message_id:
+            # tapped on an older copy of the card: remove its buttons too
+            try:
+                await query.edit_message_reply_markup(reply_markup=None)
+            except Exception:
+                pass
+        return
 
     order = await get_order(pool, order_id)
     if not order:
@@ -1385,32 +3320,7 @@ async def admin_order_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 
     if action == "fee":
         context.user_data["fee_input"] = {"order_id": order_id}
-        await context.bot.send_message(chat_id=ADMIN_ID_INT, text=t("et", "admin_fee_prompt"))
-        return
-
-    if action == "complete":
-        # DONE + add spent + notify user
-        await mark_order_done(pool, order_id)
-
-        order2 = await get_order(pool, order_id)
-        user_id = int(order2["user_id"])
-        total_cents = int(order2["total_cents"])
-        await add_spent(pool, user_id, total_cents)
-
-        u = await get_user(pool, user_id)
-        lang = (u["language"] if u and u.get("language") else "et")
-        try:
-            await context.bot.send_message(chat_id=user_id, text=f"{t(lang,'order_completed_user')}\nTOTAL: {cents_to_eur_str(total_cents)}")
-        except Exception:
-            pass
-
-        # ✅ remove buttons immediately on that admin message
-        try:
-            await query.edit_message_reply_markup(reply_markup=None)
-        except Exception:
-            pass
-        # and refresh (text will show DONE, still no buttons)
-        await refresh_admin_order_message(pool, context, order_id)
+        await context.bot.send_message(chat_id=ADMIN_ID_INT, text=t(DEFAULT_LANG, Msg.ADMIN_FEE_PROMPT))
         return
 
 
@@ -1419,7 +3329,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     if not update.message or not update.message.text:
         return
 
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
+    pool: DbPool = context.application.bot_data["db_pool"]
     user = update.effective_user
     chat = update.effective_chat
     if not user or not chat:
@@ -1427,7 +3337,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
     await upsert_user(pool, user)
     db_user = await get_user(pool, user.id)
-    lang = (db_user["language"] if db_user and db_user["language"] else "et")
+    lang = (db_user["language"] if db_user and db_user["language"] else DEFAULT_LANG)
     status = (db_user["status"] if db_user and db_user["status"] else "NEW")
     state = db_user["state"] if db_user else None
     text = update.message.text.strip()
@@ -1442,14 +3352,13 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                 raise ValueError()
             fee_cents = eur_to_cents(fee)
         except Exception:
-            await update.message.reply_text(t("et", "admin_fee_prompt"))
+            await update.message.reply_text(t(DEFAULT_LANG, Msg.ADMIN_FEE_PROMPT))
             return
 
         await set_order_fee(pool, order_id, fee_cents)
         context.user_data.pop("fee_input", None)
 
         await update.message.reply_text(f"✅ Delivery fee set: {cents_to_eur_str(fee_cents)}")
-        await refresh_admin_order_message(pool, context, order_id)
         return
 
     # --- ADMIN additem flow ---
@@ -1460,13 +3369,13 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             addflow["name"] = text
             addflow["step"] = "TEXT"
             context.user_data["additem"] = addflow
-            await update.message.reply_text(t(lang, "admin_add_text"))
+            await update.message.reply_text(t(lang, Msg.ADMIN_ADD_TEXT))
             return
         if step == "TEXT":
             addflow["short_text"] = text
             addflow["step"] = "PRICE"
             context.user_data["additem"] = addflow
-            await update.message.reply_text(t(lang, "admin_add_price"))
+            await update.message.reply_text(t(lang, Msg.ADMIN_ADD_PRICE))
             return
         if step == "PRICE":
             try:
@@ -1475,49 +3384,27 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                     raise ValueError()
                 addflow["price_cents"] = eur_to_cents(price)
             except Exception:
-                await update.message.reply_text(t(lang, "admin_add_price"))
+                await update.message.reply_text(t(lang, Msg.ADMIN_ADD_PRICE))
                 return
             addflow["step"] = "PHOTO"
             context.user_data["additem"] = addflow
-            await update.message.reply_text(t(lang, "admin_add_photo"))
+            await update.message.reply_text(t(lang, Msg.ADMIN_ADD_PHOTO))
             return
 
     # --- BUY ADDRESS ---
     if state == "BUY_ADDRESS" and status == "SAFE":
-        buy = context.user_data.get("buy") or {}
-        cart = buy.get("cart") if isinstance(buy, dict) else {}
-        if not isinstance(cart, dict) or not cart:
-            await set_state(pool, user.id, None)
-            context.user_data.pop("buy", None)
-            await update.message.reply_text(t(lang, "buy_need_items"))
-            return
-
-        cart2: Dict[int, int] = {}
-        for k, v in cart.items():
-            try:
-                cart2[int(k)] = int(v)
-            except Exception:
-                pass
-
-        subtotal = await recompute_subtotal(pool, cart2)
-        address = text
-
-        order_id = await create_order(pool, user.id, cart2, subtotal, True, address)
         await set_state(pool, user.id, None)
-        context.user_data.pop("buy", None)
-
-        await update.message.reply_text(t(lang, "buy_order_sent"))
-        await notify_admin_order(pool, context, order_id)
+        await checkout(pool, context, user.id, lang, get_buy(context), text)
         return
 
     # --- CLAIM referral ---
     if status == "PENDING":
-        await update.message.reply_text(t(lang, "already_pending"), reply_markup=kb_languages())
+        await update.message.reply_text(t(lang, Msg.ALREADY_PENDING), reply_markup=kb_languages())
         return
 
     if state == "WAITING_REF":
         if not text.startswith("@") or len(text) < 2 or " " in text:
-            await update.message.reply_text(t(lang, "invalid_ref"), reply_markup=kb_languages())
+            await update.message.reply_text(t(lang, Msg.INVALID_REF), reply_markup=kb_languages())
             return
 
         ref_username = text
@@ -1525,7 +3412,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await set_state(pool, user.id, None)
         await set_status(pool, user.id, "PENDING")
 
-        await update.message.reply_text(t(lang, "wait_admin"), reply_markup=kb_languages())
+        await update.message.reply_text(t(lang, Msg.WAIT_ADMIN), reply_markup=kb_languages())
 
         now_utc = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
         full_name = f"{user.first_name or ''} {user.last_name or ''}".strip()
@@ -1552,7 +3439,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await send_home(chat.id, lang, context)
         return
 
-    await update.message.reply_text(t(lang, "do_start"), reply_markup=kb_languages())
+    await update.message.reply_text(t(lang, Msg.DO_START), reply_markup=kb_languages())
 
 
 # ================== PHOTO HANDLER ==================
@@ -1564,9 +3451,9 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if not user or not is_admin(user.id):
         return
 
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
+    pool: DbPool = context.application.bot_data["db_pool"]
     db_user = await get_user(pool, user.id)
-    lang = (db_user["language"] if db_user and db_user["language"] else "et")
+    lang = (db_user["language"] if db_user and db_user["language"] else DEFAULT_LANG)
 
     addflow: Optional[Dict[str, Any]] = context.user_data.get("additem")
     if not addflow or addflow.get("step") != "PHOTO":
@@ -1581,15 +3468,15 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await add_item(pool, name=name, short_text=short_text, price_cents=price_cents, photo_file_id=file_id)
     except Exception:
         reset_additem(context)
-        await update.message.reply_text(t(lang, "admin_bad"))
+        await update.message.reply_text(t(lang, Msg.ADMIN_BAD))
         return
 
     reset_additem(context)
-    await update.message.reply_text(t(lang, "admin_add_done"))
+    await update.message.reply_text(t(lang, Msg.ADMIN_ADD_DONE))
 
 
 # ================== ADMIN CLAIM DECISIONS ==================
-async def admin_decision(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def admin_decision(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: "CallbackAction") -> None:
     query = update.callback_query
     if not query:
         return
@@ -1599,15 +3486,9 @@ async def admin_decision(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await query.edit_message_text("Not allowed.")
         return
 
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
-    data = query.data or ""
-    parts = data.split(":")
-    if len(parts) != 3:
-        await query.edit_message_text("Bad callback.")
-        return
-
-    action = parts[1]
-    claim_id = int(parts[2])
+    pool: DbPool = context.application.bot_data["db_pool"]
+    action = cb.verb
+    claim_id = cb.args[0]
 
     claim = await get_claim(pool, claim_id)
     if not claim:
@@ -1620,14 +3501,14 @@ async def admin_decision(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     target_user = await get_user(pool, target_user_id)
-    target_lang = (target_user["language"] if target_user and target_user["language"] else "et")
+    target_lang = (target_user["language"] if target_user and target_user["language"] else DEFAULT_LANG)
     base_text = query.message.text or ""
 
     if action == "acc":
         await decide_claim(pool, claim_id, "ACCEPTED")
         await set_status(pool, target_user_id, "SAFE")
         await set_state(pool, target_user_id, None)
-        await context.bot.send_message(chat_id=target_user_id, text=t(target_lang, "accepted"))
+        await context.bot.send_message(chat_id=target_user_id, text=t(target_lang, Msg.ACCEPTED))
         await query.edit_message_text(base_text + "\n✅ ACCEPTED", reply_markup=kb_admin_remove(target_user_id))
         return
 
@@ -1635,12 +3516,12 @@ async def admin_decision(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await decide_claim(pool, claim_id, "DECLINED")
         await set_status(pool, target_user_id, "DECLINED")
         await set_state(pool, target_user_id, None)
-        await context.bot.send_message(chat_id=target_user_id, text=t(target_lang, "declined"))
+        await context.bot.send_message(chat_id=target_user_id, text=t(target_lang, Msg.DECLINED))
         await query.edit_message_text(base_text + "\n❌ DECLINED")
         return
 
 
-async def admin_remove_safe_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def admin_remove_safe_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: "CallbackAction") -> None:
     query = update.callback_query
     if not query:
         return
@@ -1650,23 +3531,17 @@ async def admin_remove_safe_callback(update: Update, context: ContextTypes.DEFAU
         await query.edit_message_text("Not allowed.")
         return
 
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
-    data = query.data or ""
-    parts = data.split(":")
-    if len(parts) != 3:
-        await query.edit_message_text("Bad callback.")
-        return
-
-    user_id = int(parts[2])
+    pool: DbPool = context.application.bot_data["db_pool"]
+    user_id = cb.args[0]
     await ensure_user_exists(pool, user_id)
     await set_status(pool, user_id, "NEW")
     await set_state(pool, user_id, None)
 
     target_user = await get_user(pool, user_id)
-    target_lang = (target_user["language"] if target_user and target_user["language"] else "et")
+    target_lang = (target_user["language"] if target_user and target_user["language"] else DEFAULT_LANG)
 
     try:
-        await context.bot.send_message(chat_id=user_id, text=t(target_lang, "removed_safe"))
+        await context.bot.send_message(chat_id=user_id, text=t(target_lang, Msg.REMOVED_SAFE))
     except Exception:
         pass
 
@@ -1678,7 +3553,7 @@ async def admin_add_safe(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user = update.effective_user
     if not user or not is_admin(user.id) or not update.message:
         return
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
+    pool: DbPool = context.application.bot_data["db_pool"]
     args = context.args or []
     if len(args) != 1 or not args[0].isdigit():
         await update.message.reply_text("Usage: /add <user_id>")
@@ -1688,9 +3563,9 @@ async def admin_add_safe(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await set_status(pool, user_id, "SAFE")
     await set_state(pool, user_id, None)
     target_user = await get_user(pool, user_id)
-    target_lang = (target_user["language"] if target_user and target_user["language"] else "et")
+    target_lang = (target_user["language"] if target_user and target_user["language"] else DEFAULT_LANG)
     try:
-        await context.bot.send_message(chat_id=user_id, text=t(target_lang, "added_safe"))
+        await context.bot.send_message(chat_id=user_id, text=t(target_lang, Msg.ADDED_SAFE))
     except Exception:
         pass
     await update.message.reply_text("✅ Added to SAFE list.")
@@ -1700,7 +3575,7 @@ async def admin_remove_safe(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user = update.effective_user
     if not user or not is_admin(user.id) or not update.message:
         return
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
+    pool: DbPool = context.application.bot_data["db_pool"]
     args = context.args or []
     if len(args) != 1 or not args[0].isdigit():
         await update.message.reply_text("Usage: /remove <user_id>")
@@ -1710,9 +3585,9 @@ async def admin_remove_safe(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await set_status(pool, user_id, "NEW")
     await set_state(pool, user_id, None)
     target_user = await get_user(pool, user_id)
-    target_lang = (target_user["language"] if target_user and target_user["language"] else "et")
+    target_lang = (target_user["language"] if target_user and target_user["language"] else DEFAULT_LANG)
     try:
-        await context.bot.send_message(chat_id=user_id, text=t(target_lang, "removed_safe"))
+        await context.bot.send_message(chat_id=user_id, text=t(target_lang, Msg.REMOVED_SAFE))
     except Exception:
         pass
     await update.message.reply_text("✅ Removed from SAFE list.")
@@ -1721,7 +3596,7 @@ async def admin_remove_safe(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def admin_online(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.effective_user or not is_admin(update.effective_user.id) or not update.message:
         return
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
+    pool: DbPool = context.application.bot_data["db_pool"]
     await set_setting(pool, "operator_online", "true")
     await update.message.reply_text("✅ ONLINE")
 
@@ -1729,7 +3604,7 @@ async def admin_online(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def admin_offline(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.effective_user or not is_admin(update.effective_user.id) or not update.message:
         return
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
+    pool: DbPool = context.application.bot_data["db_pool"]
     await set_setting(pool, "operator_online", "false")
     await update.message.reply_text("❌ OFFLINE")
 
@@ -1737,7 +3612,7 @@ async def admin_offline(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 async def admin_loc(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.effective_user or not is_admin(update.effective_user.id) or not update.message:
         return
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
+    pool: DbPool = context.application.bot_data["db_pool"]
     args = context.args or []
     if len(args) < 2 or not args[0].isdigit():
         await update.message.reply_text("Usage: /loc <order_id> <asukoht ja kellaaeg>")
@@ -1750,8 +3625,8 @@ async def admin_loc(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     user_id = int(order["user_id"])
     u = await get_user(pool, user_id)
-    lang = (u["language"] if u and u.get("language") else "et")
-    await context.bot.send_message(chat_id=user_id, text=f"{t(lang,'order_pickup_msg')}\n{info}")
+    lang = (u["language"] if u and u.get("language") else DEFAULT_LANG)
+    await context.bot.send_message(chat_id=user_id, text=f"{t(lang, Msg.ORDER_PICKUP_MSG)}\n{info}")
     await update.message.reply_text("✅ Sent.")
 
 
@@ -1760,22 +3635,22 @@ async def admin_additem(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     if not user or not is_admin(user.id) or not update.message:
         return
     context.user_data["additem"] = {"step": "NAME"}
-    await update.message.reply_text(TEXTS["et"]["admin_add_name"])
+    await update.message.reply_text(t(DEFAULT_LANG, Msg.ADMIN_ADD_NAME))
 
 
 async def admin_removeitem(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     if not user or not is_admin(user.id) or not update.message:
         return
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
-    items = await list_items(pool)
-    if not items:
-        await update.message.reply_text(TEXTS["et"]["admin_remove_empty"])
+    pool: DbPool = context.application.bot_data["db_pool"]
+    catalog = await CATALOG.get(pool)
+    if not catalog.items:
+        await update.message.reply_text(t(DEFAULT_LANG, Msg.ADMIN_REMOVE_EMPTY))
         return
-    await update.message.reply_text(TEXTS["et"]["admin_remove_pick"], reply_markup=kb_admin_removeitem(items))
+    await update.message.reply_text(t(DEFAULT_LANG, Msg.ADMIN_REMOVE_PICK), reply_markup=kb_admin_removeitem(catalog))
 
 
-async def admin_removeitem_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def admin_removeitem_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: "CallbackAction") -> None:
     query = update.callback_query
     if not query:
         return
@@ -1783,13 +3658,8 @@ async def admin_removeitem_callback(update: Update, context: ContextTypes.DEFAUL
     if not update.effective_user or not is_admin(update.effective_user.id):
         await query.edit_message_text("Not allowed.")
         return
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
-    try:
-        item_id = int((query.data or "").split(":", 2)[2])
-    except Exception:
-        await query.edit_message_text("Bad callback.")
-        return
-    await remove_item(pool, item_id)
+    pool: DbPool = context.application.bot_data["db_pool"]
+    await remove_item(pool, cb.args[0])
     await query.edit_message_text("✅ Removed.")
 
 
@@ -1797,38 +3667,788 @@ async def admin_removeitem_callback(update: Update, context: ContextTypes.DEFAUL
 async def admin_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.effective_user or not is_admin(update.effective_user.id) or not update.message:
         return
-    pool: asyncpg.Pool = context.application.bot_data["db_pool"]
+    pool: DbPool = context.application.bot_data["db_pool"]
     args = context.args or []
     if len(args) != 1 or not args[0].startswith("@"):
-        await update.message.reply_text(TEXTS["et"]["search_usage"])
+        await update.message.reply_text(t(DEFAULT_LANG, Msg.SEARCH_USAGE))
         return
     u = await get_user_by_username(pool, args[0])
     if not u:
-        await update.message.reply_text(TEXTS["et"]["search_not_found"])
+        await update.message.reply_text(t(DEFAULT_LANG, Msg.SEARCH_NOT_FOUND))
         return
     user_id = int(u["user_id"])
     spent = int(u["spent_cents"] or 0)
-    orders_done = await count_orders_done(pool, user_id)
     uname = f"@{u['username']}" if u.get("username") else "(no username)"
+    last_order = u["last_order_at"].strftime("%Y-%m-%d %H:%M") if u["last_order_at"] else "-"
     msg = (
         "SEARCH RESULT\n\n"
         f"User: {uname}\n"
         f"User ID: {user_id}\n"
         f"Spent: {cents_to_eur_str(spent)}\n"
-        f"Orders (DONE): {orders_done}\n"
+        f"Orders (DONE): {u['orders_done']}\n"
+        f"Orders (CANCELLED): {u['orders_cancelled']}\n"
+        f"Last order: {last_order}\n"
     )
     await update.message.reply_text(msg)
 
 
+def render_orders_page(status: str, rows: Sequence[asyncpg.Record]) -> str:
+    lines = [f"ORDERS — {status}\n"]
+    if not rows:
+        lines.append("(none)")
+    for r in rows:
+        who = f"@{r['username']}" if r["username"] else (r["first_name"] or "?")
+        when = r["created_at"].strftime("%Y-%m-%d %H:%M") if r["created_at"] else ""
+        delivery = " · delivery" if r["delivery"] else ""
+        lines.append(f"#{r['id']} · {cents_to_eur_str(int(r['total_cents']))} · {who} · {r['lines']} items{delivery} · {when}")
+    return "\n".join(lines)
+
+
+async def admin_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not update.effective_user or not is_admin(update.effective_user.id) or not update.message:
+        return
+    pool: DbPool = context.application.bot_data["db_pool"]
+    args = context.args or []
+    status = args[0].upper() if args else "NEW"
+    if len(args) > 1 or status not in ORDER_STATUSES:
+        await update.message.reply_text(t(DEFAULT_LANG, Msg.ORDERS_USAGE))
+        return
+    rows, has_newer, has_older = await list_orders_page(pool, status)
+    await update.message.reply_text(
+        render_orders_page(status, rows),
+        reply_markup=kb_admin_orders(status, [int(r["id"]) for r in rows], has_newer, has_older),
+    )
+
+
+async def admin_orders_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, cb: "CallbackAction") -> None:
+    # aord:<STATUS> first page, aord:<STATUS>:b|a:<id> older/newer page, aord:o:<id> order card
+    query = update.callback_query
+    if not query:
+        return
+    await query.answer()
+
+    if not update.effective_user or not is_admin(update.effective_user.id):
+        return
+
+    pool: DbPool = context.application.bot_data["db_pool"]
+
+    if cb.verb == "o":
+        # a fresh card at the bottom of the chat; the outbox edits this one from now on
+        async with admin_card_turn(cb.args[0]):
+            await notify_admin_order(pool, context.bot, cb.args[0])
+        return
+
+    status, _, direction = cb.verb.partition(":")
+    if cb.args:
+        cursor = cb.args[0]
+        if direction == "b":
+            rows, has_newer, has_older = await list_orders_page(pool, status, older_than=cursor)
+        else:
+            rows, has_newer, has_older = await list_orders_page(pool, status, newer_than=cursor)
+    else:
+        rows, has_newer, has_older = await list_orders_page(pool, status)
+
+    try:
+        await query.edit_message_text(
+            render_orders_page(status, rows),
+            reply_markup=kb_admin_orders(status, [int(r["id"]) for r in rows], has_newer, has_older),
+        )
+    except BadRequest as e:
+        # same tab tapped twice
+        if "not modified" not in str(e).lower():
+            raise
+
+
+# ================== UPDATE PROCESSING ==================
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # concurrent across users, strictly sequential (arrival order) per user,
+    # so user_data["buy"] / fee_input / users.state transitions never interleave
+    def __init__(self, max_workers: int, max_pending: int) -> None:
+        super().__init__(max(max_workers, max_pending))
+        self._workers = asyncio.BoundedSemaphore(max_workers)
+        self._user_locks: Dict[int, asyncio.Lock] = {}
+        self._user_pending: Dict[int, int] = {}
+
+    async def do_process_update(self, update: object, coroutine: Any) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._workers:
+                await coroutine
+            return
+
+        uid = user.id
+        lock = self._user_locks.get(uid)
+        if lock is None:
+            lock = self._user_locks[uid] = asyncio.Lock()
+        self._user_pending[uid] = self._user_pending.get(uid, 0) + 1
+        try:
+            # take the user's turn first, so a user's queued updates don't hold worker slots
+            async with lock, self._workers:
+                await coroutine
+        finally:
+            left = self._user_pending[uid] - 1
+            if left:
+                self._user_pending[uid] = left
+            else:
+                del self._user_pending[uid]
+                del self._user_locks[uid]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+async def admin_dbstats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not update.effective_user or not is_admin(update.effective_user.id) or not update.message:
+        return
+    pool: DbPool = context.application.bot_data["db_pool"]
+    size, max_size = pool.size()
+    st = DB_STATS
+    wait_avg = st.acquire_wait_total / st.acquires if st.acquires else 0.0
+    lines = [
+        "DB STATS\n",
+        f"Pool: {size}/{max_size}, in use: {st.in_use} (max {st.in_use_max})",
+        f"Acquires: {st.acquires}, wait avg {wait_avg * 1000:.2f}ms, max {st.acquire_wait_max * 1000:.2f}ms",
+        f"User write-behind failures: {st.write_behind_failures}",
+        "",
+        "Queries (count / avg ms / max ms / errors):",
+    ]
+    top = sorted(st.queries.items(), key=lambda kv: kv[1][1], reverse=True)[:15]
+    for name, (count, total, worst, errors) in top:
+        lines.append(f"{name}: {count} / {total / count * 1000:.2f} / {worst * 1000:.2f} / {errors}")
+    await update.message.reply_text("\n".join(lines))
+
+
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not update.effective_user or not is_admin(update.effective_user.id) or not update.message:
+        return
+    lines = [
+        "HANDLER STATS\n",
+        "handler: count / avg ms / max ms / db ms / api ms / queries / errors (avg per update)",
+    ]
+    top = sorted(HANDLER_STATS.items(), key=lambda kv: kv[1].wall, reverse=True)[:20]
+    for name, st in top:
+        if not st.count:
+            continue
+        n = st.count
+        lines.append(
+            f"{name}: {n} / {st.wall / n * 1000:.1f} / {st.wall_max * 1000:.1f} / "
+            f"{st.db / n * 1000:.1f} / {st.api / n * 1000:.1f} / {st.queries / n:.1f} / {st.errors}"
+        )
+    await update.message.reply_text("\n".join(lines))
+
+
+async def admin_reloadtexts(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not update.effective_user or not is_admin(update.effective_user.id) or not update.message:
+        return
+    pool: DbPool = context.application.bot_data["db_pool"]
+    try:
+        texts = await reload_texts()
+    except (OSError, ValueError) as e:
+        await update.message.reply_text(f"❌ Texts not reloaded: {e}")
+        return
+    await publish_invalidation(pool, "texts")  # other processes read the same LOCALES_DIR
+    lines = [f"✅ Texts reloaded from {LOCALES_DIR}: {', '.join(texts.langs)}"]
+    for lang in texts.langs:
+        if texts.missing[lang]:
+            lines.append(f"{lang}: {len(texts.missing[lang])} missing ({', '.join(texts.missing[lang][:10])})")
+        if texts.unknown[lang]:
+            lines.append(f"{lang}: unknown ids {', '.join(texts.unknown[lang][:10])}")
+    await update.message.reply_text("\n".join(lines))
+
+
+# ================== OUTBOUND ==================
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.blocked_until = 0.0  # set from RetryAfter
+
+    def wait_time(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class SendJob:
+    __slots__ = ("priority", "seq", "chat_id", "merge_key", "callback", "args", "kwargs", "future", "attempts")
+
+    def __init__(self, priority: int, seq: int, chat_id: Any, merge_key: Any, callback: Any, args: Any, kwargs: Any) -> None:
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.merge_key = merge_key
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.attempts = 0
+
+    def __lt__(self, other: "SendJob") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+PRIORITY_USER = 0
+PRIORITY_ADMIN = 1  # bookkeeping in the admin chat yields to customer replies
+
+
+class SendScheduler(BaseRateLimiter):
+    # Every Bot API call with a chat_id is queued here: global + per-chat token
+    # buckets, customer chats before the admin chat, RetryAfter honoured and
+    # retried, and a queued edit of a message is replaced by a newer edit of it.
+    # Jobs wait in a heap per chat; a chat with jobs sits either in _ready
+    # (its bucket allows a send, keyed by its head job) or in _waiting (keyed by
+    # when it will), so a dispatch costs O(log chats) however long the queue is.
+    def __init__(self) -> None:
+        # the Bot API limit is per bot: shard workers split it
+        rate = SEND_GLOBAL_RATE / SHARD_WORKERS if BOT_MODE == "shard" else SEND_GLOBAL_RATE
+        self._global = TokenBucket(rate, rate)
+        self._chats: Dict[Any, TokenBucket] = {}
+        self._queues: Dict[Any, List[SendJob]] = {}
+        self._ready: List[Tuple[int, int, Any]] = []  # (priority, seq, chat_id) of the chat's head job
+        self._waiting: List[Tuple[float, Any]] = []  # (monotonic time its bucket allows a send, chat_id)
+        self._size = 0
+        self._pending_edits: Dict[Any, SendJob] = {}
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def initialize(self) -> None:
+        # called on every Bot.initialize, and the Application and its Updater both initialize the bot
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def process_request(
+        self,
+        callback: Any,
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Any],
+    ) -> Any:
+        start = time.perf_counter()
+        try:
+            return await self._submit(callback, args, kwargs, endpoint, data)
+        finally:
+            trace_api(time.perf_counter() - start)
+
+    async def _submit(self, callback: Any, args: Any, kwargs: Dict[str, Any], endpoint: str, data: Dict[str, Any]) -> Any:
+        chat_id = data.get("chat_id")
+        if chat_id is None or self._task is None:
+            # getUpdates, answerCallbackQuery, ... are not chat messages
+            return await callback(*args, **kwargs)
+
+        merge_key = None
+        if endpoint.startswith("editMessage") and data.get("message_id"):
+            merge_key = (endpoint, str(chat_id), data["message_id"])
+            queued = self._pending_edits.get(merge_key)
+            if queued is not None:
+                # not sent yet -> send only the newest content, both callers get its result
+                queued.callback, queued.args, queued.kwargs = callback, args, kwargs
+                return await asyncio.shield(queued.future)
+
+        priority = PRIORITY_ADMIN if str(chat_id) == ADMIN_ID else PRIORITY_USER
+        self._seq += 1
+        job = SendJob(priority, self._seq, str(chat_id), merge_key, callback, args, kwargs)
+        if merge_key is not None:
+            self._pending_edits[merge_key] = job
+        self._enqueue(job)
+        return await asyncio.shield(job.future)
+
+    def _enqueue(self, job: SendJob) -> None:
+        queue = self._queues.get(job.chat_id)
+        self._size += 1
+        if queue is not None:
+            heapq.heappush(queue, job)  # the chat is already in _ready or _waiting
+            return
+        self._queues[job.chat_id] = [job]
+        self._schedule(job.chat_id, time.monotonic())
+        self._wakeup.set()
+
+    def _schedule(self, chat_id: Any, now: float) -> None:
+        delay = self._bucket(chat_id).wait_time(now)
+        if delay > 0:
+            heapq.heappush(self._waiting, (now + delay, chat_id))
+        else:
+            head = self._queues[chat_id][0]
+            heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+
+    def _bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+        return bucket
+
+    async def _dispatch(self) -> None:
+        while True:
+            now = time.monotonic()
+            while self._waiting and self._waiting[0][0] <= now:
+                self._schedule(heapq.heappop(self._waiting)[1], now)
+
+            if not self._ready:
+                delay: Optional[float] = self._waiting[0][0] - now if self._waiting else None
+            else:
+                delay = self._global.wait_time(now)
+            if delay is None or delay > 0:
+                self._wakeup.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                continue
+
+            # best-priority chat that can send now; RetryAfter may have blocked it since
+            chat_id = heapq.heappop(self._ready)[2]
+            bucket = self._bucket(chat_id)
+            if bucket.wait_time(now) > 0:
+                self._schedule(chat_id, now)
+                continue
+            queue = self._queues[chat_id]
+            job = heapq.heappop(queue)
+            self._size -= 1
+            self._global.take()
+            bucket.take()
+            if queue:
+                self._schedule(chat_id, now)
+            else:
+                del self._queues[chat_id]
+            if job.merge_key is not None:
+                self._pending_edits.pop(job.merge_key, None)
+            asyncio.get_running_loop().create_task(self._run(job))
+
+    async def _run(self, job: SendJob) -> None:
+        try:
+            result = await job.callback(*job.args, **job.kwargs)
+        except RetryAfter as e:
+            job.attempts += 1
+            if job.attempts > SEND_MAX_RETRIES:
+                job.future.set_exception(e)
+                return
+            self._bucket(job.chat_id).blocked_until = time.monotonic() + float(e.retry_after)
+            self._enqueue(job)
+            return
+        except Exception as e:
+            job.future.set_exception(e)
+            return
+        job.future.set_result(result)
+
+    def queue_size(self) -> int:
+        return self._size
+
+
+# ================== CALLBACK ROUTING ==================
+# One CallbackQueryHandler for all inline buttons: the payload is parsed once and
+# routed by an exact (namespace, verb) lookup instead of trying a regex per handler.
+class CallbackAction(NamedTuple):
+    namespace: str  # "buy"
+    verb: str  # "qty"; "" when there is none, "delivery:yes" for multi-word verbs
+    args: Tuple[int, ...]  # (item_id, qty)
+
+
+def parse_callback(data: str) -> Optional[CallbackAction]:
+    # "<namespace>[:<word>...][:<int>...]" — words form the verb, trailing numbers the args
+    tokens = data.split(":")
+    words: List[str] = []
+    args: List[int] = []
+    for tok in tokens[1:]:
+        if tok.isdigit() and tok.isascii():
+            args.append(int(tok))
+        elif args or not tok:
+            return None
+        else:
+            words.append(tok)
+    return CallbackAction(tokens[0], ":".join(words), tuple(args))
+
+
+# (namespace, verb) -> (handler(update, context, action), accepted numbers of args)
+CALLBACK_ROUTES: Dict[Tuple[str, str], Tuple[Any, Tuple[int, ...]]] = {}
+
+
+def route(handler: Any, namespace: str, verbs: Sequence[str], nargs: Tuple[int, ...] = (0,)) -> None:
+    handler = traced(handler)
+    for verb in verbs:
+        CALLBACK_ROUTES[(namespace, verb)] = (handler, nargs)
+
+
+route(on_lang_or_verify, "lang", TEXTS.langs)
+route(on_lang_or_verify, "verify", ("",))
+route(safe_menu_click, "safe", ("shop", "buy", "orders", "help", "account", "home"))
+route(item_open, "item", ("",), (1, 2))
+route(shop_page_callback, "shop", ("from", "before", "open"), (1,))
+route(buy_callback, "buy", ("clear", "back", "next", "delivery:yes", "delivery:no"))
+route(buy_callback, "buy", ("item", "from", "before"), (1,))
+route(buy_callback, "buy", ("qty",), (2,))
+route(user_orders_callback, "uord", ("view", "cancel", "confirm"), (1,))
+route(admin_decision, "adm", ("acc", "dec"), (1,))
+route(admin_remove_safe_callback, "adm", ("rem",), (1,))
+route(admin_removeitem_callback, "adm", ("rmitem",), (1,))
+route(admin_order_callback, "ord", ("complete", "fee"), (1,))
+route(admin_orders_callback, "aord", ORDER_STATUSES)
+route(admin_orders_callback, "aord", [f"{st}:{d}" for st in ORDER_STATUSES for d in ("a", "b")], (1,))
+route(admin_orders_callback, "aord", ("o",), (1,))
+
+
+def resolve_callback(data: str) -> Optional[Tuple[Any, CallbackAction]]:
+    cb = parse_callback(data)
+    if cb is None:
+        return None
+    target = CALLBACK_ROUTES.get((cb.namespace, cb.verb))
+    if target is None or len(cb.args) not in target[1]:
+        return None
+    return target[0], cb
+
+
+async def dispatch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    resolved = resolve_callback(query.data or "")
+    if resolved is None:
+        # stale or foreign button: just stop the spinner
+        await query.answer()
+        return
+    handler, cb = resolved
+    await handler(update, context, cb)
+
+
+# ================== SHARDING ==================
+# BOT_MODE=sharded: this process only terminates the webhook and forwards each update, by
+# effective_user.id, to one of SHARD_WORKERS worker processes (BOT_MODE=shard), each a full
+# Application with its own pool. One socketpair per worker, inherited by the child (no port
+# anything else on the host could connect to), keeps every user's updates in arrival order,
+# so PerUserUpdateProcessor's guarantees, user_data and USER_CACHE stay per-process. Writes
+# that reach another shard's data publish on CACHE_CHANNEL.
+# Frames front -> worker: SHARD_FRAME(kind, payload length) + update JSON; worker -> front:
+# one byte once it is up, then one per frame, after the update is queued (SHARD_UPDATE) or
+# processed (SHARD_BARRIER).
+SHARD_FRAME = struct.Struct("!BI")
+SHARD_UPDATE = 0
+SHARD_BARRIER = 1  # acked once everything sent before it has been handled
+ADMIN_SHARD = 0  # admin and user-less updates, so /add, fee_input etc. share one process
+SHARD_CONNECT_TIMEOUT = 60.0  # worker start: migrations, settings, catalog
+SHARD_IDLE_TIMEOUT = 120.0  # keep-alive webhook connections
+WEBHOOK_MAX_BODY = 1 << 20  # bytes; an update is a few KB
+
+
+def shard_for(user_id: Optional[int], shards: int = SHARD_WORKERS) -> int:
+    if user_id is None or user_id == ADMIN_ID_INT:
+        return ADMIN_SHARD
+    # Fibonacci hashing: sequential ids spread evenly
+    return ((user_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) % shards
+
+
+def owns_user(user_id: int) -> bool:
+    return BOT_MODE != "shard" or shard_for(user_id) == SHARD_INDEX
+
+
+def delivers_outbox() -> bool:
+    # one sender for the admin chat: per-chat buckets are per process, and the admin
+    # shard already sends everything else there. order_done notices to customers go
+    # out from here too, next to their own shard's replies; one per order, so within
+    # SEND_CHAT_BURST.
+    return BOT_MODE != "shard" or SHARD_INDEX == ADMIN_SHARD
+
+
+def update_user_id(data: Dict[str, Any]) -> Optional[int]:
+    # Update.effective_user without building the Update: the sender of whatever the update carries
+    for value in data.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user")
+            if isinstance(user, dict) and "id" in user:
+                return int(user["id"])
+    return None
+
+
+async def _serve_shard(
+    app: Application, stop: asyncio.Event, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    try:
+        while True:
+            kind, size = SHARD_FRAME.unpack(await reader.readexactly(SHARD_FRAME.size))
+            payload = await reader.readexactly(size)
+            if kind == SHARD_UPDATE:
+                with contextlib.suppress(ValueError):
+                    await app.update_queue.put(Update.de_json(json.loads(payload), app.bot))
+            elif kind == SHARD_BARRIER:
+                await app.update_queue.join()
+            writer.write(b"\x00")
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+        stop.set()  # the front went away (or is restarting us)
+
+
+async def run_shard_worker(app: Application) -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    # what main() and run_polling/run_webhook do around the update source
+    await migrate()
+    await app.initialize()
+    await on_startup(app)
+    await app.start()
+    reader, writer = await asyncio.open_connection(sock=socket.socket(fileno=SHARD_FD))
+    writer.write(b"\x00")  # up
+    serve = loop.create_task(_serve_shard(app, stop, reader, writer))
+    try:
+        await stop.wait()
+    finally:
+        serve.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await serve
+        await app.stop()
+        await on_stop(app)
+        await app.shutdown()
+        await on_shutdown(app)
+
+
+class ShardLink:
+    # one worker process: starts it, restarts it when it dies, and carries its frames
+    def __init__(self, index: int, count: int, command: Sequence[str]) -> None:
+        self.index = index
+        self.count = count
+        self.command = list(command)
+        self.restarts = 0
+        self._proc: Optional[asyncio.subprocess.Process] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._acks: "deque[asyncio.Future]" = deque()
+        self._ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def wait_ready(self) -> None:
+        await asyncio.wait_for(self._ready.wait(), SHARD_CONNECT_TIMEOUT)
+
+    async def _spawn(self) -> asyncio.StreamReader:
+        front_end, worker_end = socket.socketpair()
+        env = dict(
+            os.environ,
+            BOT_MODE="shard",
+            SHARD_INDEX=str(self.index),
+            SHARD_WORKERS=str(self.count),
+            SHARD_FD=str(worker_end.fileno()),
+        )
+        if METRICS_PORT:
+            env["METRICS_PORT"] = str(METRICS_PORT + self.index)
+        try:
+            self._proc = await asyncio.create_subprocess_exec(*self.command, env=env, pass_fds=(worker_end.fileno(),))
+        except BaseException:
+            front_end.close()
+            raise
+        finally:
+            worker_end.close()
+        reader, self._writer = await asyncio.open_connection(sock=front_end)
+        # EOF if the worker dies while starting
+        await asyncio.wait_for(reader.readexactly(1), SHARD_CONNECT_TIMEOUT)
+        return reader
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                reader = await self._spawn()
+                self._ready.set()
+                while True:
+                    acks = await reader.read(4096)
+                    if not acks:
+                        break
+                    for _ in acks:
+                        fut = self._acks.popleft()
+                        if not fut.done():
+                            fut.set_result(None)
+            except (OSError, EOFError, asyncio.TimeoutError):
+                pass
+            finally:
+                self._ready.clear()
+                while self._acks:
+                    fut = self._acks.popleft()
+                    if not fut.done():
+                        fut.set_exception(ConnectionError(f"shard {self.index} is gone"))
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+                await self._terminate()
+            self.restarts += 1
+            sys.stderr.write(f"shard {self.index} exited, restarting\n")
+            await asyncio.sleep(1)
+
+    async def _terminate(self) -> None:
+        proc, self._proc = self._proc, None
+        if proc is None or proc.returncode is not None:
+            return
+        proc.terminate()
+        try:
+            await asyncio.wait_for(proc.wait(), 30)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+
+    async def send(self, kind: int, payload: bytes = b"") -> None:
+        # raises ConnectionError/TimeoutError if the worker is down; the caller answers 503
+        await self.wait_ready()
+        fut = asyncio.get_running_loop().create_future()
+        self._acks.append(fut)
+        self._writer.write(SHARD_FRAME.pack(kind, len(payload)) + payload)
+        with contextlib.suppress(ConnectionError):
+            await self._writer.drain()  # a broken connection fails fut as well
+        await fut
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+
+class ShardFront:
+    def __init__(self, workers: int, command: Sequence[str]) -> None:
+        self.links = [ShardLink(i, workers, command) for i in range(workers)]
+
+    async def start(self) -> None:
+        # admin shard alone first: it runs the migrations the others would wait on (see migrate)
+        self.links[ADMIN_SHARD].start()
+        await self.links[ADMIN_SHARD].wait_ready()
+        for link in self.links:
+            link.start()
+        await asyncio.gather(*(link.wait_ready() for link in self.links))
+
+    async def forward(self, raw: bytes) -> None:
+        user_id = update_user_id(json.loads(raw))  # ValueError: not an update
+        await self.links[shard_for(user_id, len(self.links))].send(SHARD_UPDATE, raw)
+
+    async def barrier(self) -> None:
+        await asyncio.gather(*(link.send(SHARD_BARRIER) for link in self.links))
+
+    async def stop(self) -> None:
+        await asyncio.gather(*(link.stop() for link in self.links))
+
+
+@tornado.web.stream_request_body
+class ShardWebhookHandler(tornado.web.RequestHandler):
+    # the BOT_MODE=sharded webhook endpoint; the secret is checked on the headers,
+    # before any of the body is read, and bodies over WEBHOOK_MAX_BODY are refused
+    SUPPORTED_METHODS = ("POST",)
+
+    def initialize(self, front: ShardFront, secret: str) -> None:
+        self.front = front
+        self.secret = secret.encode()
+        self.chunks: List[bytes] = []
+
+    def prepare(self) -> None:
+        token = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode()
+        if not hmac.compare_digest(token, self.secret):
+            raise tornado.web.HTTPError(403)
+
+    def data_received(self, chunk: bytes) -> None:
+        self.chunks.append(chunk)
+
+    async def post(self) -> None:
+        try:
+            await self.front.forward(b"".join(self.chunks))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        except (ConnectionError, asyncio.TimeoutError):
+            raise tornado.web.HTTPError(503)  # Telegram retries
+
+
+def shard_webhook_server(front: ShardFront, secret: Optional[str] = None) -> tornado.httpserver.HTTPServer:
+    # secret: defaults to WEBHOOK_SECRET (bench.py passes its own); call .listen() on the result
+    app = tornado.web.Application(
+        [(f"/{WEBHOOK_PATH}", ShardWebhookHandler, dict(front=front, secret=secret or WEBHOOK_SECRET))],
+        log_function=lambda handler: None,  # no access log, like the polling/webhook modes
+    )
+    return tornado.httpserver.HTTPServer(
+        app, max_body_size=WEBHOOK_MAX_BODY, idle_connection_timeout=SHARD_IDLE_TIMEOUT
+    )
+
+
+async def run_sharded_front(command: Sequence[str]) -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    front = ShardFront(SHARD_WORKERS, command)
+    await front.start()
+    server = shard_webhook_server(front)
+    server.listen(WEBHOOK_PORT, WEBHOOK_LISTEN)
+    try:
+        async with Bot(BOT_TOKEN) as bot:
+            await bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES,
+            )
+        await stop.wait()
+    finally:
+        server.stop()
+        await server.close_all_connections()
+        await front.stop()
+
+
 # ================== MAIN ==================
-def main() -> None:
-    app = (
+# only what the handlers below consume
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+
+async def drop_unexpected_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Telegram only sends ALLOWED_UPDATES; anything else was posted to the webhook by hand
+    # (e.g. edited_message would otherwise reach the filters.TEXT handler)
+    if not any(getattr(update, kind) for kind in ALLOWED_UPDATES):
+        raise ApplicationHandlerStop
+
+
+def webhook_options(**overrides: Any) -> Dict[str, Any]:
+    # Application.run_webhook / Updater.start_webhook arguments
+    options: Dict[str, Any] = dict(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=f"{(WEBHOOK_URL or '').rstrip('/')}/{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=ALLOWED_UPDATES,
+    )
+    options.update(overrides)
+    return options
+
+
+def build_application(request: Optional[BaseRequest] = None) -> Application:
+    # request: replaces the HTTP transport to the Bot API (bench.py passes a stub)
+    builder = (
         Application.builder()
         .token(BOT_TOKEN)
         .post_init(on_startup)
+        .post_stop(on_stop)
         .post_shutdown(on_shutdown)
-        .build()
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_WORKERS, UPDATE_MAX_PENDING))
+        .persistence(PgPersistence())
+        .rate_limiter(SendScheduler())
     )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    app = builder.build()
 
     # user
     app.add_handler(CommandHandler("start", start_cmd))
@@ -1843,25 +4463,41 @@ def main() -> None:
     app.add_handler(CommandHandler("removeitem", admin_removeitem))
     app.add_handler(CommandHandler("search", admin_search))
     app.add_handler(CommandHandler("shearch", admin_search))  # alias
+    app.add_handler(CommandHandler("dbstats", admin_dbstats))
+    app.add_handler(CommandHandler("stats", admin_stats))
+    app.add_handler(CommandHandler("orders", admin_orders))
+    app.add_handler(CommandHandler("reloadtexts", admin_reloadtexts))
 
-    # callbacks
-    app.add_handler(CallbackQueryHandler(on_lang_or_verify, pattern=r"^(lang:(et|ru|en)|verify)$"))
-    app.add_handler(CallbackQueryHandler(safe_menu_click, pattern=r"^safe:(shop|buy|orders|help|account|home)$"))
-    app.add_handler(CallbackQueryHandler(item_open, pattern=r"^item:\d+$"))
-    app.add_handler(CallbackQueryHandler(buy_callback, pattern=r"^buy:"))
-    app.add_handler(CallbackQueryHandler(user_orders_callback, pattern=r"^uord:(view|cancel|confirm):\d+$"))
-
-    # admin callbacks
-    app.add_handler(CallbackQueryHandler(admin_decision, pattern=r"^adm:(acc|dec):\d+$"))
-    app.add_handler(CallbackQueryHandler(admin_remove_safe_callback, pattern=r"^adm:rem:\d+$"))
-    app.add_handler(CallbackQueryHandler(admin_removeitem_callback, pattern=r"^adm:rmitem:\d+$"))
-    app.add_handler(CallbackQueryHandler(admin_order_callback, pattern=r"^ord:(complete|fee):\d+$"))
+    # callbacks (user + admin), see CALLBACK_ROUTES
+    app.add_handler(CallbackQueryHandler(dispatch_callback))
 
     # messages
     app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
 
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    # tracing around whichever group 0 handler matches
+    for handler in app.handlers[0]:
+        handler.callback = traced(handler.callback)
+    app.add_handler(TypeHandler(Update, drop_unexpected_update), group=-2)
+    app.add_handler(TypeHandler(Update, trace_start), group=-1)
+    app.add_handler(TypeHandler(Update, trace_finish), group=TRACE_GROUP_END)
+    return app
+
+
+def main() -> None:
+    if BOT_MODE == "sharded":
+        asyncio.run(run_sharded_front([sys.executable, os.path.abspath(__file__)]))
+        return
+    if BOT_MODE == "shard":
+        asyncio.run(run_shard_worker(build_application()))
+        return
+    app = build_application()
+    # the loop run_polling/run_webhook pick up with get_event_loop()
+    asyncio.get_event_loop().run_until_complete(migrate())
+    if BOT_MODE == "webhook":
+        app.run_webhook(**webhook_options())
+    else:
+        app.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":